@@ -0,0 +1,402 @@
+import os, sys, shutil
+import io
+import time
+import json
+import hashlib, hmac
+import argparse
+import contextlib
+import getpass
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+import paramiko
+
+# End to end benchmark of the command line and lambda flows, without AWS and without a victim host:
+# S3 and EC2 are local stand-ins, the host is a local SSH/SFTP server running the collector
+# (sent through SFTP as in a real response) over synthetic artifacts and a synthetic memory image.
+# One JSON line per run is appended to the results file, to compare releases.
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(repo_path, d) for d in ('benchmark', 'commandline', 'lambda', 'resources')]
+
+S3_bucket = 'my-forensics'
+S3_evidence_path = 'forensics/evidence/'
+S3_resources = ['forensics/resources/artifacts.json', 'forensics/resources/collectLocalForensics.py']
+S3_EC2_key = 'forensics/config/EC2-key.pem'
+S3_custody_key = 'forensics/config/custody.key'
+S3_lime_cache_path = 'forensics/resources/lime/'
+interrupted_part_size = 1024 * 1024  # Multipart part size of interrupted runs, so even a small archive goes up in several parts
+working_path = '/tmp/forensics/'  # Collector working path, the same on the "host" as in the real one
+instance_id = 'i-0000000000bench'
+
+# Orchestrator functions timed as phases, by module. Concurrent calls (uploads) add up.
+# forensicsCommon (code shared by the orchestrators) only gets the stand-ins, its functions are timed where the orchestrators call them
+timed_functions = {
+    'forensicsCommon': [],
+    'containmentAndForensicsEC2': ['get_fleet_data', 'preserve_status', 'forensics', 'ec2_containment', 'lime_module_cache_key',
+                                   'stream_memory_dump', 'stream_collection', 'sftp_to_s3', 'upload_individual', 'upload_deduplicated'],
+    'EC2ForensicsEvidence': ['forensics', 'lime_module_cache_key', 'stream_memory_dump', 'stream_collection', 'sftp_to_s3', 'upload_individual', 'upload_deduplicated'],
+    'InstanceContainAndPreserveStatus': ['get_instance_data', 'preserve_status', 'ec2_containment'],
+    'PreservationTracker': ['pending_preservations', 'describe_by_id']}
+
+
+class PhaseTimer:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+
+    def wrap(self, module, name):
+        func = getattr(module, name)
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.time() - start)
+        setattr(module, name, timed)
+
+    def add(self, name, seconds):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'seconds': 0, 'calls': 0})
+            phase['seconds'] = round(phase['seconds'] + seconds, 3)
+            phase['calls'] += 1
+
+    def reset(self):
+        with self.lock:
+            phases, self.phases = self.phases, {}
+        return phases
+
+
+class DiskSampler:
+    """Peak size of the collector working path on the host, sampled every interval seconds while a run goes on"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+    def _sample(self):
+        while not self.stop.wait(self.interval):
+            size = 0
+            for root, dirs, files in os.walk(working_path):
+                for name in files:
+                    try:
+                        size += os.path.getsize(os.path.join(root, name))
+                    except OSError:
+                        pass  # Removed while it was walked
+            self.peak = max(self.peak, size)
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def make_dataset(sandbox, params):
+    """Synthetic memory image and log files (kept in source/, copied for every run: the collector removes collected files)"""
+    import collectLocalForensics
+    rng = random.Random(0)
+    source = os.path.join(sandbox, 'source')
+    os.makedirs(source)
+    memory_image = None
+    if params['memory_mb']:
+        memory_image = os.path.join(sandbox, 'memory.raw')
+        with open(memory_image, 'wb') as f:
+            for n in range(params['memory_mb']):
+                f.write(collectLocalForensics.synthetic_memory(1024 * 1024, rng))
+    for n in range(params['log_files']):
+        with open(os.path.join(source, 'messages-{}'.format(n)), 'wb') as f:
+            f.write(collectLocalForensics.synthetic_logs(params['log_mb'] * 1024 * 1024 // params['log_files'], rng))
+
+    artifacts = [{'name': 'HostnameCommand', 'type': 'COMMAND', 'attributes': ['cat', '/etc/hostname']},
+                 {'name': 'KernelCommand', 'type': 'COMMAND', 'attributes': ['uname', '-a']},
+                 {'name': 'ListProcessesPsCommand', 'type': 'COMMAND', 'attributes': ['ps', '-ef']},
+                 {'name': 'ProcSnapshot', 'type': 'PROC', 'volatility': 'network', 'attributes': []},
+                 {'name': 'SyntheticLogs', 'type': 'FILE', 'attributes': [os.path.join(sandbox, 'logs', 'messages-*')]}]
+    return memory_image, json.dumps(artifacts, indent=2).encode()
+
+
+def reset_environment(sandbox, s3, ec2, artifacts, params):
+    logs = os.path.join(sandbox, 'logs')
+    if os.path.exists(logs):
+        shutil.rmtree(logs)
+    shutil.copytree(os.path.join(sandbox, 'source'), logs)
+    if os.path.exists(working_path):
+        shutil.rmtree(working_path)
+    if params['cold_cache'] and os.path.exists(os.path.join(sandbox, 'cache')):
+        shutil.rmtree(os.path.join(sandbox, 'cache'))
+
+    key = io.StringIO()
+    params['ssh_key'].write_private_key(key)
+    with open(os.path.join(repo_path, 'resources', 'collectLocalForensics.py'), 'rb') as f:
+        collector = f.read()
+    release = os.uname().release
+    custody_key = os.urandom(32).hex().encode()
+    # Cached LiME module as published from a trusted builder, with its signed record; the collector gets --memory-image and never loads it
+    lime_module = b'\0' * 4096
+    lime_record = {'release': release, 'sha256': hashlib.sha256(lime_module).hexdigest()}
+    lime_record['signature'] = {'algorithm': 'HMAC-SHA256', 'key': S3_custody_key, 'value': hmac.new(
+        custody_key, json.dumps(lime_record, sort_keys=True, separators=(',', ':')).encode(), hashlib.sha256).hexdigest()}
+    lime_key = '{}{}/lime-{}.ko'.format(S3_lime_cache_path, release, release)
+    s3.objects = {
+        (S3_bucket, 'forensics/config/containmentAndForensicsEC2_conf.json'): json.dumps({
+            'working_path': working_path,
+            'S3_bucket': S3_bucket,
+            'S3_resources': S3_resources,
+            'S3_evidence_path': S3_evidence_path,
+            'EC2_key': S3_EC2_key,
+            'custody_key': S3_custody_key,
+            'ec2_local_user': getpass.getuser(),
+            'isolation_security_groups': ['isolation_step1', 'isolation'],
+            'forensics_access_security_group': 'forensics_access',
+            'region': 'local',
+            'S3_lime_cache_path': S3_lime_cache_path,
+            'codecs': params['codecs']}).encode(),
+        (S3_bucket, S3_EC2_key): key.getvalue().encode(),
+        (S3_bucket, S3_custody_key): custody_key,
+        (S3_bucket, S3_resources[0]): artifacts,
+        (S3_bucket, S3_resources[1]): collector,
+        (S3_bucket, lime_key): lime_module,
+        (S3_bucket, lime_key + '.json'): json.dumps(lime_record).encode()}
+    ec2.instances, ec2.images, ec2.snapshots = {}, {}, {}
+    ec2.add_instance(instance_id, '127.0.0.1', volumes=params['volumes'])
+
+
+def run_cli(modules, params):
+    cli = modules['containmentAndForensicsEC2']
+    cli.main({'instance_ids': [instance_id], 'filters': [], 'fleet_workers': 1,
+              'memory_dump': bool(params['memory_mb']), 'ami_snapshot': False, 'multi_volume_snapshot': params['multi_volume_snapshot'], 'conserve_files': False,
+              'send_to_s3': True, 's3_data_format': params['s3_data_format'], 'ssh_public_ip': False,
+              'memory_dump_stream': params['memory_dump_stream'], 'stream_evidence': params['stream_evidence'], 'incremental': False,
+              'retrieve': None, 'retrieve_to': '.', 'publish_lime_module': None, 'promote_lime_module': None, 'metrics_file': None,
+              'containment_first': params['containment_first'], 'deadline': None,
+              'size_budget': params['size_budget'], 'time_budget': 0, 'run_id': params['run_id']})
+
+
+def run_lambda(modules, params):
+    modules['EC2ForensicsEvidence'].lambda_handler({'instance_id': instance_id, 'ec2_ip': '127.0.0.1',
+                                                   'no_memory_dump': not params['memory_mb'],
+                                                   'memory_dump_stream': params['memory_dump_stream'],
+                                                   'stream_evidence': params['stream_evidence'],
+                                                   'codecs': params['codecs'],
+                                                   's3_data_format': params['s3_data_format'],
+                                                   'size_budget_mb': params['size_budget'],
+                                                   'run_id': params['run_id']}, None)
+    modules['InstanceContainAndPreserveStatus'].lambda_handler({'instance_id': instance_id, 'no_ami_snapshot': True,
+                                                               'multi_volume_snapshot': params['multi_volume_snapshot']}, None)
+    # Scheduled run of the tracker, the snapshots are complete by then
+    modules['PreservationTracker'].lambda_handler({}, None)
+
+
+flows = {'cli': run_cli, 'lambda': run_lambda}
+
+
+def load_modules(s3, ec2, timer, host, sandbox):
+    # Orchestrators create their boto3 clients on import, they are replaced by the stand-ins
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.update({'FORENSICS_BUCKET': S3_bucket, 'FORENSICS_EVIDENCE_PATH': S3_evidence_path,
+                       'EC2_LOCAL_USER': getpass.getuser(), 'REGION': 'us-east-1'})
+    modules = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, functions in timed_functions.items():
+            module = __import__(name)
+            module.s3_client = s3
+            if hasattr(module, 'cache_path'):
+                module.cache_path = os.path.join(sandbox, 'cache', name, '')
+            if hasattr(module, 'ec2_client'):
+                module.ec2_client = ec2
+            for f in functions:
+                if hasattr(module, f):
+                    timer.wrap(module, f)
+            modules[name] = module
+
+    # Every SSH connection goes to the local host, whatever the address
+    connect = paramiko.SSHClient.connect
+    paramiko.SSHClient.connect = lambda self, *args, **kwargs: connect(self, *args, **dict(kwargs, port=host.port))
+    return modules
+
+
+def run(flow, n, modules, s3, ec2, host, counters, timer, sandbox, artifacts, params, output):
+    reset_environment(sandbox, s3, ec2, artifacts, params)
+    for module in modules.values():
+        if params['cold_cache'] and hasattr(module, 'cache_index'):
+            module.cache_index = None
+    counters.reset()
+    timer.reset()
+    host.collector_runs = []
+    tracemalloc.start()
+    start = time.time()
+    params = dict(params, run_id='bench_{}_{}_{}'.format(flow, n, int(start)))
+    attempts = 1
+    last_runs = 0
+    interrupted = None
+    with contextlib.redirect_stdout(output), DiskSampler() as disk:
+        # Interrupted run: S3 fails every part past the first ones, the flow is started again with the same run id.
+        # Small parts, so that the evidence goes up in multipart parts whatever its size
+        if params['interrupt_after_parts'] is not None:
+            part_sizes = {name: m.s3_part_size for name, m in modules.items() if hasattr(m, 's3_part_size')}
+            for name in part_sizes:
+                modules[name].s3_part_size = interrupted_part_size
+            s3.parts_left, s3.parts_refused = params['interrupt_after_parts'], 0
+            try:
+                flows[flow](modules, params)
+            finally:
+                s3.parts_left = None
+            interrupted = s3.parts_refused > 0
+            attempts += 1
+        # Collectors of the interrupted attempt can have been stopped, only the last attempt has to succeed
+        last_runs = len(host.collector_runs)
+        try:
+            flows[flow](modules, params)
+        finally:
+            for name, size in part_sizes.items() if interrupted is not None else ():
+                modules[name].s3_part_size = size
+    seconds = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    evidence = [k for b, k in s3.objects if k.startswith(S3_evidence_path) and instance_id in k and 'instance_data' not in k and not k.startswith(S3_evidence_path + 'runs/')]
+    values = counters.reset()
+    phases = timer.reset()
+    phases['collector'] = {'seconds': round(sum(r['seconds'] for r in host.collector_runs), 3), 'calls': len(host.collector_runs)}
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': params['revision'],
+            'flow': flow,
+            'run': n,
+            'config': {k: params[k] for k in ('memory_mb', 'log_mb', 'log_files', 'volumes', 's3_data_format', 'memory_dump_stream', 'stream_evidence', 'codecs', 'latency', 'cold_cache', 'containment_first', 'size_budget', 'multi_volume_snapshot', 'interrupt_after_parts')},
+            'ok': bool(evidence) and all(r['exit_status'] == 0 for r in host.collector_runs[last_runs:]) and run_finished(s3, params['run_id']) and interrupted is not False,
+            'attempts': attempts,
+            'interrupted': interrupted,
+            'seconds': round(seconds, 3),
+            'phases': phases,
+            'bytes': {k: v for k, v in values.items() if 'bytes' in k},
+            'calls': {k: v for k, v in values.items() if k.endswith('_calls')},
+            'orchestrator_peak_kb': peak // 1024,
+            'collector_maxrss_kb': max([r['maxrss_kb'] for r in host.collector_runs] or [0]),
+            'host_disk_peak_kb': disk.peak // 1024,
+            'evidence_objects': len(evidence),
+            'preservations': {'pending': len([k for k in evidence if k.startswith(S3_evidence_path + 'preservation/pending/')]),
+                              'finished': len([k for k in evidence if k.startswith(S3_evidence_path + 'preservation/') and '/pending/' not in k])}}
+
+
+def run_finished(s3, run_id):
+    # Journal of the run says it finished
+    key = '{}runs/{}/{}.json'.format(S3_evidence_path, run_id, instance_id)
+    return bool(json.loads(s3.objects[(S3_bucket, key)])['steps'].get('run', {}).get('done')) if (S3_bucket, key) in s3.objects else False
+
+
+def print_results(results):
+    print('\n{:<8} {:>4} {:>4} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12} {:>12}'.format(
+        'Flow', 'Run', 'OK', 'Total', 'Forensics', 'Collector', 'Upload', 'S3 in MB', 'SSH out MB', 'Orch. peak', 'Coll. RSS', 'Host disk'))
+    for r in results:
+        upload = sum(r['phases'].get(p, {}).get('seconds', 0) for p in ('stream_memory_dump', 'upload_individual', 'upload_deduplicated')) or r['phases'].get('sftp_to_s3', {}).get('seconds', 0)
+        sent = r['bytes'].get('sftp_bytes_read', 0) + r['bytes'].get('ssh_bytes_stdout', 0)
+        print('{:<8} {:>4} {:>4} {:>8.2f}s {:>9.2f}s {:>9.2f}s {:>9.2f}s {:>10.1f} {:>10.1f} {:>9} KB {:>9} KB {:>9} KB'.format(
+            r['flow'], r['run'], 'OK' if r['ok'] else 'FAIL', r['seconds'], r['phases'].get('forensics', {}).get('seconds', 0),
+            r['phases']['collector']['seconds'], upload, r['bytes'].get('s3_bytes_in', 0) / 1048576, sent / 1048576,
+            r['orchestrator_peak_kb'], r['collector_maxrss_kb'], r['host_disk_peak_kb']))
+    for flow in sorted(set(r['flow'] for r in results)):
+        print('{:<8} median total {:.2f}s'.format(flow, statistics.median(r['seconds'] for r in results if r['flow'] == flow)))
+
+
+def main(params):
+    from localStubs import Counters, LocalS3, LocalEC2, LocalHost
+
+    print("I'm going to do this:\n"+str(params).replace('\'','').replace('{', '').replace('}','').replace(',','\n')+'\n')
+    params['revision'] = revision()
+    params['ssh_key'] = paramiko.RSAKey.generate(2048)
+    sandbox = tempfile.mkdtemp(prefix='forensics_benchmark_')
+    output = open(params['log'], 'w') if params['log'] else open(os.devnull, 'w')
+    results = []
+    try:
+        print('Generating synthetic data: memory {} MB, logs {} MB in {} files...'.format(params['memory_mb'], params['log_mb'], params['log_files']))
+        memory_image, artifacts = make_dataset(sandbox, params)
+
+        counters = Counters()
+        timer = PhaseTimer()
+        s3 = LocalS3(counters, params['latency'])
+        ec2 = LocalEC2(counters, params['latency'])
+        host = LocalHost(counters, memory_image)
+        modules = load_modules(s3, ec2, timer, host, sandbox)
+
+        for flow in params['flows']:
+            for n in range(1, params['runs'] + 1):
+                print('Running {} flow, run {}/{}...'.format(flow, n, params['runs']))
+                result = run(flow, n, modules, s3, ec2, host, counters, timer, sandbox, artifacts, params, output)
+                if result['interrupted'] is False:
+                    print('[ERROR] The run was not interrupted: less than {} parts were uploaded before it finished, nothing was resumed.'.format(params['interrupt_after_parts'] + 1))
+                results.append(result)
+                with open(params['results'], 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+        host.close()
+    finally:
+        output.close()
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+    print_results(results)
+    print('\nResults appended to ' + params['results'])
+    return all(r['ok'] for r in results)
+
+
+# From command line arguments:
+if __name__=='__main__':
+    my_parser = argparse.ArgumentParser()
+    my_parser.add_argument('--flow', required=False, dest='flows', type=str, choices=list(flows), action='append', help='Flow to run, can be repeated. --> default: cli and lambda')
+    my_parser.add_argument('--runs', required=False, dest='runs', type=int, default=3, help='Runs of every flow. --> default: 3')
+    my_parser.add_argument('--memory-mb', required=False, dest='memory_mb', type=int, default=64, help='Size of the synthetic memory image, 0 for no memory dump. --> default: 64')
+    my_parser.add_argument('--log-mb', required=False, dest='log_mb', type=int, default=32, help='Total size of the synthetic log files. --> default: 32')
+    my_parser.add_argument('--log-files', required=False, dest='log_files', type=int, default=8, help='Number of synthetic log files. --> default: 8')
+    my_parser.add_argument('--volumes', required=False, dest='volumes', type=int, default=1, help='EBS volumes of the instance. --> default: 1')
+    my_parser.add_argument('--S3-data-format', required=False, dest='s3_data_format', type=str, choices=['individual', 'packed', 'deduplicated'], default='packed', help='--> default: packed')
+    my_parser.add_argument('--memory-dump-stream', required=False, dest='memory_dump_stream', action='store_true', help='Stream the memory image through ssh straight to S3. --> default: false')
+    my_parser.add_argument('--stream-evidence', required=False, dest='stream_evidence', action='store_true', help='The collector streams the evidence through ssh, uploaded while it runs (stored as individual). --> default: false')
+    my_parser.add_argument('--codec', required=False, dest='codecs', type=str, action='append', default=[], help='Collector codec, as [TYPE=]CODEC[:LEVEL]. Can be repeated. --> default: collector default')
+    my_parser.add_argument('--latency', required=False, dest='latency', type=float, default=0.0, help='Seconds added to every S3 and EC2 API call. --> default: 0')
+    my_parser.add_argument('--cold-cache', required=False, dest='cold_cache', action='store_true', help='Empty the orchestrators local cache (config, resources, key) before every run. --> default: false (warm after the first run)')
+    my_parser.add_argument('--containment-first', required=False, dest='containment_first', action='store_true', help='Command line flow in containment-first mode. --> default: false')
+    my_parser.add_argument('--multi-volume-snapshot', required=False, dest='multi_volume_snapshot', action='store_true', help='Snapshot all the volumes in one request. --> default: false (one request per volume)')
+    my_parser.add_argument('--size-budget', required=False, dest='size_budget', type=int, default=0, help='Collection size budget in MB (artifacts over it are truncated or skipped). --> default: no limit')
+    my_parser.add_argument('--interrupt-after-parts', required=False, dest='interrupt_after_parts', type=int, help='Interrupt every run after this many multipart parts uploaded to S3 (the next ones fail), then start it again with the same run id to resume it. --> default: no interruption')
+    my_parser.add_argument('--results', required=False, dest='results', type=str, default='benchmark_results.jsonl', help='File where one JSON line per run is appended. --> default: benchmark_results.jsonl')
+    my_parser.add_argument('--log', required=False, dest='log', type=str, help='File for the output of the flows. --> default: discarded')
+    args = my_parser.parse_args()
+
+    argsh = {
+        'flows': args.flows or list(flows),
+        'runs': args.runs,
+        'memory_mb': args.memory_mb,
+        'log_mb': args.log_mb,
+        'log_files': max(1, args.log_files),
+        'volumes': args.volumes,
+        's3_data_format': args.s3_data_format,
+        'memory_dump_stream': args.memory_dump_stream,
+        'stream_evidence': args.stream_evidence,
+        'codecs': args.codecs,
+        'latency': args.latency,
+        'cold_cache': args.cold_cache,
+        'containment_first': args.containment_first,
+        'size_budget': args.size_budget,
+        'multi_volume_snapshot': args.multi_volume_snapshot,
+        'interrupt_after_parts': args.interrupt_after_parts,
+        'results': args.results,
+        'log': args.log
+    }
+
+    if not main(argsh):
+        sys.exit(1)
@@ -0,0 +1,450 @@
+import os, io
+import logging
+import time, datetime
+import hashlib, base64
+import socket, subprocess, threading
+import types
+import paramiko
+from botocore.exceptions import ClientError
+
+# Local stand-ins for S3, EC2 and the victim host (SSH/SFTP), used by benchmarkForensics.py.
+# Only the calls made by the command line script and the lambdas are implemented.
+
+
+class Counters:
+    """Thread safe byte and call counters shared by the stand-ins"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def reset(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+
+def response(**kwargs):
+    return dict(kwargs, ResponseMetadata={'HTTPStatusCode': 200})
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class LocalS3:
+    """
+    In memory S3 (objects by bucket and key), with optional latency per API call.
+    parts_left: number of parts accepted before every upload_part fails (None: no limit), to interrupt runs.
+    parts_refused counts the parts that failed that way.
+    """
+
+    def __init__(self, counters, latency=0):
+        self.counters = counters
+        self.latency = latency
+        self.objects = {}
+        self.uploads = {}
+        self.parts_left = None
+        self.parts_refused = 0
+        self.lock = threading.Lock()
+
+    def _call(self, operation):
+        self.counters.add('s3_calls')
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, bucket, key, operation):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise client_error('404' if operation == 'HeadObject' else 'NoSuchKey', operation)
+
+    def _put(self, bucket, key, body):
+        self.counters.add('s3_bytes_in', len(body))
+        with self.lock:
+            self.objects[(bucket, key)] = body
+
+    def put_object(self, Body, Bucket, Key, ContentMD5=None, **kwargs):
+        self._call('PutObject')
+        body = Body if isinstance(Body, bytes) else Body.read()
+        if ContentMD5 and base64.b64encode(hashlib.md5(body).digest()).decode() != ContentMD5:
+            raise client_error('BadDigest', 'PutObject')
+        self._put(Bucket, Key, body)
+        return response(ETag='"{}"'.format(hashlib.md5(body).hexdigest()))
+
+    def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None, **kwargs):
+        self._call('GetObject')
+        body = self._get(Bucket, Key, 'GetObject')
+        if IfNoneMatch and IfNoneMatch == '"{}"'.format(hashlib.md5(body).hexdigest()):
+            raise client_error('304', 'GetObject')
+        if Range:
+            start, end = Range[len('bytes='):].split('-')
+            body = body[int(start):int(end) + 1]
+        self.counters.add('s3_bytes_out', len(body))
+        return response(Body=io.BytesIO(body), ContentLength=len(body), ETag='"{}"'.format(hashlib.md5(body).hexdigest()))
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call('HeadObject')
+        body = self._get(Bucket, Key, 'HeadObject')
+        return response(ContentLength=len(body))
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self._call('GetObject')
+        body = self._get(Bucket, Key, 'GetObject')
+        self.counters.add('s3_bytes_out', len(body))
+        with open(Filename, 'wb') as f:
+            f.write(body)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call('CreateMultipartUpload')
+        upload_id = hashlib.md5('{}/{}/{}'.format(Bucket, Key, time.time()).encode()).hexdigest()
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return response(UploadId=upload_id)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5=None, **kwargs):
+        self._call('UploadPart')
+        if ContentMD5 and base64.b64encode(hashlib.md5(Body).digest()).decode() != ContentMD5:
+            raise client_error('BadDigest', 'UploadPart')
+        with self.lock:
+            if self.parts_left is not None:
+                if self.parts_left <= 0:
+                    self.parts_refused += 1
+                    raise client_error('RequestTimeout', 'UploadPart')
+                self.parts_left -= 1
+            if UploadId not in self.uploads:
+                raise client_error('NoSuchUpload', 'UploadPart')
+            self.uploads[UploadId][PartNumber] = Body
+        self.counters.add('s3_bytes_in', len(Body))
+        return response(ETag='"{}"'.format(hashlib.md5(Body).hexdigest()))
+
+    def list_parts(self, Bucket, Key, UploadId, **kwargs):
+        self._call('ListParts')
+        with self.lock:
+            if UploadId not in self.uploads:
+                raise client_error('NoSuchUpload', 'ListParts')
+            parts = sorted(self.uploads[UploadId].items())
+        return response(Parts=[{'PartNumber': n, 'Size': len(body), 'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())} for n, body in parts])
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._call('CompleteMultipartUpload')
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+            self.objects[(Bucket, Key)] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+        return response()
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._call('AbortMultipartUpload')
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return response()
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call('DeleteObject')
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return response()
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self._call('ListObjectsV2')
+        with self.lock:
+            keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+        return response(Contents=[{'Key': k, 'Size': len(self.objects[(Bucket, k)])} for k in keys])
+
+    def get_paginator(self, operation):
+        s3 = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                yield getattr(s3, operation)(**kwargs)
+        return Paginator()
+
+
+class LocalEC2:
+    """EC2 API over a dict of instances (describe_instances format), with optional latency per API call"""
+
+    def __init__(self, counters, latency=0):
+        self.counters = counters
+        self.latency = latency
+        self.instances = {}
+        self.images = {}
+        self.snapshots = {}
+        self.meta = types.SimpleNamespace(region_name='local-1')
+
+    def _call(self):
+        self.counters.add('ec2_calls')
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_instance(self, Iid, ip, volumes=1, tags=None):
+        self.instances[Iid] = {
+            'InstanceId': Iid,
+            'ImageId': 'ami-00000000000000000',
+            'InstanceType': 't3.micro',
+            'LaunchTime': '2021-01-17 18:44:15+00:00',
+            'Placement': {'AvailabilityZone': 'local-1a'},
+            'State': {'Name': 'running'},
+            'PrivateIpAddress': ip,
+            'PrivateDnsName': 'localhost',
+            'PublicIpAddress': ip,
+            'PublicDnsName': 'localhost',
+            'VpcId': 'vpc-local',
+            'SecurityGroups': [{'GroupId': 'sg-original', 'GroupName': 'original'}],
+            'BlockDeviceMappings': [{'DeviceName': '/dev/xvd' + chr(ord('a') + n), 'Ebs': {'VolumeId': 'vol-{}-{}'.format(Iid, n)}} for n in range(volumes)],
+            'Tags': [{'Key': k, 'Value': v} for k, v in (tags or {}).items()]}
+
+    def describe_instances(self, InstanceIds=None, Filters=None, **kwargs):
+        self._call()
+        found = []
+        for inst in self.instances.values():
+            if InstanceIds and inst['InstanceId'] not in InstanceIds:
+                continue
+            tags = {t['Key']: t['Value'] for t in inst['Tags']}
+            if any(f['Name'].startswith('tag:') and tags.get(f['Name'][4:]) not in f['Values'] for f in Filters or []):
+                continue
+            if any(f['Name'] == 'instance-state-name' and inst['State']['Name'] not in f['Values'] for f in Filters or []):
+                continue
+            found.append(inst)
+        return response(Reservations=[{'ReservationId': 'r-' + i['InstanceId'], 'Instances': [i]} for i in found])
+
+    def get_paginator(self, operation):
+        ec2 = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                yield getattr(ec2, operation)(**kwargs)
+        return Paginator()
+
+    def create_image(self, InstanceId, Name, **kwargs):
+        self._call()
+        image_id = 'ami-' + hashlib.md5(Name.encode()).hexdigest()[:17]
+        self.images[image_id] = {'ImageId': image_id, 'Name': Name, 'State': 'pending'}
+        return response(ImageId=image_id)
+
+    def _snapshot(self, VolumeId):
+        snapshot = {'SnapshotId': 'snap-' + hashlib.md5(VolumeId.encode()).hexdigest()[:17], 'VolumeId': VolumeId,
+                    'State': 'pending', 'Progress': '0%', 'StartTime': datetime.datetime.now(datetime.timezone.utc)}
+        self.snapshots[snapshot['SnapshotId']] = snapshot
+        return dict(snapshot)
+
+    def create_snapshot(self, VolumeId, **kwargs):
+        self._call()
+        return response(**self._snapshot(VolumeId))
+
+    def create_snapshots(self, InstanceSpecification, **kwargs):
+        # Every volume of the instance in one request
+        self._call()
+        volumes = self.instances[InstanceSpecification['InstanceId']]['BlockDeviceMappings']
+        return response(Snapshots=[self._snapshot(v['Ebs']['VolumeId']) for v in volumes])
+
+    def describe_snapshots(self, Filters=None, **kwargs):
+        # Snapshots and images are finished the first time they are described after being created
+        self._call()
+        ids = [v for f in Filters or [] if f['Name'] == 'snapshot-id' for v in f['Values']]
+        found = [self.snapshots[i] for i in ids if i in self.snapshots]
+        for s in found:
+            s.update(State='completed', Progress='100%')
+        return response(Snapshots=[dict(s) for s in found])
+
+    def describe_images(self, Filters=None, **kwargs):
+        self._call()
+        ids = [v for f in Filters or [] if f['Name'] == 'image-id' for v in f['Values']]
+        found = [self.images[i] for i in ids if i in self.images]
+        for i in found:
+            i['State'] = 'available'
+        return response(Images=[dict(i) for i in found])
+
+    def describe_security_groups(self, Filters=None, GroupIds=None, **kwargs):
+        self._call()
+        names = [v for f in Filters or [] if f['Name'] == 'group-name' for v in f['Values']]
+        vpcs = [v for f in Filters or [] if f['Name'] == 'vpc-id' for v in f['Values']]
+        groups = [{'GroupId': 'sg-' + n, 'GroupName': n, 'VpcId': 'vpc-local'} for n in names if not vpcs or 'vpc-local' in vpcs]
+        groups += [{'GroupId': g, 'GroupName': g[3:], 'VpcId': 'vpc-local'} for g in GroupIds or []]
+        return response(SecurityGroups=groups)
+
+    def modify_instance_attribute(self, InstanceId, Groups, **kwargs):
+        self._call()
+        self.instances[InstanceId]['SecurityGroups'] = [{'GroupId': g, 'GroupName': g[3:]} for g in Groups]
+        return response()
+
+    def create_tags(self, Resources, Tags, **kwargs):
+        self._call()
+        for r in Resources:
+            if r in self.instances:
+                self.instances[r]['Tags'] += Tags
+        return response()
+
+
+class LocalSFTPHandle(paramiko.SFTPHandle):
+
+    def __init__(self, host, flags=0):
+        super().__init__(flags)
+        self.host = host
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def read(self, offset, length):
+        data = super().read(offset, length)
+        if isinstance(data, bytes):
+            self.host.counters.add('sftp_bytes_read', len(data))
+        return data
+
+    def write(self, offset, data):
+        self.host.counters.add('sftp_bytes_written', len(data))
+        return super().write(offset, data)
+
+
+class LocalSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP over the local file system, paths are taken as they are"""
+
+    def __init__(self, server, host, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.host = host
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+            if flags & os.O_WRONLY:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                mode = 'rb'
+            f = os.fdopen(fd, mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = LocalSFTPHandle(self.host, flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, f)), f) for f in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class LocalSSHInterface(paramiko.ServerInterface):
+
+    def __init__(self, host):
+        self.host = host
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.host.run_command, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+logging.getLogger('benchmark.localhost').setLevel(logging.CRITICAL)
+
+
+class LocalHost:
+    """
+    Victim host stand-in: SSH/SFTP server on 127.0.0.1 that runs commands on this machine.
+    sudo is dropped, and collectLocalForensics.py gets --memory-image, so no kernel module is loaded.
+    Every collector run is recorded in self.collector_runs (seconds, exit status, peak RSS).
+    """
+
+    def __init__(self, counters, memory_image=None):
+        self.counters = counters
+        self.memory_image = memory_image
+        self.collector_runs = []
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, addr = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.set_log_channel('benchmark.localhost')  # Clients closing their connections is not an error here
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTPServer, self)
+            transport.start_server(server=LocalSSHInterface(self))
+
+    def close(self):
+        self.sock.close()
+
+    @staticmethod
+    def is_collector(command):
+        # The collector itself, not a command about it (pkill of an earlier collector)
+        return 'python3 -u collectLocalForensics.py' in command
+
+    def rewrite_command(self, command):
+        command = command.replace('sudo ', '')
+        if self.is_collector(command) and self.memory_image:
+            command += ' --memory-image ' + self.memory_image
+        return command
+
+    def run_command(self, channel, command):
+        command = self.rewrite_command(command)
+        start = time.time()
+        # Own session, as sshd does: the command is the leader of its process group
+        proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+
+        def pump_stderr():
+            for data in iter(lambda: proc.stderr.read1(65536), b''):
+                channel.sendall_stderr(data)
+        stderr_thread = threading.Thread(target=pump_stderr, daemon=True)
+        stderr_thread.start()
+        for data in iter(lambda: proc.stdout.read1(1048576), b''):
+            self.counters.add('ssh_bytes_stdout', len(data))
+            channel.sendall(data)
+        stderr_thread.join()
+        # wait4 gives the resources used by this command only (peak RSS in KB on Linux)
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+        if self.is_collector(command):
+            self.collector_runs.append({'command': command, 'seconds': round(time.time() - start, 3),
+                                        'exit_status': proc.returncode, 'maxrss_kb': rusage.ru_maxrss})
+        channel.send_exit_status(proc.returncode if proc.returncode >= 0 else 128 - proc.returncode)  # Killed by a signal, as a shell reports it
+        channel.close()
@@ -2,9 +2,24 @@ import time
 import argparse
 import boto3
 import botocore.config
-import os, shutil
+from botocore.exceptions import ClientError
+import os, sys, shutil
 import json
 import paramiko
+import hashlib, collections
+import subprocess, fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+# Code shared with the lambdas, in the lambda directory of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lambda'))
+import forensicsCommon
+from forensicsCommon import (cached_s3_file, evict_cache, measure, emit_metric, artifact_metric, forward_collection_metrics,
+                             preserve_status, security_group_ids, ec2_containment, run_remote, stream_memory_dump, sftp_to_s3,
+                             read_archive_index, upload_individual, upload_deduplicated, stream_collection, remove_remote_sources,
+                             ArchiveVerifier, write_custody_record, lime_module_cache_key, quarantine_lime_module,
+                             publish_lime_module, promote_lime_module, push_collection_state, save_collection_state,
+                             RunJournal, remote_file_size, s3_part_size, s3_upload_workers, remote_kill_grace, remote_timeouts, artifact_event_prefix)
 
 # Get script configuration parameters form S3 file. 
 # TODO If SSM is used, replace S3 conf for SSM parameters.
@@ -20,7 +35,12 @@ S3_conf_params = 'forensics/config/containmentAndForensicsEC2_conf.json'
 #    "EC2_key": "forensics/config/EC2-key.pem",
 #    "ec2_local_user": "ec2-user",
 #    "isolation_security_groups": ["sg-09e9773906990d7bc","sg-adb43d7ebc40c2609"],
-#    "region": "sa-east-1"
+#    "forensics_access_security_group": "forensics_access",
+#    "region": "sa-east-1",
+#    "S3_lime_cache_path": "forensics/resources/lime/",
+#    "S3_blobs_path": "forensics/evidence/blobs/",
+#    "custody_key": "forensics/config/custody.key",
+#    "codecs": ["memory=zstd:1", "FILE=gzip:6", "COMMAND=gzip:6"]
 #}
 
 # Conf params to get from S3_conf_params (or SSM)
@@ -30,7 +50,12 @@ S3_resources = None
 S3_evidence_path = None
 EC2_key = None
 ec2_local_user = None
+S3_blobs_path = None  # Content-addressed evidence store for --S3-data-format deduplicated
+S3_custody_key = None  # HMAC-SHA256 secret custody records are signed with (in the conf bucket). Records are not signed without it
+codecs = []  # Compression of archive members per artifact type, [TYPE=]CODEC[:LEVEL] (see collectLocalForensics.py --codec)
+S3_lime_cache_path = None  # Prebuilt LiME modules, stored as <S3_lime_cache_path><kernel release>/lime-<kernel release>.ko
 isolation_security_groups = None  # To drop established connections: apply First SG (inbound/outbound 0.0.0.0/0), wait, apply Second SG (restricted)
+forensics_access_security_group = None  # --containment-first: SG added to the isolation SG during the collection, only allows ssh from the forensics side
 region = None
 
 # Global variables
@@ -38,7 +63,12 @@ ec2_client = boto3.client('ec2', region_name=region)
 #ec2_resource = boto3.resource('ec2', region_name=region)
 s3_client = boto3.client('s3', region_name=region, config=botocore.config.Config(s3={'addressing_style':'path'}))
 
-local_tmp = '/tmp/{}/'.format(int(time.time()))
+# Local cache of S3 config, resources and key, kept between runs
+cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'containmentAndForensicsEC2', '')
+
+collection_time_share = 0.6  # Share of the --deadline time left given to the collection when no time budget is set (the rest is for the upload)
+metrics_file = None  # JSON lines file where metrics are appended (--metrics-file)
+decompress_commands = {'gzip': ['gzip', '-dc'], 'zstd': ['zstd', '-dc'], 'lz4': ['lz4', '-dc']}  # Archive member codecs, to retrieve artifacts
 
 
 print("""
@@ -66,12 +96,18 @@ def get_config_params():
     global S3_evidence_path
     global ec2_local_user
     global isolation_security_groups
+    global forensics_access_security_group
     global EC2_key
     global region
+    global S3_lime_cache_path
+    global S3_blobs_path
+    global S3_custody_key
+    global codecs
     print('Getting configuration parameters from S3: {}/{}\n'.format(S3_conf_bucket, S3_conf_params))
     try:
-        confS3 = s3_client.get_object(Bucket= S3_conf_bucket, Key=S3_conf_params)
-        conf = json.loads(confS3['Body'].read().decode("utf-8")) 
+        evict_cache()
+        with open(cached_s3_file(S3_conf_bucket, S3_conf_params)) as f:
+            conf = json.load(f)
 
         working_path = conf['working_path']
         S3_bucket = conf['S3_bucket']
@@ -79,100 +115,119 @@ def get_config_params():
         S3_evidence_path= conf['S3_evidence_path']
         ec2_local_user = conf['ec2_local_user']
         isolation_security_groups = conf['isolation_security_groups']
+        forensics_access_security_group = conf.get('forensics_access_security_group')
         region = conf['region']
+        codecs = conf.get('codecs', [])
+        S3_blobs_path = conf.get('S3_blobs_path', S3_evidence_path + 'blobs/')
+        S3_custody_key = conf.get('custody_key')
+        S3_lime_cache_path = conf.get('S3_lime_cache_path', 'forensics/resources/lime/')
 
-        # Put .pem ec2 key to local temp
-        EC2_key = local_tmp + os.path.basename(conf['EC2_key'])
-        s3_client.download_file(S3_conf_bucket, conf['EC2_key'], EC2_key)
-        # Change pem permissions to 0600
-        os.chmod(EC2_key, 0o600)
+        # .pem ec2 key in the local cache (0600, wiped on eviction)
+        EC2_key = cached_s3_file(S3_conf_bucket, conf['EC2_key'], secret=True)
 
     except Exception as e:
         #TODO: Better error msg
         print('[ERROR] {}'.format(str(e)))
 
 
-def get_instance_data(Iid):
-    res = False
-    print('Getting Instance {} data...'.format(Iid))
+def configure_common():
+    # forensicsCommon works with the configuration of this script
+    forensicsCommon.configure(s3_client=s3_client, ec2_client=ec2_client, working_path=working_path, S3_bucket=S3_bucket,
+                              S3_evidence_path=S3_evidence_path, S3_blobs_path=S3_blobs_path, S3_custody_bucket=S3_conf_bucket,
+                              S3_custody_key=S3_custody_key, S3_lime_cache_path=S3_lime_cache_path,
+                              isolation_security_groups=isolation_security_groups, cache_path=cache_path,
+                              metrics_file=metrics_file, metrics_output=False)
+
+
+def save_instance_data(Iid, res):
+    pd = res['Reservations'][0]['Instances'][0]
+    print('[OK] Instance {} found:\n     ImageId: {}\n     InstanceType: {}\n     LaunchTime: {}\n     AZ: {}\n     PrivateIP: {}\n     PublicIP: {}\n'.format(Iid, pd['ImageId'], pd['InstanceType'], str(pd['LaunchTime']), pd['Placement']['AvailabilityZone'], pd.get('PrivateIpAddress'), pd.get('PublicIpAddress')))
+    # Upload instance data to S3:
+    instance_data_filename = '{}instance_data_{}_{}.json'.format(S3_evidence_path, Iid, time.strftime('%Y%m%d_%H%M'))
+    s3_client.put_object(Body= json.dumps(res, default=str).encode('utf-8'), Bucket= S3_bucket, Key=instance_data_filename)
+    print('This data was uploaded to {}\n'.format(instance_data_filename))
+
+
+def get_fleet_data(Iids=None, filters=None):
+    """
+    Resolve instance ids and/or filters (tags, ASG) with one batched describe_instances.
+    Filters only take running instances: stopped or terminated ones can not be collected from.
+    Returns {instance_id: describe_instances response of that single instance}.
+    """
+    fleet = {}
+    print('Getting Instances data... ids: {} filters: {}'.format(Iids, filters))
     try:
-        res = ec2_client.describe_instances(InstanceIds=[Iid])
-        if res['ResponseMetadata']['HTTPStatusCode'] == 200:
-            pd = res['Reservations'][0]['Instances'][0]
-            print('[OK] Instance found:\n     ImageId: {}\n     InstanceType: {}\n     LaunchTime: {}\n     AZ: {}\n     PrivateIP: {}\n     PublicIP: {}\n'.format(pd['ImageId'], pd['InstanceType'], str(pd['LaunchTime']), pd['Placement']['AvailabilityZone'], pd['PrivateIpAddress'], pd['PublicIpAddress']))
-            # Upload instance data to S3:
-            instance_data_filename = '{}instance_data_{}_{}.json'.format(S3_evidence_path, Iid, time.strftime('%Y%m%d_%H%M'))
-            s3_client.put_object(Body= json.dumps(res, default=str).encode('utf-8'), Bucket= S3_bucket, Key=instance_data_filename)
-            print('This data was uploaded to {}\n'.format(instance_data_filename))
-        else:
-            print('[ERROR] {}'.format(str(res)))
+        kwargs = {}
+        if Iids:
+            kwargs['InstanceIds'] = Iids
+        if filters:
+            kwargs['Filters'] = filters + [{'Name': 'instance-state-name', 'Values': ['running']}]
+            print('Only running instances matching the filters are taken.')
+        for res in ec2_client.get_paginator('describe_instances').paginate(**kwargs):
+            if res['ResponseMetadata']['HTTPStatusCode'] != 200:
+                print('[ERROR] {}'.format(str(res)))
+                continue
+            for reservation in res['Reservations']:
+                for inst in reservation['Instances']:
+                    # Same shape as a describe_instances of only this instance
+                    inst_res = {'Reservations': [dict(reservation, Instances=[inst])], 'ResponseMetadata': res['ResponseMetadata']}
+                    fleet[inst['InstanceId']] = inst_res
+                    save_instance_data(inst['InstanceId'], inst_res)
     except Exception as e:
         #TODO: Better error msg
         print('[ERROR] {}'.format(str(e)))
 
-    return res
+    return fleet
 
 
-def preserve_status(Iid, do_ami_snapshot, volumes):
-    if do_ami_snapshot:
-        # Create AMI of running Instance this process creates also EBS snapshot
-        print('Creating AMI from instance id: {}...'.format(Iid))
-        try:
-            res = ec2_client.create_image(InstanceId=Iid, NoReboot=True, Name="ami_preserved_from_"+Iid)
-            #print(res)
-            if res['ResponseMetadata']['HTTPStatusCode'] == 200:
-                print('[OK] AMI created {}\n'.format(res['ImageId']))
-            else:
-                print('[ERROR] {}\n'.format(str(res)))
-        except:
-            #TODO: Better error msg
-            print('[ERROR]\n')
-    else:
-        # Only take EBS Snapshot
-        print('Creating EBS snapshots...')
-        for vol in volumes:   
-            print('> Creating snapshot of volume: {}'.format(vol['Ebs']['VolumeId']))
-            try:
-                res = ec2_client.create_snapshot(VolumeId=vol['Ebs']['VolumeId'], Description="vol_snapshot_from_"+Iid)
-                if res['ResponseMetadata']['HTTPStatusCode'] == 200:
-                    print('[OK] EBS snapshot created {}\n'.format(res['SnapshotId']))
-                else:
-                    print('[ERROR] {}\n'.format(str(res)))
-            except:
-                #TODO: Better error msg
-                print('[ERROR]\n')
-            
-
-def ec2_containment(Iid):
-    # Remove original SGs and set very restrictive containment SG
-    print('\nContainment - Removing SGs...')
+def close_forensics_access(Iid, vpc_id=None):
+    # Containment-first mode: once the collection is done, only the isolation SG is left
+    print('\nClosing forensics access - Removing SG {}...'.format(forensics_access_security_group))
     try:
-        sg_id = ec2_client.describe_security_groups(Filters=[ {'Name': 'group-name', 'Values': [isolation_security_groups[0]]} ])['SecurityGroups'][0]['GroupId']
-        print('-> Attaching SG {} - {} (first step: change all connections to untracked)'.format(isolation_security_groups[0], sg_id))
-        res = ec2_client.modify_instance_attribute(InstanceId=Iid, Groups=[sg_id])
-        time.sleep(2)   # just wait 2 seconds...
-        sg_id = ec2_client.describe_security_groups(Filters=[ {'Name': 'group-name', 'Values': [isolation_security_groups[1]]} ])['SecurityGroups'][0]['GroupId']
-        print('-> Attaching SG {} - {} (second step: dropping all connections with isolation SG)'.format(isolation_security_groups[1], sg_id))
-        res = ec2_client.modify_instance_attribute(InstanceId=Iid, Groups=[sg_id])
+        res = ec2_client.modify_instance_attribute(InstanceId=Iid, Groups=security_group_ids([isolation_security_groups[1]], vpc_id))
         if res['ResponseMetadata']['HTTPStatusCode'] == 200:
-            print('[OK] SGs removed\n')
-        else:
-            print('[ERROR] {}\n'.format(str(res)))
+            print('[OK] Forensics access closed\n')
+            return True
+        print('[ERROR] {}\n'.format(str(res)))
     except Exception as e:
         #TODO: Better error msg
         print('[ERROR] {}'.format(str(e)))
+    return False
 
-    # Tag as quarantined
-    print('Tagging instance id {} as Security_status: quarantined'.format(Iid))
+
+def ssh_connect(ssh_client, inst, ssh_public_ip, key):
+    if ssh_public_ip:
+        print('Connecting to {} (PublicIP: {})'.format(inst['PublicDnsName'], inst['PublicIpAddress']))
+        ssh_client.connect(hostname=inst['PublicIpAddress'], username=ec2_local_user, pkey=key)
+    else:
+        print('Connecting to {} (PrivateIP: {})'.format(inst['PrivateDnsName'], inst['PrivateIpAddress']))
+        ssh_client.connect(hostname=inst['PrivateIpAddress'], username=ec2_local_user, pkey=key)
+
+
+def lime_module_precheck(Iid, inst_data, params):
+    """
+    Containment-first: the LiME module cache is checked for the instance kernel before the isolation.
+    On a miss the module would be built on the isolated instance, which can not reach the package
+    repositories nor github, so the memory dump of that instance is skipped.
+    Returns True when the memory dump can be done.
+    """
+    inst = inst_data['Reservations'][0]['Instances'][0]
+    if not inst['State']['Name'] == 'running':
+        return True  # No collection at all, forensics reports it
+    ssh_client = paramiko.SSHClient()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     try:
-        res = ec2_client.create_tags(Resources=[Iid], Tags=[ { 'Key': 'Security_status', 'Value': 'quarantined' }])
-        if res['ResponseMetadata']['HTTPStatusCode'] == 200:
-            print('[OK] instance tagged\n')
-        else:
-            print('[ERROR] {}\n'.format(str(res)))
+        ssh_connect(ssh_client, inst, params['ssh_public_ip'], paramiko.RSAKey.from_private_key_file(EC2_key))
+        lime_module_sha256 = lime_module_cache_key(ssh_client)[1]
     except Exception as e:
-        #TODO: Better error msg
-        print('[ERROR] {}'.format(str(e)))
+        print('[ERROR] {}: the LiME module cache can not be checked before the isolation ({}), the memory dump is skipped.'.format(Iid, str(e)))
+        return False
+    finally:
+        ssh_client.close()
+    if not lime_module_sha256:
+        print('[ERROR] {}: no prebuilt LiME module for the instance kernel, and it can not be built once the instance is isolated. '
+              'The memory dump is skipped. Publish or promote a module for this kernel to dump the memory in containment-first mode.'.format(Iid))
+    return bool(lime_module_sha256)
 
 
 def forensics(tasks, i_data):
@@ -186,83 +241,477 @@ def forensics(tasks, i_data):
         print('[ERROR] EC2 instance not running. Cannot do forensics local tasks.')
         return False
 
+    # Remote commands are aborted on the instance when they run past this (no limit if None)
+    deadline = time.time() + tasks['deadline'] if tasks['deadline'] else None
+
+    # Progress of the run in S3, an attempt with the same run id goes on from where the last one stopped
+    journal = RunJournal(tasks['run_id'], tasks['instance_id'])
+    run = journal.step('run')
+    if run.get('done'):
+        print('Run {} already finished on {}, nothing to do.'.format(tasks['run_id'], tasks['instance_id']))
+        return True
+    if not run:
+        # Evidence names are kept by every attempt of the run
+        stamp = time.strftime('%Y%m%d_%H%M')
+        run = {'archive': 'forensics_complete_{}_{}.tar'.format(tasks['instance_id'], stamp),
+               'memory_dump': 'memory_dump_{}_{}.mem.gz'.format(tasks['instance_id'], stamp)}
+        journal.update('run', **run)
+    packed_evidence_filename = run['archive']
+
     # Copy resource files from S3 to EC2 
     try:
-        if tasks['ssh_public_ip']:
-            print('Connecting to {} (PublicIP: {})'.format(inst['PublicDnsName'], inst['PublicIpAddress']))
-            ssh_client.connect(hostname=inst['PublicIpAddress'], username=ec2_local_user, pkey=key)
-        else:
-            print('Connecting to {} (PrivateIP: {})'.format(inst['PrivateDnsName'], inst['PrivateIpAddress']))
-            ssh_client.connect(hostname=inst['PrivateIpAddress'], username=ec2_local_user, pkey=key)
+        ssh_connect(ssh_client, inst, tasks['ssh_public_ip'], key)
 
         # Create remote working tmp dirs
         cmd = 'mkdir -p ' + working_path
-        stdin, stdout, stderr = ssh_client.exec_command(cmd)
-        #print('stdout {}: {}'.format(cmd, stdout.read()))
-        if len(stderr.read()): 
-            raise Exception ('Failed tu execute: {}. stderr: {}'.format(cmd,sdterr.read()))
+        if run_remote(ssh_client, cmd, remote_timeouts['command'], deadline, tasks['instance_id']) != 0:
+            raise Exception ('Failed to execute: {}'.format(cmd))
+
+        # Prebuilt LiME module for the instance kernel goes with the other resources
+        lime_module_key, lime_module_sha256 = lime_module_cache_key(ssh_client, deadline) if tasks['memory_dump'] else (None, None)
 
         # Retrieve resources from S3 and send to EC2
         ftp_client=ssh_client.open_sftp()
-        for r in S3_resources:
-            loc_tmp = local_tmp + os.path.basename(r)
-            print('Retrieving from S3: {} to {}'.format(str(r), loc_tmp))
-            s3_client.download_file(S3_bucket, r, loc_tmp)
-
-            print('Sending: {} to EC2: {}'.format(loc_tmp, working_path+os.path.basename(r)))
-            ftp_client.put(loc_tmp, working_path+os.path.basename(r))
+        with measure('push', tasks['instance_id']) as metric:
+            # Resources still on the instance since an earlier attempt, and not changed in S3 since, are not sent again
+            pushed = journal.step('push').get('files', {})
+            for r in S3_resources + ([lime_module_key] if lime_module_sha256 else []):
+                local_copy = cached_s3_file(S3_bucket, r)
+                remote_copy = working_path+os.path.basename(r)
+                with open(local_copy, 'rb') as f:
+                    sha256 = hashlib.sha256(f.read()).hexdigest()
+                if r == lime_module_key and sha256 != lime_module_sha256:
+                    raise Exception('Cached LiME module {} does not match its recorded sha256, it is not sent to the instance'.format(r))
+                if remote_copy in pushed and pushed[remote_copy]['sha256'] == sha256 and remote_file_size(ftp_client, remote_copy) == pushed[remote_copy]['size']:
+                    print('Already on EC2: {}'.format(remote_copy))
+                    continue
+                print('Sending: {} to EC2: {}'.format(local_copy, remote_copy))
+                pushed[remote_copy] = {'size': ftp_client.put(local_copy, remote_copy).st_size, 'sha256': sha256}
+                metric['bytes'] += pushed[remote_copy]['size']
+            journal.update('push', done=True, files=pushed)
+
+        # Incremental collection state of this instance, kept in S3 between runs
+        collection_state_key = '{}collection_state_{}.json'.format(S3_evidence_path, tasks['instance_id'])
+        if tasks['incremental']:
+            push_collection_state(ftp_client, collection_state_key)
 
     except Exception as e:
         print('[ERROR] '+ str(e))
         return False
 
     
+    ok = True
+    # Diskless memory dump, streamed through the SSH channel straight to S3
+    stream_memory = tasks['memory_dump'] and tasks['memory_dump_stream'] and tasks['send_to_s3']
+    if stream_memory and journal.done('memory_stream'):
+        print('Memory dump already streamed to S3 by an earlier attempt: {}'.format(S3_evidence_path + run['memory_dump']))
+    elif stream_memory:
+        with measure('memory_stream', tasks['instance_id']) as metric:
+            report = stream_memory_dump(ssh_client, run['memory_dump'], deadline, tasks['instance_id'], journal)
+            metric.update(ok=bool(report), bytes=report['bytes'] if report else 0)
+        if metric['ok']:
+            journal.update('memory_stream', done=True)
+        ok = metric['ok']
+
+    # Evidence streamed by the collector and uploaded while it runs, nothing staged on the instance
+    stream_evidence = tasks['stream_evidence'] and tasks['send_to_s3']
+    if stream_evidence and tasks['s3_data_format'] != 'individual':
+        print('[WARNING] Streamed evidence is stored as individual objects, not {}.'.format(tasks['s3_data_format']))
+
     # RUN Forensic taks on remote server!
     print('\nRunning forensic tasks!...')
-    packed_evidence_filename = 'forensics_complete_{}_{}.tar.gz'.format(tasks['instance_id'], time.strftime('%Y%m%d_%H%M'))
+    # Collection started by an earlier attempt: its collector is stopped if it is still running,
+    # and the new one goes on with its archive (artifacts and memory dump already in it are kept)
+    collection = journal.step('collection')
+    if collection.get('pid') and not collection.get('done'):
+        run_remote(ssh_client, "sh -c 'sudo pkill -TERM -g {} -f collectLocalForensics.py; sleep {}'".format(collection['pid'], remote_kill_grace),
+                   remote_timeouts['command'], deadline, tasks['instance_id'])
     # TODO remove hardcoded collectLocalForensics.py
-    cmd = 'cd {}; sudo python3 collectLocalForensics.py {} {} {}'.format(
-                                                working_path,
-                                                '' if tasks['memory_dump'] else '--no-memory-dump',
+    # Collection budgets. With a deadline, the time budget defaults to a share of the time left
+    time_budget = tasks['time_budget'] or (int((deadline - time.time()) * collection_time_share) if deadline else 0)
+    cmd = 'sudo python3 -u collectLocalForensics.py {} {} {} {} {} {}{}'.format(
+                                                '' if tasks['memory_dump'] and not stream_memory else '--no-memory-dump',
                                                 '--conserve-local-forensics',
-                                                '--output-filename ' + packed_evidence_filename)
-    print("> I'm going to execute:\n  # {}".format(cmd))
-    # TODO try except
-    stdin, stdout, stderr = ssh_client.exec_command(cmd)
-    #print('stdout {}: {}'.format(cmds, stdout.read()))
-    if len(stderr.read()): 
-        print('Failed to execute: {}. stderr: {}'.format(cmd, stderr.read()))
-
-
-    if tasks['send_to_s3']:
-        # Get forensics_complete.tar.gz file from remote server
-        print('\nGetting from EC2: {}'.format(working_path+packed_evidence_filename))
-        # TODO try except
-        ftp_client.get(working_path+packed_evidence_filename, local_tmp+packed_evidence_filename)
-
-        if tasks['s3_data_format'] == 'packed':
-            # Send packed file to S3
-            print('Uploading evidence file: {} to S3: {}'.format(local_tmp+packed_evidence_filename, S3_evidence_path))
-            s3_client.upload_file(local_tmp+packed_evidence_filename, S3_bucket, S3_evidence_path+packed_evidence_filename)
+                                                '--incremental' if tasks['incremental'] else '',
+                                                ' '.join('--codec ' + c for c in tasks['codecs']),
+                                                ' '.join('--{} {}'.format(k, v) for k, v in (('size-budget', tasks['size_budget']), ('time-budget', max(1, time_budget) if time_budget else 0)) if v),
+                                                '--output-filename ' + packed_evidence_filename,
+                                                ' --stream-output' if stream_evidence else ' --resume' if collection else '')
+    # Collector output is followed line by line, every artifact is reported (and recorded in the journal) as soon as it is collected
+    collected = collection.get('artifacts', [])
+    emitted = set(collected)
+
+    def on_collector_line(stream, line):
+        # Messages of other collector workers can come right before the artifact line
+        before, event, after = line.partition(artifact_event_prefix)
+        if event:
+            if before:
+                print('  [{}] {}'.format(tasks['instance_id'], before))
+            a = json.loads(after)
+            emitted.add(a['output'])
+            collected.append(a['output'])
+            journal.note('collection', artifacts=collected)
+            emit_metric(artifact_metric(a, tasks['instance_id']))
+            print('  [{}] collected {} {} in {:.2f}s ({} bytes)'.format(tasks['instance_id'], a['status'], a['name'], a['seconds'], a.get('bytes', 0)))
         else:
-            # untar packed and send individual files to S3
-            # TODO
-            pass
+            print('  [{}] {}'.format(tasks['instance_id'], line))
+
+    if collection.get('done'):
+        print('Collection already finished by an earlier attempt: {}'.format(working_path+packed_evidence_filename))
+        exit_status = 0
+    elif stream_evidence:
+        # A streamed collection is not resumed, an earlier attempt that didn't finish is done again from the start
+        prefix = S3_evidence_path + os.path.splitext(packed_evidence_filename)[0] + '/'
+        print("> I'm going to execute:\n  # {}".format(cmd))
+        print('Streaming evidence to S3: {}'.format(prefix))
+        with measure('collection', tasks['instance_id'], streamed=True) as metric:
+            exit_status, index, manifest = stream_collection(ssh_client, cmd, prefix, prefix+'manifest.json', deadline, tasks['instance_id'], on_collector_line,
+                                                             on_pid=lambda pid: journal.update('collection', pid=pid))
+            if manifest:
+                # Signed chain of custody record next to the evidence
+                record = write_custody_record(index, {m['name']: m['uploaded_sha256'] for m in manifest['members']},
+                                              S3_evidence_path+packed_evidence_filename+'.custody.json', tasks['instance_id'], 'individual')
+                metric.update(ok=record['verified'], signed=bool(record['signature']), remote_seconds=manifest['collection_seconds'],
+                              bytes=sum(m['size'] for m in manifest['members']))
+            else:
+                metric['ok'] = False
+                print('[ERROR] Streamed collection {}: {}'.format('aborted' if exit_status is None else 'exited with status {}'.format(exit_status), cmd))
+            # Done only once its evidence is all in S3
+            journal.update('collection', done=metric['ok'], exit_status=exit_status, artifacts=collected,
+                           sources_to_remove=index.get('sources_to_remove', []) if metric['ok'] else [])
+            if not metric['ok']:
+                ok = False
+    else:
+        print("> I'm going to execute:\n  # {}".format(cmd))
+        with measure('collection', tasks['instance_id']) as metric:
+            exit_status = run_remote(ssh_client, cmd, remote_timeouts['collection'], deadline, tasks['instance_id'], on_collector_line, working_path,
+                                     on_pid=lambda pid: journal.update('collection', pid=pid))
+            journal.update('collection', done=exit_status == 0, exit_status=exit_status, artifacts=collected)
+            if exit_status != 0:
+                ok = metric['ok'] = False
+                print('[ERROR] Collection {}: {}'.format('aborted' if exit_status is None else 'exited with status {}'.format(exit_status), cmd))
+            # Timings measured by the collector itself, per artifact (the ones not followed live)
+            summary = forward_collection_metrics(ftp_client, working_path+packed_evidence_filename, tasks['instance_id'], emitted) if exit_status is not None else None
+            if summary:
+                metric.update(remote_seconds=summary['elapsed_seconds'], bytes=sum(a.get('bytes', 0) for a in summary['artifacts']), cut=len(summary.get('cut', [])))
+                # What the collection budgets left out, recorded in collection_summary.json
+                for c in summary.get('cut', []):
+                    print('[WARNING] {} {} {} ({}): {} bytes kept'.format(c['status'], c['name'], c['target'], c['cut']['reason'], c['cut']['collected_bytes']))
+
+    # Files the streamed collection left on the instance are removed now that their evidence is in S3
+    collection = journal.step('collection')
+    if collection.get('sources_to_remove') and collection.get('done') and not collection.get('sources_removed'):
+        if remove_remote_sources(ssh_client, collection['sources_to_remove'], deadline, tasks['instance_id']):
+            journal.update('collection', sources_removed=True)
+
+    if tasks['incremental']:
+        save_collection_state(ftp_client, collection_state_key)
+
+    # LiME module built on this run is only kept in quarantine, it never goes to the cache
+    if tasks['memory_dump'] and not lime_module_sha256:
+        quarantine_lime_module(ftp_client, lime_module_key, tasks['instance_id'])
+
+
+    # An aborted collection left no complete archive to upload, a streamed one is already uploaded
+    if tasks['send_to_s3'] and exit_status is not None and not stream_evidence:
+        with measure('upload', tasks['instance_id'], s3_data_format=tasks['s3_data_format']) as metric:
+            # Hashes computed by the collector, checked against what is uploaded
+            index = read_archive_index(ftp_client, working_path+packed_evidence_filename)
+            digests = {}
+            if not index:
+                metric['ok'] = False
+            elif tasks['s3_data_format'] == 'packed':
+                # Stream forensics_complete.tar file from remote server to S3
+                print('\nUploading evidence file from EC2: {} to S3: {}'.format(working_path+packed_evidence_filename, S3_evidence_path))
+                uploaded = journal.step('archive')
+                if uploaded.get('done'):
+                    print('Already uploaded by an earlier attempt: {}'.format(S3_evidence_path+packed_evidence_filename))
+                    report, digests = uploaded['report'], uploaded['digests']
+                else:
+                    verifier = ArchiveVerifier(index)
+                    report = sftp_to_s3(ftp_client, working_path+packed_evidence_filename, S3_evidence_path+packed_evidence_filename, on_data=verifier.update,
+                                        journal=journal, step='archive')
+                    # A resumed upload hashed the members on the instance instead of reading them all again
+                    digests = (report and report.get('member_sha256')) or verifier.hexdigests()
+                    if report:
+                        journal.update('archive', done=True, report={'bytes': report['bytes'], 'sha256': report['sha256']}, digests=digests)
+                # Index next to it, any artifact can be retrieved alone with ranged GETs (--retrieve)
+                index_report = report and sftp_to_s3(ftp_client, working_path+packed_evidence_filename+'.index.json', S3_evidence_path+packed_evidence_filename+'.index.json')
+                metric.update(ok=bool(index_report), bytes=report['bytes'] + index_report['bytes'] if index_report else 0)
+            elif tasks['s3_data_format'] == 'deduplicated':
+                # Only members whose content is not in the bucket yet are uploaded
+                print('\nUploading new evidence blobs from EC2: {} to S3: {}'.format(working_path+packed_evidence_filename, S3_blobs_path))
+                manifest = upload_deduplicated(ftp_client, working_path+packed_evidence_filename, S3_evidence_path+packed_evidence_filename+'.manifest.json', index, journal)
+                metric.update(ok=bool(manifest), bytes=manifest['uploaded_bytes'] if manifest else 0)
+                digests = {m['name']: m['uploaded_sha256'] for m in manifest['members'] if m['uploaded_sha256']} if manifest else {}
+            else:
+                # Every member of the archive as its own object, under a prefix named after the run
+                prefix = S3_evidence_path + os.path.splitext(packed_evidence_filename)[0] + '/'
+                print('\nUploading individual evidence files from EC2: {} to S3: {}'.format(working_path+packed_evidence_filename, prefix))
+                manifest = upload_individual(ftp_client, working_path+packed_evidence_filename, prefix, prefix+'manifest.json', index, journal)
+                metric.update(ok=bool(manifest), bytes=sum(m['size'] for m in manifest['members']) if manifest else 0)
+                digests = {m['name']: m['uploaded_sha256'] for m in manifest['members']} if manifest else {}
+            if metric['ok']:
+                # Signed chain of custody record next to the evidence
+                record = write_custody_record(index, digests, S3_evidence_path+packed_evidence_filename+'.custody.json', tasks['instance_id'], tasks['s3_data_format'])
+                metric.update(ok=record['verified'], signed=bool(record['signature']))
+            if not metric['ok']:
+                ok = False
+            journal.update('upload', done=metric['ok'])
+
+    # A run that didn't finish keeps its files on the instance, for the next attempt
+    if ok:
+        journal.update('run', done=True, finished_at=round(time.time(), 3))
+    else:
+        print('[ERROR] Run {} not finished on {}, start it again with the same run id to resume it.'.format(tasks['run_id'], tasks['instance_id']))
 
     # Cleaning
-    if not tasks['conserve_files']:
+    if not tasks['conserve_files'] and ok:
         # TODO instead of send rm, do it by collecLocalForensics.py arg
         # rm files on remote server
         print('Cleaning all the mess...')
         cmd = 'rm -rf {}'.format(working_path)
-        stdin, stdout, stderr = ssh_client.exec_command(cmd)
-        #print('stdout {}: {}'.format(cmds, stdout.read()))
-        if len(stderr.read()): 
-            print('Failed to execute {}. stderr: {}'.format(cmd, stderr.read()))
+        if run_remote(ssh_client, cmd, remote_timeouts['command'], label=tasks['instance_id']) != 0:
+            print('Failed to execute {}'.format(cmd))
 
 
     ftp_client.close()
     ssh_client.close()
+    return ok
+
+
+def run_phases(phases):
+    """
+    Phase scheduler. phases is a list of (name, function, [names it waits for]).
+    Every phase starts as soon as the phases it waits for are finished (whatever their outcome),
+    independent phases run at the same time.
+    Returns the timeline: {name: {'ok', 'start', 'end', 'seconds'}}, times relative to the scheduler start.
+    """
+    start = time.time()
+    names = [p[0] for p in phases]
+    for name, func, deps in phases:
+        if any(d not in names for d in deps):
+            raise ValueError('Phase {} waits for an unknown phase: {}'.format(name, deps))
+
+    def timed(name, func):
+        phase_start = time.time()
+        try:
+            ok = func() is not False
+        except Exception as e:
+            print('[ERROR] phase {}: {}'.format(name, str(e)))
+            ok = False
+        return {'ok': ok, 'start': round(phase_start - start, 2), 'end': round(time.time() - start, 2), 'seconds': round(time.time() - phase_start, 2)}
+
+    timeline = {}
+    pending = list(phases)
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(phases)) as executor:
+        while pending or running:
+            for phase in [p for p in pending if all(d in timeline for d in p[2])]:
+                pending.remove(phase)
+                running[executor.submit(timed, phase[0], phase[1])] = phase[0]
+            if not running:
+                raise ValueError('Phases with circular dependencies: {}'.format([p[0] for p in pending]))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                timeline[running.pop(f)] = f.result()
+    return timeline
+
+
+def print_timeline(Iid, timeline):
+    print('\nTimeline {}:'.format(Iid))
+    for name, t in sorted(timeline.items(), key=lambda i: i[1]['start']):
+        print('  {:<12} {:>8.2f}s -> {:>8.2f}s  {:>8.2f}s  {}'.format(name, t['start'], t['end'], t['seconds'], 'OK' if t['ok'] else 'ERROR'))
+
+
+def measured(phase, Iid, func, *args):
+    # Phase metric around func, failed when it returns False
+    with measure(phase, Iid) as metric:
+        metric['ok'] = func(*args) is not False
+    return metric['ok']
+
+
+class ContainmentBatches:
+    """
+    Containment of the fleet instances with as few ec2_containment calls as possible, so they share
+    its settle time between the isolation steps. Instances queued together are contained by one call
+    (one per vpc), and the ones queued while a call runs go together in the next one.
+    wait() blocks until the instances given are contained and returns {instance id: (ok, contained at)}.
+    """
+
+    def __init__(self, access_security_groups=()):
+        self.access_security_groups = list(access_security_groups)
+        self.condition = threading.Condition()
+        self.queue = {}  # Instance id -> vpc id, not taken by a call yet
+        self.results = {}  # Instance id -> Future of (ok, contained at)
+        self.running = False
+
+    def add(self, instances):
+        # instances: {instance id: vpc id}
+        with self.condition:
+            for Iid, vpc_id in instances.items():
+                self.queue[Iid] = vpc_id
+                self.results[Iid] = Future()
+
+    def wait(self, Iids):
+        with self.condition:
+            while self.running and any(Iid in self.queue for Iid in Iids):
+                self.condition.wait()
+            batch = {}
+            if any(Iid in self.queue for Iid in Iids):
+                # This thread contains everything queued, not only its own instances
+                batch, self.queue, self.running = self.queue, {}, True
+        if batch:
+            try:
+                by_vpc = collections.defaultdict(list)
+                for Iid, vpc_id in batch.items():
+                    by_vpc[vpc_id].append(Iid)
+                with ThreadPoolExecutor(max_workers=len(by_vpc)) as executor:
+                    list(executor.map(self.contain, by_vpc.items()))
+            finally:
+                with self.condition:
+                    self.running = False
+                    self.condition.notify_all()
+        return {Iid: self.results[Iid].result() for Iid in Iids}
+
+    def contain(self, vpc_instances):
+        vpc_id, Iids = vpc_instances
+        failures = {}
+        try:
+            ec2_containment(Iids, vpc_id, self.access_security_groups, failures=failures)
+        except Exception as e:
+            for Iid in Iids:
+                failures[Iid] = [str(e)]
+        contained_at = time.time()
+        for Iid in Iids:
+            self.results[Iid].set_result((Iid not in failures, contained_at))
+
+
+def respond_to_instance(params, Iid, inst_data, containment, response_start):
+    """
+    Run preserve_status, forensics and containment (ContainmentBatches) on one instance.
+    Snapshots and remote collection start together, containment only waits for the
+    remote collection (it cuts the ssh access).
+    Containment-first: the whole fleet was queued for containment at once, keeping the
+    forensics access SG, the collection runs on the isolated instance and the forensics
+    access is closed at the end.
+    Returns a result row with the timeline and the time to containment.
+    """
+    tasks = dict(params, instance_id=Iid, codecs=codecs)
+    start = time.time()
+    vpc_id = inst_data['Reservations'][0]['Instances'][0].get('VpcId')
+    contained = {}
+
+    def contain():
+        if not params['containment_first']:
+            containment.add({Iid: vpc_id})
+        contained['ok'], contained['at'] = containment.wait([Iid])[Iid]
+        return contained['ok']
+
+    preserve = lambda: measured('preserve', Iid, preserve_status, Iid, params['ami_snapshot'], inst_data['Reservations'][0]['Instances'][0]['BlockDeviceMappings'], params['multi_volume_snapshot'])
+    if params['containment_first']:
+        timeline = run_phases([
+            ('containment', lambda: measured('containment', Iid, contain), []),
+            ('preserve', preserve, []),
+            ('forensics', lambda: measured('forensics', Iid, forensics, tasks, inst_data), ['containment']),
+            ('close_access', lambda: measured('close_access', Iid, close_forensics_access, Iid, vpc_id), ['forensics'])])
+    else:
+        timeline = run_phases([
+            ('preserve', preserve, []),
+            ('forensics', lambda: measured('forensics', Iid, forensics, tasks, inst_data), []),
+            ('containment', lambda: measured('containment', Iid, contain), ['forensics'])])
+    # From the start of the response to the isolation SG in place
+    time_to_containment = round(contained.get('at', time.time()) - response_start, 2)
+    emit_metric({'phase': 'time_to_containment', 'instance_id': Iid, 'ok': timeline['containment']['ok'], 'bytes': 0, 'seconds': time_to_containment})
+    print_timeline(Iid, timeline)
+    print('  Time to containment: {:.2f}s'.format(time_to_containment))
+    return dict(timeline, instance_id=Iid, seconds=round(time.time() - start, 2), time_to_containment=time_to_containment)
+
+
+def print_fleet_results(results):
+    print('\n{:<22} {:<16} {:<16} {:<16} {:<10} {}'.format('Instance', 'Preserve', 'Forensics', 'Containment', 'Total', 'Time to containment'))
+    for r in results:
+        cells = ['{:<5} {:>8.2f}s'.format('OK' if r[n]['ok'] else 'ERROR', r[n]['seconds']) for n in ('preserve', 'forensics', 'containment')]
+        print('{:<22} {:<16} {:<16} {:<16} {:<10} {:.2f}s'.format(r['instance_id'], cells[0], cells[1], cells[2], '{:.2f}s'.format(r['seconds']), r['time_to_containment']))
+
+
+def read_s3_range(key, start, end):
+    return s3_client.get_object(Bucket=S3_bucket, Key=key, Range='bytes={}-{}'.format(start, end - 1))['Body'].read()
+
+
+def s3_ranged_copy(key, start, size, out):
+    """
+    Write size bytes of an S3 object from start to out (binary file object) with ranged GETs of
+    s3_part_size, fetched in parallel and written in order (no more than 2 * workers parts in memory).
+    """
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=s3_upload_workers) as executor:
+        for offset in range(start, start + size, s3_part_size):
+            pending.append(executor.submit(read_s3_range, key, offset, min(offset + s3_part_size, start + size)))
+            while pending and (pending[0].done() or len(pending) > s3_upload_workers * 2):
+                out.write(pending.popleft().result())
+        while pending:
+            out.write(pending.popleft().result())
+
+
+def retrieve_member(archive_key, member, path):
+    # Only the member byte range is downloaded, decompressed with the tool of its codec and checked against the index hash
+    codec = member['codec'].split(':')[0]
+    with open(path, 'wb') as out:
+        if codec == 'none':
+            s3_ranged_copy(archive_key, member['data_offset'], member['size'], out)
+        else:
+            proc = subprocess.Popen(decompress_commands[codec], stdin=subprocess.PIPE, stdout=out)
+            try:
+                s3_ranged_copy(archive_key, member['data_offset'], member['size'], proc.stdin)
+            finally:
+                proc.stdin.close()
+            if proc.wait() != 0:
+                raise Exception('{} exited with status {}'.format(' '.join(decompress_commands[codec]), proc.returncode))
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            sha256.update(chunk)
+    if sha256.hexdigest() != member['sha256']:
+        raise Exception('sha256 of {} does not match the archive index'.format(path))
+
+
+def retrieve_artifacts(archive_key, names, destination):
+    """
+    Get artifacts out of a packed archive in S3 without downloading it: the index uploaded next to
+    it (<archive>.index.json) gives the byte range of every member. names are member names, with or
+    without the codec extension, wildcards allowed. Without names, the archive members are listed.
+    """
+    try:
+        index = json.loads(s3_client.get_object(Bucket=S3_bucket, Key=archive_key + '.index.json')['Body'].read().decode('utf-8'))
+    except ClientError as e:
+        print('[ERROR] Getting archive index {}.index.json: {}'.format(archive_key, str(e)))
+        return False
+
+    if not names:
+        print('\n{:<60} {:>14} {:>14}  {}'.format('Member', 'Size', 'Stored', 'Codec'))
+        for m in index['members']:
+            print('{:<60} {:>14} {:>14}  {}'.format(m['name'], m['original_size'], m['size'], m['codec']))
+        return True
+
+    ok = True
+    for name in names:
+        members = [m for m in index['members'] if fnmatch.fnmatch(m['name'], name) or
+                   (m['compressed'] and fnmatch.fnmatch(os.path.splitext(m['name'])[0], name))]
+        if not members:
+            print('[ERROR] No member {} in {}'.format(name, archive_key))
+            ok = False
+        for m in members:
+            path = os.path.join(destination, os.path.splitext(m['name'])[0] if m['compressed'] else m['name'])
+            print('Retrieving {} ({} bytes of {}) to {}'.format(m['name'], m['size'], archive_key, path))
+            try:
+                retrieve_member(archive_key, m, path)
+                print('[OK] {} ({} bytes, sha256 {})'.format(path, m['original_size'], m['sha256']))
+            except Exception as e:
+                print('[ERROR] Retrieving {}: {}'.format(m['name'], str(e)))
+                ok = False
+    return ok
 
 
 
@@ -272,29 +721,57 @@ def forensics(tasks, i_data):
 
 
 def main(params):
-
-    if os.path.exists(local_tmp):
-        shutil.rmtree(local_tmp)
-    os.mkdir(local_tmp)
+    global metrics_file
 
     print("I'm going to do this:\n"+str(params).replace('\'','').replace('{', '').replace('}','').replace(',','\n')+'\n')
 
+    configure_common()
     get_config_params()
+    metrics_file = params['metrics_file']
+    configure_common()
 
-    inst_id = params['instance_id']
+    if params['retrieve']:
+        return retrieve_artifacts(params['retrieve'][0], params['retrieve'][1:], params['retrieve_to'])
 
-    inst_data = get_instance_data(inst_id)
-    #print(str(inst_data))
-    if not inst_data:
-        raise ValueError('Target instance Id does no exist.')
+    if params['publish_lime_module']:
+        module_path, release = params['publish_lime_module']
+        with open(module_path, 'rb') as f:
+            return publish_lime_module(f.read(), release, module_path)
 
-    preserve_status(inst_id, params['ami_snapshot'], inst_data['Reservations'][0]['Instances'][0]['BlockDeviceMappings'])
+    if params['promote_lime_module']:
+        return promote_lime_module(*params['promote_lime_module'])
 
-    forensics(params, inst_data)
+    if params['containment_first'] and not forensics_access_security_group:
+        raise ValueError('Containment-first needs forensics_access_security_group in the configuration.')
 
-    ec2_containment(inst_id)
+    # Progress of every instance is journaled under the run id, the same command with --run-id resumes an unfinished run
+    params['run_id'] = params['run_id'] or time.strftime('%Y%m%d_%H%M%S')
+    print('Run id: {} (start it again with --run-id {} to resume it)'.format(params['run_id'], params['run_id']))
 
-    shutil.rmtree(local_tmp)
+    # One or many instances (fleet mode), resolved with a single describe_instances
+    with measure('describe', None) as metric:
+        fleet = get_fleet_data(params['instance_ids'], params['filters'])
+        metric.update(ok=bool(fleet), instances=len(fleet))
+    #print(str(fleet))
+    if not fleet:
+        raise ValueError('Target instance Id does no exist.')
+
+    # Containment of the fleet in batches. Containment-first: every instance at once, in one call
+    response_start = time.time()
+    fleet_params = {Iid: params for Iid in fleet}
+    containment = ContainmentBatches([forensics_access_security_group] if params['containment_first'] else [])
+    if params['containment_first']:
+        # Without a prebuilt LiME module the memory dump can not be done on the isolated instance
+        if params['memory_dump']:
+            with ThreadPoolExecutor(max_workers=max(1, params['fleet_workers'])) as executor:
+                memory_dumps = dict(zip(fleet, executor.map(lime_module_precheck, fleet, fleet.values(), [params] * len(fleet))))
+            fleet_params = {Iid: dict(params, memory_dump=memory_dumps[Iid]) for Iid in fleet}
+        containment.add({Iid: inst_data['Reservations'][0]['Instances'][0].get('VpcId') for Iid, inst_data in fleet.items()})
+    with ThreadPoolExecutor(max_workers=max(1, params['fleet_workers'])) as executor:
+        futures = [executor.submit(respond_to_instance, fleet_params[Iid], Iid, inst_data, containment, response_start) for Iid, inst_data in fleet.items()]
+        results = [f.result() for f in futures]
+
+    print_fleet_results(results)
 
     print('\nDone!\n')
 
@@ -303,23 +780,66 @@ def main(params):
 # From command line arguments:
 if __name__=='__main__':
     my_parser = argparse.ArgumentParser()
-    my_parser.add_argument('-id', '--InstanceId', type=str, required=True, dest='instance_id', help='Instance id of the server to take forensics data from.')
+    my_parser.add_argument('-id', '--InstanceId', type=str, nargs='+', required=False, dest='instance_ids', help='Instance id of the server to take forensics data from. Several ids are allowed (fleet mode).')
+    my_parser.add_argument('--tag', required=False, dest='tags', type=str, action='append', default=[], help='Fleet mode: take every instance with this tag, as Key=Value. Can be repeated.')
+    my_parser.add_argument('--asg', required=False, dest='asg', type=str, help='Fleet mode: take every instance of this autoscaling group.')
+    my_parser.add_argument('--fleet-workers', required=False, dest='fleet_workers', type=int, default=4, help='Fleet mode: number of instances worked at the same time. --> default: 4')
     my_parser.add_argument('--no-memory-dump', required=False, dest='no_memory_dump', action='store_true', help='Do not execute memory dump. --> default: false (make memory dump)')
     my_parser.add_argument('--no-ami-snapshot', required=False, dest='no_ami_snapshot', action='store_true', help='Do not snapshot entire AMI. --> default: false (make EBS snapshot. Otherwise only EBS snapshot will be taken)')
+    my_parser.add_argument('--multi-volume-snapshot', required=False, dest='multi_volume_snapshot', action='store_true', help='With --no-ami-snapshot, snapshot all the attached volumes in one request, at the same point in time (crash-consistent across volumes). --> default: false (one snapshot request per volume)')
     my_parser.add_argument('--conserve-local-forensics', required=False, dest='conserve_forensics', action='store_true', help='Do not delete forensic files gathered in destination server after finishing tasks. --> default: false (delete tmp files in remote server)')
     my_parser.add_argument('--no-send-to-S3', required=False, dest='no_send_to_s3', action='store_true', help='Do not copy forensic files to S3 bucket. --> default: false (copy forensic files to S3)')
-    my_parser.add_argument('--S3-data-format', required=False, dest='s3_data_format', type=str, choices=['individual', 'packed'], default='packed', action='store', help='Choose how forensic data is stored in S3, as an individual compressed file, or individually. --> default: packed (save one compressed file to S3 containing all forensic files)')
+    my_parser.add_argument('--S3-data-format', required=False, dest='s3_data_format', type=str, choices=['individual', 'packed', 'deduplicated'], default='packed', action='store', help='Choose how forensic data is stored in S3, as an individual compressed file, or individually (one object per artifact plus a manifest.json). deduplicated: each artifact stored once by content hash in S3_blobs_path, plus a run manifest. --> default: packed (save one compressed file to S3 containing all forensic files)')
     my_parser.add_argument('--ssh_use_public_ip', required=False, dest='ssh_public_ip', action='store_true', help='Use instance Public IP to connect by ssh to execute and get forensics data. --> default: false (use Private IP)')
+    my_parser.add_argument('--memory-dump-stream', required=False, dest='memory_dump_stream', action='store_true', help='Stream the memory dump through ssh straight to S3, without writing the image to the instance disk (LiME port is firewalled to loopback while it serves the image). Without a cached LiME module for the kernel, the module is still built on the instance disk. --> default: false (dump to remote working path)')
+    my_parser.add_argument('--stream-evidence', required=False, dest='stream_evidence', action='store_true', help='The collector streams the evidence through ssh as each artifact is collected, and it is uploaded to S3 while the collection runs, stored as individual objects. No evidence is staged on the instance (without a cached LiME module, the module is still built on its disk). --> default: false (archive in remote working path, uploaded after the collection)')
+    my_parser.add_argument('--incremental', required=False, dest='incremental', action='store_true', help='Only collect log bytes appended since the last collection of each instance (state kept in S3 evidence path). --> default: false (full files)')
+    my_parser.add_argument('--retrieve', required=False, dest='retrieve', type=str, nargs='+', metavar=('ARCHIVE_KEY', 'ARTIFACT'), help='Get artifacts out of a packed archive in S3 (key relative to the bucket) with ranged GETs, without downloading the whole archive. Artifact names with or without codec extension, wildcards allowed. Only the archive key: list its members.')
+    my_parser.add_argument('--publish-lime-module', required=False, dest='publish_lime_module', type=str, nargs=2, metavar=('MODULE', 'KERNEL_RELEASE'), help='Run on a trusted builder: publish a LiME module built for this kernel release (uname -r) to the module cache, with its signed sha256 record. Modules built on an instance under investigation are only kept in quarantine, never cached.')
+    my_parser.add_argument('--promote-lime-module', required=False, dest='promote_lime_module', type=str, nargs=3, metavar=('INSTANCE_ID', 'KERNEL_RELEASE', 'SHA256'), help='Publish to the module cache a LiME module kept in quarantine (built on that instance), after it was reviewed. SHA256 is the hash of the module reviewed, it is only promoted if the quarantined module still has it.')
+    my_parser.add_argument('--retrieve-to', required=False, dest='retrieve_to', type=str, default='.', help='Directory where retrieved artifacts are written. --> default: current directory')
+    my_parser.add_argument('--size-budget', required=False, dest='size_budget', type=int, default=0, help='MB of original data collected at most on each instance, memory dump included. Artifacts over it are truncated (files keep their newest bytes) or skipped, most volatile first. --> default: no limit')
+    my_parser.add_argument('--time-budget', required=False, dest='time_budget', type=int, default=0, help='Seconds allowed to the remote collection. Artifacts still running then are stopped, the ones not started skipped. --> default: no limit')
+    my_parser.add_argument('--deadline', required=False, dest='deadline', type=int, help='Seconds allowed to the remote tasks on each instance, commands still running then are aborted on the instance. --> default: no limit (only per phase timeouts)')
+    my_parser.add_argument('--containment-first', required=False, dest='containment_first', action='store_true', help='Isolate the instance at once, keeping only ssh access from the forensics side (forensics_access_security_group), then preserve and collect on the isolated instance. --> default: false (containment after the collection)')
+    my_parser.add_argument('--run-id', required=False, dest='run_id', type=str, help='Resume the run with this id (printed at the start of every run): steps finished are skipped, the collection goes on with its archive on the instance and partial uploads are resumed. --> default: new run')
+    my_parser.add_argument('--metrics-file', required=False, dest='metrics_file', type=str, help='Append the duration, bytes and outcome of every phase and artifact to this file, as JSON lines in CloudWatch Embedded Metric Format. --> default: none')
     args = my_parser.parse_args()
 
+    filters = []
+    for tag in args.tags:
+        if '=' not in tag:
+            my_parser.error('--tag must be Key=Value: ' + tag)
+        filters.append({'Name': 'tag:' + tag.split('=', 1)[0], 'Values': [tag.split('=', 1)[1]]})
+    if args.asg:
+        filters.append({'Name': 'tag:aws:autoscaling:groupName', 'Values': [args.asg]})
+    if not args.instance_ids and not filters and not args.retrieve and not args.publish_lime_module and not args.promote_lime_module:
+        my_parser.error('one of -id, --tag, --asg, --retrieve, --publish-lime-module or --promote-lime-module is required')
+
     argsh = { 
-        'instance_id': args.instance_id,
+        'instance_ids': args.instance_ids,
+        'filters': filters,
+        'fleet_workers': args.fleet_workers,
         'memory_dump': not args.no_memory_dump,
         'ami_snapshot': not args.no_ami_snapshot,
+        'multi_volume_snapshot': args.multi_volume_snapshot,
         'conserve_files': args.conserve_forensics,
         'send_to_s3': not args.no_send_to_s3,
         's3_data_format': args.s3_data_format,
-        'ssh_public_ip': args.ssh_public_ip
+        'ssh_public_ip': args.ssh_public_ip,
+        'memory_dump_stream': args.memory_dump_stream,
+        'stream_evidence': args.stream_evidence,
+        'incremental': args.incremental,
+        'retrieve': args.retrieve,
+        'retrieve_to': args.retrieve_to,
+        'publish_lime_module': args.publish_lime_module,
+        'promote_lime_module': args.promote_lime_module,
+        'metrics_file': args.metrics_file,
+        'containment_first': args.containment_first,
+        'deadline': args.deadline,
+        'size_budget': args.size_budget,
+        'time_budget': args.time_budget,
+        'run_id': args.run_id
     } 
 
     main(argsh)
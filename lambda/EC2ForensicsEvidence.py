@@ -2,9 +2,17 @@ import argparse
 import time
 import boto3
 import botocore.config
+from botocore.exceptions import ClientError
 import os, shutil
+import hashlib
 import json
 import paramiko
+import forensicsCommon
+from forensicsCommon import (cached_s3_file, evict_cache, measure, emit_metric, artifact_metric, forward_collection_metrics,
+                             run_remote, stream_memory_dump, sftp_to_s3, read_archive_index, upload_individual, upload_deduplicated,
+                             stream_collection, remove_remote_sources, ArchiveVerifier, write_custody_record, lime_module_cache_key,
+                             quarantine_lime_module, promote_lime_module, push_collection_state, save_collection_state, RunJournal, remote_file_size,
+                             remote_kill_grace, remote_timeouts, artifact_event_prefix)
 
 # Get script configuration parameters from lambda environment variables. 
 # TODO If SSM is used, replace env vars for SSM parameters.
@@ -13,13 +21,21 @@ S3_bucket = os.environ['FORENSICS_BUCKET']
 S3_resources = ["forensics/resources/artifacts.json", "forensics/resources/collectLocalForensics.py"]
 S3_evidence_path = os.environ['FORENSICS_EVIDENCE_PATH']
 S3_EC2_key = "forensics/config/EC2-key.pem"
+S3_custody_key = "forensics/config/custody.key"  # HMAC-SHA256 secret custody records are signed with
+S3_blobs_path = S3_evidence_path + "blobs/"  # Content-addressed evidence store for s3_data_format deduplicated
+S3_lime_cache_path = "forensics/resources/lime/"  # Prebuilt LiME modules, stored as <S3_lime_cache_path><kernel release>/lime-<kernel release>.ko
 ec2_local_user = os.environ["EC2_LOCAL_USER"]
 region = os.environ['REGION']
 
 # Global variables
 s3_client = boto3.client('s3', region_name=region, config=botocore.config.Config(s3={'addressing_style':'path'}))
+ec2_client = boto3.client('ec2', region_name=region)
 
-local_tmp = '/tmp/{}/'.format(int(time.time()))
+# Local cache of S3 resources and key, /tmp is kept between warm invocations of the same lambda instance
+cache_path = '/tmp/forensics_cache/'
+
+collection_time_share = 0.6  # Share of the time left given to the collection when no time budget is set (the rest is for the upload)
+lambda_deadline_margin = 30  # Seconds kept before the lambda timeout, remote commands are aborted then
 
 
 print("""
@@ -37,19 +53,48 @@ print("""
 """)
 
 
+def configure_common():
+    # forensicsCommon works with the configuration of this lambda
+    forensicsCommon.configure(s3_client=s3_client, ec2_client=ec2_client, working_path=working_path, S3_bucket=S3_bucket,
+                              S3_evidence_path=S3_evidence_path, S3_blobs_path=S3_blobs_path, S3_custody_bucket=S3_bucket,
+                              S3_custody_key=S3_custody_key, S3_lime_cache_path=S3_lime_cache_path, cache_path=cache_path,
+                              metrics_file=None, metrics_output=True)
+
+
 def forensics(tasks):
-    # Get .pem ec2 key from S3 and put it in local temp
-    EC2_key = local_tmp + os.path.basename(S3_EC2_key)
-    s3_client.download_file(S3_bucket, S3_EC2_key, EC2_key)
-    # Change pem permissions to 0600
-    os.chmod(EC2_key, 0o600)
+    # .pem ec2 key in the local cache (0600, wiped on eviction)
+    EC2_key = cached_s3_file(S3_bucket, S3_EC2_key, secret=True)
 
     # ssh connection pre-steps
     key = paramiko.RSAKey.from_private_key_file(EC2_key)
     ssh_client = paramiko.SSHClient()
     ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-    # TODO check if EC2 is running
+    try:
+        inst = ec2_client.describe_instances(InstanceIds=[tasks['instance_id']])['Reservations'][0]['Instances'][0]
+    except (ClientError, IndexError) as e:
+        print('[ERROR] EC2 instance {} not found: {}'.format(tasks['instance_id'], str(e)))
+        return False
+    if not inst['State']['Name'] == 'running':
+        print('[ERROR] EC2 instance not running. Cannot do forensics local tasks.')
+        return False
+
+    # Remote commands are aborted on the instance when they run past this (no limit if None)
+    deadline = time.time() + tasks['deadline'] if tasks['deadline'] else None
+
+    # Progress of the run in S3, an attempt with the same run id goes on from where the last one stopped
+    journal = RunJournal(tasks['run_id'], tasks['instance_id'])
+    run = journal.step('run')
+    if run.get('done'):
+        print('Run {} already finished on {}, nothing to do.'.format(tasks['run_id'], tasks['instance_id']))
+        return True
+    if not run:
+        # Evidence names are kept by every attempt of the run
+        stamp = time.strftime('%Y%m%d_%H%M')
+        run = {'archive': 'forensics_complete_{}_{}.tar'.format(tasks['instance_id'], stamp),
+               'memory_dump': 'memory_dump_{}_{}.mem.gz'.format(tasks['instance_id'], stamp)}
+        journal.update('run', **run)
+    packed_evidence_filename = run['archive']
 
     # Copy resource files from S3 to EC2 
     try:
@@ -58,72 +103,220 @@ def forensics(tasks):
 
         # Create remote working tmp dirs
         cmd = 'mkdir -p ' + working_path
-        stdin, stdout, stderr = ssh_client.exec_command(cmd)
-        #print('stdout {}: {}'.format(cmd, stdout.read()))
-        if len(stderr.read()): 
-            raise Exception ('Failed tu execute: {}. stderr: {}'.format(cmd,sdterr.read()))
+        if run_remote(ssh_client, cmd, remote_timeouts['command'], deadline, tasks['instance_id']) != 0:
+            raise Exception ('Failed to execute: {}'.format(cmd))
+
+        # Prebuilt LiME module for the instance kernel goes with the other resources
+        lime_module_key, lime_module_sha256 = lime_module_cache_key(ssh_client, deadline) if tasks['memory_dump'] else (None, None)
 
         # Retrieve resources from S3 and send to EC2
         ftp_client=ssh_client.open_sftp()
-        for r in S3_resources:
-            loc_tmp = local_tmp + os.path.basename(r)
-            print('Retrieving from S3: {} to {}'.format(str(r), loc_tmp))
-            s3_client.download_file(S3_bucket, r, loc_tmp)
-
-            print('Sending: {} to EC2: {}'.format(loc_tmp, working_path+os.path.basename(r)))
-            ftp_client.put(loc_tmp, working_path+os.path.basename(r))
+        with measure('push', tasks['instance_id']) as metric:
+            # Resources still on the instance since an earlier attempt, and not changed in S3 since, are not sent again
+            pushed = journal.step('push').get('files', {})
+            for r in S3_resources + ([lime_module_key] if lime_module_sha256 else []):
+                local_copy = cached_s3_file(S3_bucket, r)
+                remote_copy = working_path+os.path.basename(r)
+                with open(local_copy, 'rb') as f:
+                    sha256 = hashlib.sha256(f.read()).hexdigest()
+                if r == lime_module_key and sha256 != lime_module_sha256:
+                    raise Exception('Cached LiME module {} does not match its recorded sha256, it is not sent to the instance'.format(r))
+                if remote_copy in pushed and pushed[remote_copy]['sha256'] == sha256 and remote_file_size(ftp_client, remote_copy) == pushed[remote_copy]['size']:
+                    print('Already on EC2: {}'.format(remote_copy))
+                    continue
+                print('Sending: {} to EC2: {}'.format(local_copy, remote_copy))
+                pushed[remote_copy] = {'size': ftp_client.put(local_copy, remote_copy).st_size, 'sha256': sha256}
+                metric['bytes'] += pushed[remote_copy]['size']
+            journal.update('push', done=True, files=pushed)
+
+        # Incremental collection state of this instance, kept in S3 between runs
+        collection_state_key = '{}collection_state_{}.json'.format(S3_evidence_path, tasks['instance_id'])
+        if tasks['incremental']:
+            push_collection_state(ftp_client, collection_state_key)
 
     except Exception as e:
         print('[ERROR] '+ str(e))
         return False
 
     
+    ok = True
+    # Diskless memory dump, streamed through the SSH channel straight to S3
+    stream_memory = tasks['memory_dump'] and tasks['memory_dump_stream'] and tasks['send_to_s3']
+    if stream_memory and journal.done('memory_stream'):
+        print('Memory dump already streamed to S3 by an earlier attempt: {}'.format(S3_evidence_path + run['memory_dump']))
+    elif stream_memory:
+        with measure('memory_stream', tasks['instance_id']) as metric:
+            report = stream_memory_dump(ssh_client, run['memory_dump'], deadline, tasks['instance_id'], journal)
+            metric.update(ok=bool(report), bytes=report['bytes'] if report else 0)
+        if metric['ok']:
+            journal.update('memory_stream', done=True)
+        ok = metric['ok']
+
+    # Evidence streamed by the collector and uploaded while it runs, nothing staged on the instance
+    stream_evidence = tasks['stream_evidence'] and tasks['send_to_s3']
+    if stream_evidence and tasks['s3_data_format'] != 'individual':
+        print('[WARNING] Streamed evidence is stored as individual objects, not {}.'.format(tasks['s3_data_format']))
+
     # RUN Forensic taks on remote server!
     print('\nRunning forensic tasks!...')
-    packed_evidence_filename = 'forensics_complete_{}_{}.tar.gz'.format(tasks['instance_id'], time.strftime('%Y%m%d_%H%M'))
+    # Collection started by an earlier attempt: its collector is stopped if it is still running,
+    # and the new one goes on with its archive (artifacts and memory dump already in it are kept)
+    collection = journal.step('collection')
+    if collection.get('pid') and not collection.get('done'):
+        run_remote(ssh_client, "sh -c 'sudo pkill -TERM -g {} -f collectLocalForensics.py; sleep {}'".format(collection['pid'], remote_kill_grace),
+                   remote_timeouts['command'], deadline, tasks['instance_id'])
     # TODO remove hardcoded collectLocalForensics.py
-    cmd = 'cd {}; sudo python3 collectLocalForensics.py {} {} {}'.format(
-                                                working_path,
-                                                '' if tasks['memory_dump'] else '--no-memory-dump',
+    # Collection budgets. With a deadline, the time budget defaults to a share of the time left
+    time_budget = tasks['time_budget'] or (int((deadline - time.time()) * collection_time_share) if deadline else 0)
+    cmd = 'sudo python3 -u collectLocalForensics.py {} {} {} {} {} {}{}'.format(
+                                                '' if tasks['memory_dump'] and not stream_memory else '--no-memory-dump',
                                                 '--conserve-local-forensics',
-                                                '--output-filename ' + packed_evidence_filename)
-    print("> I'm going to execute:\n  # {}".format(cmd))
-    # TODO try except
-    stdin, stdout, stderr = ssh_client.exec_command(cmd)
-    #print('stdout {}: {}'.format(cmds, stdout.read()))
-    if len(stderr.read()): 
-        print('Failed to execute: {}. stderr: {}'.format(cmd, stderr.read()))
-
-
-    if tasks['send_to_s3']:
-        # Get forensics_complete.tar.gz file from remote server
-        print('\nGetting from EC2: {}'.format(working_path+packed_evidence_filename))
-        # TODO try except
-        ftp_client.get(working_path+packed_evidence_filename, local_tmp+packed_evidence_filename)
-
-        if tasks['s3_data_format'] == 'packed':
-            # Send packed file to S3
-            print('Uploading evidence file: {} to S3: {}'.format(local_tmp+packed_evidence_filename, S3_evidence_path))
-            s3_client.upload_file(local_tmp+packed_evidence_filename, S3_bucket, S3_evidence_path+packed_evidence_filename)
+                                                '--incremental' if tasks['incremental'] else '',
+                                                ' '.join('--codec ' + c for c in tasks['codecs']),
+                                                ' '.join('--{} {}'.format(k, v) for k, v in (('size-budget', tasks['size_budget']), ('time-budget', max(1, time_budget) if time_budget else 0)) if v),
+                                                '--output-filename ' + packed_evidence_filename,
+                                                ' --stream-output' if stream_evidence else ' --resume' if collection else '')
+    # Collector output is followed line by line, every artifact is reported (and recorded in the journal) as soon as it is collected
+    collected = collection.get('artifacts', [])
+    emitted = set(collected)
+
+    def on_collector_line(stream, line):
+        # Messages of other collector workers can come right before the artifact line
+        before, event, after = line.partition(artifact_event_prefix)
+        if event:
+            if before:
+                print('  [{}] {}'.format(tasks['instance_id'], before))
+            a = json.loads(after)
+            emitted.add(a['output'])
+            collected.append(a['output'])
+            journal.note('collection', artifacts=collected)
+            emit_metric(artifact_metric(a, tasks['instance_id']))
+            print('  [{}] collected {} {} in {:.2f}s ({} bytes)'.format(tasks['instance_id'], a['status'], a['name'], a['seconds'], a.get('bytes', 0)))
         else:
-            # untar packed and send individual files to S3
-            # TODO
-            pass
+            print('  [{}] {}'.format(tasks['instance_id'], line))
+
+    if collection.get('done'):
+        print('Collection already finished by an earlier attempt: {}'.format(working_path+packed_evidence_filename))
+        exit_status = 0
+    elif stream_evidence:
+        # A streamed collection is not resumed, an earlier attempt that didn't finish is done again from the start
+        prefix = S3_evidence_path + os.path.splitext(packed_evidence_filename)[0] + '/'
+        print("> I'm going to execute:\n  # {}".format(cmd))
+        print('Streaming evidence to S3: {}'.format(prefix))
+        with measure('collection', tasks['instance_id'], streamed=True) as metric:
+            exit_status, index, manifest = stream_collection(ssh_client, cmd, prefix, prefix+'manifest.json', deadline, tasks['instance_id'], on_collector_line,
+                                                             on_pid=lambda pid: journal.update('collection', pid=pid))
+            if manifest:
+                # Signed chain of custody record next to the evidence
+                record = write_custody_record(index, {m['name']: m['uploaded_sha256'] for m in manifest['members']},
+                                              S3_evidence_path+packed_evidence_filename+'.custody.json', tasks['instance_id'], 'individual')
+                metric.update(ok=record['verified'], signed=bool(record['signature']), remote_seconds=manifest['collection_seconds'],
+                              bytes=sum(m['size'] for m in manifest['members']))
+            else:
+                metric['ok'] = False
+                print('[ERROR] Streamed collection {}: {}'.format('aborted' if exit_status is None else 'exited with status {}'.format(exit_status), cmd))
+            # Done only once its evidence is all in S3
+            journal.update('collection', done=metric['ok'], exit_status=exit_status, artifacts=collected,
+                           sources_to_remove=index.get('sources_to_remove', []) if metric['ok'] else [])
+            if not metric['ok']:
+                ok = False
+    else:
+        print("> I'm going to execute:\n  # {}".format(cmd))
+        with measure('collection', tasks['instance_id']) as metric:
+            exit_status = run_remote(ssh_client, cmd, remote_timeouts['collection'], deadline, tasks['instance_id'], on_collector_line, working_path,
+                                     on_pid=lambda pid: journal.update('collection', pid=pid))
+            journal.update('collection', done=exit_status == 0, exit_status=exit_status, artifacts=collected)
+            if exit_status != 0:
+                ok = metric['ok'] = False
+                print('[ERROR] Collection {}: {}'.format('aborted' if exit_status is None else 'exited with status {}'.format(exit_status), cmd))
+            # Timings measured by the collector itself, per artifact (the ones not followed live)
+            summary = forward_collection_metrics(ftp_client, working_path+packed_evidence_filename, tasks['instance_id'], emitted) if exit_status is not None else None
+            if summary:
+                metric.update(remote_seconds=summary['elapsed_seconds'], bytes=sum(a.get('bytes', 0) for a in summary['artifacts']), cut=len(summary.get('cut', [])))
+                # What the collection budgets left out, recorded in collection_summary.json
+                for c in summary.get('cut', []):
+                    print('[WARNING] {} {} {} ({}): {} bytes kept'.format(c['status'], c['name'], c['target'], c['cut']['reason'], c['cut']['collected_bytes']))
+
+    # Files the streamed collection left on the instance are removed now that their evidence is in S3
+    collection = journal.step('collection')
+    if collection.get('sources_to_remove') and collection.get('done') and not collection.get('sources_removed'):
+        if remove_remote_sources(ssh_client, collection['sources_to_remove'], deadline, tasks['instance_id']):
+            journal.update('collection', sources_removed=True)
+
+    if tasks['incremental']:
+        save_collection_state(ftp_client, collection_state_key)
+
+    # LiME module built on this run is only kept in quarantine, it never goes to the cache
+    if tasks['memory_dump'] and not lime_module_sha256:
+        quarantine_lime_module(ftp_client, lime_module_key, tasks['instance_id'])
+
+
+    # An aborted collection left no complete archive to upload, a streamed one is already uploaded
+    if tasks['send_to_s3'] and exit_status is not None and not stream_evidence:
+        with measure('upload', tasks['instance_id'], s3_data_format=tasks['s3_data_format']) as metric:
+            # Hashes computed by the collector, checked against what is uploaded
+            index = read_archive_index(ftp_client, working_path+packed_evidence_filename)
+            digests = {}
+            if not index:
+                metric['ok'] = False
+            elif tasks['s3_data_format'] == 'packed':
+                # Stream forensics_complete.tar file from remote server to S3
+                print('\nUploading evidence file from EC2: {} to S3: {}'.format(working_path+packed_evidence_filename, S3_evidence_path))
+                uploaded = journal.step('archive')
+                if uploaded.get('done'):
+                    print('Already uploaded by an earlier attempt: {}'.format(S3_evidence_path+packed_evidence_filename))
+                    report, digests = uploaded['report'], uploaded['digests']
+                else:
+                    verifier = ArchiveVerifier(index)
+                    report = sftp_to_s3(ftp_client, working_path+packed_evidence_filename, S3_evidence_path+packed_evidence_filename, on_data=verifier.update,
+                                        journal=journal, step='archive')
+                    # A resumed upload hashed the members on the instance instead of reading them all again
+                    digests = (report and report.get('member_sha256')) or verifier.hexdigests()
+                    if report:
+                        journal.update('archive', done=True, report={'bytes': report['bytes'], 'sha256': report['sha256']}, digests=digests)
+                # Index next to it, any artifact can be retrieved alone with ranged GETs (containmentAndForensicsEC2.py --retrieve)
+                index_report = report and sftp_to_s3(ftp_client, working_path+packed_evidence_filename+'.index.json', S3_evidence_path+packed_evidence_filename+'.index.json')
+                metric.update(ok=bool(index_report), bytes=report['bytes'] + index_report['bytes'] if index_report else 0)
+            elif tasks['s3_data_format'] == 'deduplicated':
+                # Only members whose content is not in the bucket yet are uploaded
+                print('\nUploading new evidence blobs from EC2: {} to S3: {}'.format(working_path+packed_evidence_filename, S3_blobs_path))
+                manifest = upload_deduplicated(ftp_client, working_path+packed_evidence_filename, S3_evidence_path+packed_evidence_filename+'.manifest.json', index, journal)
+                metric.update(ok=bool(manifest), bytes=manifest['uploaded_bytes'] if manifest else 0)
+                digests = {m['name']: m['uploaded_sha256'] for m in manifest['members'] if m['uploaded_sha256']} if manifest else {}
+            else:
+                # Every member of the archive as its own object, under a prefix named after the run
+                prefix = S3_evidence_path + os.path.splitext(packed_evidence_filename)[0] + '/'
+                print('\nUploading individual evidence files from EC2: {} to S3: {}'.format(working_path+packed_evidence_filename, prefix))
+                manifest = upload_individual(ftp_client, working_path+packed_evidence_filename, prefix, prefix+'manifest.json', index, journal)
+                metric.update(ok=bool(manifest), bytes=sum(m['size'] for m in manifest['members']) if manifest else 0)
+                digests = {m['name']: m['uploaded_sha256'] for m in manifest['members']} if manifest else {}
+            if metric['ok']:
+                # Signed chain of custody record next to the evidence
+                record = write_custody_record(index, digests, S3_evidence_path+packed_evidence_filename+'.custody.json', tasks['instance_id'], tasks['s3_data_format'])
+                metric.update(ok=record['verified'], signed=bool(record['signature']))
+            if not metric['ok']:
+                ok = False
+            journal.update('upload', done=metric['ok'])
+
+    # A run that didn't finish keeps its files on the instance, for the next attempt
+    if ok:
+        journal.update('run', done=True, finished_at=round(time.time(), 3))
+    else:
+        print('[ERROR] Run {} not finished on {}, start it again with the same run id to resume it.'.format(tasks['run_id'], tasks['instance_id']))
 
     # Cleaning
-    if not tasks['conserve_files']:
+    if not tasks['conserve_files'] and ok:
         # TODO instead of send rm, do it by collecLocalForensics.py arg
         # rm files on remote server
         print('Cleaning all the mess...')
         cmd = 'rm -rf {}'.format(working_path)
-        stdin, stdout, stderr = ssh_client.exec_command(cmd)
-        #print('stdout {}: {}'.format(cmds, stdout.read()))
-        if len(stderr.read()): 
-            print('Failed to execute {}. stderr: {}'.format(cmd, stderr.read()))
+        if run_remote(ssh_client, cmd, remote_timeouts['command'], label=tasks['instance_id']) != 0:
+            print('Failed to execute {}'.format(cmd))
 
 
     ftp_client.close()
     ssh_client.close()
+    return ok
 
 
 
@@ -134,15 +327,12 @@ def forensics(tasks):
 
 def main(params):
 
-    if os.path.exists(local_tmp):
-        shutil.rmtree(local_tmp)
-    os.mkdir(local_tmp)
-
     print("I'm going to do this:\n"+str(params).replace('\'','').replace('{', '').replace('}','').replace(',','\n')+'\n')
 
-    forensics(params)
-
-    shutil.rmtree(local_tmp)
+    configure_common()
+    evict_cache()
+    with measure('forensics', params['instance_id']) as metric:
+        metric['ok'] = forensics(params) is not False
 
     print('\nDone!\n')
 
@@ -157,13 +347,29 @@ def lambda_handler(event, context):
     "instance_id": "",
     "ec2_ip": "",
     "no_memory_dump": true/false,           --> default: false (make memory dump)
+    "memory_dump_stream": true/false,       --> default: false (dump memory to remote disk. true: stream it through ssh straight to S3, the LiME module is still built on disk without a cached one)
+    "stream_evidence": true/false,          --> default: false (archive on the remote disk, uploaded after the collection. true: streamed through ssh and uploaded while it runs, stored as individual)
     "conserve_local_forensics": true/false, --> default: false (delete tmp files in remote server)
+    "codecs": ["memory=zstd:1", "FILE=gzip"], --> default: gzip for every artifact type ([TYPE=]CODEC[:LEVEL], see collectLocalForensics.py --codec)
+    "incremental": true/false,              --> default: false (full files. true: only log bytes appended since the last collection of the instance)
     "no_send_to_s3": true/false,            --> default: false (copy forensis files to S3)
-    "s3_data_format": "individual"/"packed" --> default: packed (save one compressed file to S3 containing all forensic files)
+    "s3_data_format": "individual"/"packed"/"deduplicated" --> default: packed (save one compressed file to S3 containing all forensic files)
+    "size_budget_mb": 2048,                 --> default: no limit (MB of original data collected at most, memory dump included. Artifacts over it are truncated or skipped)
+    "time_budget_seconds": 300,             --> default: collection_time_share of the lambda time left (artifacts still running then are stopped, the rest skipped)
+    "run_id": ""                            --> default: the lambda request id, the same on asynchronous retries (an invocation with the run id of an unfinished run resumes it)
+    }
+    Promotion of a reviewed LiME module from quarantine to the module cache (no instance is worked):
+    event = {
+    "promote_lime_module": {"instance_id": "", "kernel_release": "", "sha256": ""}
     }
     """   
     print("Received event: {}".format(event))
 
+    if event.get('promote_lime_module'):
+        promote = event['promote_lime_module']
+        configure_common()
+        return promote_lime_module(promote['instance_id'], promote['kernel_release'], promote['sha256'])
+
     if not event['instance_id']:
         raise ValueError('Target instance Id is required.')
 
@@ -171,9 +377,18 @@ def lambda_handler(event, context):
         'instance_id': event['instance_id'],
         'ec2_ip': event['ec2_ip'],
         'memory_dump': False if 'no_memory_dump' in event and event['no_memory_dump'] else True,
+        'memory_dump_stream': True if 'memory_dump_stream' in event and event['memory_dump_stream'] else False,
+        'stream_evidence': True if 'stream_evidence' in event and event['stream_evidence'] else False,
+        'incremental': True if 'incremental' in event and event['incremental'] else False,
+        'codecs': event['codecs'] if 'codecs' in event else [],
         'conserve_files': True if 'conserve_local_forensics' in event and event['conserve_local_forensics'] else False,
         'send_to_s3': False if 'no_send_to_s3' in event and event['no_send_to_s3'] else True,
-        's3_data_format': event['s3_data_format'] if 's3_data_format' in event else 'packed' 
+        's3_data_format': event['s3_data_format'] if 's3_data_format' in event else 'packed',
+        'size_budget': event.get('size_budget_mb', 0),
+        'time_budget': event.get('time_budget_seconds', 0),
+        'run_id': event.get('run_id') or (context.aws_request_id if context else time.strftime('%Y%m%d_%H%M%S')),
+        # Remote commands are aborted before the lambda itself is killed
+        'deadline': context.get_remaining_time_in_millis() / 1000 - lambda_deadline_margin if context else None
     }
 
     print('Starting for instance: ' + event['instance_id'])
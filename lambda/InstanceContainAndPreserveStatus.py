@@ -4,6 +4,8 @@ import boto3
 import botocore.config
 import os, shutil
 import json
+import forensicsCommon
+from forensicsCommon import measure, preserve_status, ec2_containment
 
 # Get script configuration parameters from lambda environment variables. 
 # TODO If SSM is used, replace env vars for SSM parameters.
@@ -28,6 +30,13 @@ print("""
 """)
 
 
+def configure_common():
+    # forensicsCommon works with the configuration of this lambda
+    forensicsCommon.configure(s3_client=s3_client, ec2_client=ec2_client, S3_bucket=S3_bucket, S3_evidence_path=S3_evidence_path,
+                              isolation_security_groups=isolation_security_groups,
+                              metrics_file=None, metrics_output=True)
+
+
 def get_instance_data(Iid):
     res = False
     print('Getting Instance {} data...'.format(Iid))
@@ -49,69 +58,6 @@ def get_instance_data(Iid):
     return res
 
 
-def preserve_status(Iid, do_ami_snapshot, volumes):
-    if do_ami_snapshot:
-        # Create AMI of running Instance this process creates also EBS snapshot
-        print('Creating AMI from instance id: {}...'.format(Iid))
-        try:
-            res = ec2_client.create_image(InstanceId=Iid, NoReboot=True, Name="ami_preserved_from_"+Iid)
-            #print(res)
-            if res['ResponseMetadata']['HTTPStatusCode'] == 200:
-                print('[OK] AMI created {}\n'.format(res['ImageId']))
-            else:
-                print('[ERROR] {}\n'.format(str(res)))
-        except:
-            #TODO: Better error msg
-            print('[ERROR]\n')
-    else:
-        # Only take EBS Snapshot
-        print('Creating EBS snapshots...')
-        for vol in volumes:   
-            print('> Creating snapshot of volume: {}'.format(vol['Ebs']['VolumeId']))
-            try:
-                res = ec2_client.create_snapshot(VolumeId=vol['Ebs']['VolumeId'], Description="vol_snapshot_from_"+Iid)
-                if res['ResponseMetadata']['HTTPStatusCode'] == 200:
-                    print('[OK] EBS snapshot created {}\n'.format(res['SnapshotId']))
-                else:
-                    print('[ERROR] {}\n'.format(str(res)))
-            except:
-                #TODO: Better error msg
-                print('[ERROR]\n')
-            
-
-def ec2_containment(Iid):
-    # Remove original SGs and set very restrictive containment SG
-    print('\nContainment - Removing SGs...')
-    try:
-        sg_id = ec2_client.describe_security_groups(Filters=[ {'Name': 'group-name', 'Values': [isolation_security_groups[0]]} ])['SecurityGroups'][0]['GroupId']
-        print('-> Attaching SG {} - {} (first step: change all connections to untracked)'.format(isolation_security_groups[0], sg_id))
-        res = ec2_client.modify_instance_attribute(InstanceId=Iid, Groups=[sg_id])
-        time.sleep(2)   # just wait 2 seconds...
-        sg_id = ec2_client.describe_security_groups(Filters=[ {'Name': 'group-name', 'Values': [isolation_security_groups[1]]} ])['SecurityGroups'][0]['GroupId']
-        print('-> Attaching SG {} - {} (second step: dropping all connections with isolation SG)'.format(isolation_security_groups[1], sg_id))
-        res = ec2_client.modify_instance_attribute(InstanceId=Iid, Groups=[sg_id])
-        if res['ResponseMetadata']['HTTPStatusCode'] == 200:
-            print('[OK] SGs removed\n')
-        else:
-            print('[ERROR] {}\n'.format(str(res)))
-    except Exception as e:
-        #TODO: Better error msg
-        print('[ERROR] {}'.format(str(e)))
-
-    # Tag as quarantined
-    print('Tagging instance id {} as Security_status: quarantined'.format(Iid))
-    try:
-        res = ec2_client.create_tags(Resources=[Iid], Tags=[ { 'Key': 'Security_status', 'Value': 'quarantined' }])
-        if res['ResponseMetadata']['HTTPStatusCode'] == 200:
-            print('[OK] instance tagged\n')
-        else:
-            print('[ERROR] {}\n'.format(str(res)))
-    except Exception as e:
-        #TODO: Better error msg
-        print('[ERROR] {}'.format(str(e)))
-
-
-
 ######################################################
 # Main from command line Arguments or Lambda execution
 ######################################################
@@ -121,16 +67,21 @@ def main(params):
 
     print("I'm going to do this:\n"+str(params).replace('\'','').replace('{', '').replace('}','').replace(',','\n')+'\n')
 
+    configure_common()
     inst_id = params['instance_id']
 
-    inst_data = get_instance_data(inst_id)
+    with measure('describe', inst_id) as metric:
+        inst_data = get_instance_data(inst_id)
+        metric['ok'] = bool(inst_data)
     #print(str(inst_data))
     if not inst_data:
         raise ValueError('Target instance Id does no exist.')
 
-    preserve_status(inst_id, params['ami_snapshot'], inst_data['Reservations'][0]['Instances'][0]['BlockDeviceMappings'])
+    with measure('preserve', inst_id) as metric:
+        metric['ok'] = preserve_status(inst_id, params['ami_snapshot'], inst_data['Reservations'][0]['Instances'][0]['BlockDeviceMappings'], params['multi_volume_snapshot'])
 
-    ec2_containment(inst_id)
+    with measure('containment', inst_id) as metric:
+        metric['ok'] = ec2_containment(inst_id, inst_data['Reservations'][0]['Instances'][0].get('VpcId'))
 
     print('\nDone!\n')
 
@@ -144,6 +95,7 @@ def lambda_handler(event, context):
     event = {
     "instance_id": "",
     "no_ami_snapshot": true/false,          --> default: false (make AMI snapshot. Otherwise only EBS snapshot will be taken)
+    "multi_volume_snapshot": true/false,    --> default: false (one snapshot request per volume. Otherwise all volumes in one crash-consistent request)
     }
     """   
     print("Received event: {}".format(event))
@@ -153,7 +105,8 @@ def lambda_handler(event, context):
 
     argsh = { 
         'instance_id': event['instance_id'],
-        'ami_snapshot': False if 'no_ami_snapshot' in event and event['no_ami_snapshot'] else True
+        'ami_snapshot': False if 'no_ami_snapshot' in event and event['no_ami_snapshot'] else True,
+        'multi_volume_snapshot': bool(event.get('multi_volume_snapshot'))
     }
 
     print('Starting for instance: ' + event['instance_id'])
@@ -0,0 +1,146 @@
+import time
+import boto3
+import botocore.config
+import os
+import json
+from forensicsCommon import emit_metric, preservation_pending_prefix
+
+# Get script configuration parameters from lambda environment variables.
+# TODO If SSM is used, replace env vars for SSM parameters.
+S3_bucket = os.environ['FORENSICS_BUCKET']
+S3_evidence_path = os.environ['FORENSICS_EVIDENCE_PATH']
+region = os.environ['REGION']
+
+# Global variables
+ec2_client = boto3.client('ec2', region_name=region)
+s3_client = boto3.client('s3', region_name=region, config=botocore.config.Config(s3={'addressing_style':'path'}))
+
+preservation_prefix = 'preservation/'  # Under S3_evidence_path: final record of every preservation
+describe_batch_size = 200  # Ids per describe_snapshots / describe_images call (filter values)
+tracking_max_age = 2 * 86400  # Seconds. Preservations not finished by then are recorded as timed out
+not_found_grace = 3 * 5 * 60  # Seconds after requested_at (3 runs of the default 5 minutes schedule) a snapshot or AMI missing from describe_* is taken as not visible yet (eventual consistency), not as gone
+snapshot_final_states = ['completed', 'error']
+image_final_states = ['available', 'failed', 'error', 'invalid', 'deregistered']
+
+
+print("""
+////////////////////////////////////////////////////////////////////////////////
+| Tracks the AMIs and EBS snapshots taken from vulnerated EC2 instances        |
+| until they finish, and records their final state and duration               |
+|                                                                              |
+| Author: Guido Bernat.                                                        |
+///////////////////////////////////////////////////////////////////////////////
+
+""")
+
+
+def pending_preservations():
+    # {S3 key: record} of every preservation not finished yet, whatever instance or run it comes from
+    records = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_bucket, Prefix=S3_evidence_path + preservation_pending_prefix):
+        for obj in page.get('Contents', []):
+            records[obj['Key']] = json.loads(s3_client.get_object(Bucket=S3_bucket, Key=obj['Key'])['Body'].read().decode('utf-8'))
+    return records
+
+
+def describe_by_id(describe, id_filter, result_key, id_key, ids):
+    """
+    Snapshots or images by id, with one describe call per describe_batch_size ids. Ids are given
+    as a filter, so a deleted snapshot or image is just missing from the result (no error).
+    """
+    found = {}
+    ids = sorted(set(ids))
+    for n in range(0, len(ids), describe_batch_size):
+        res = describe(Filters=[{'Name': id_filter, 'Values': ids[n:n + describe_batch_size]}])
+        for r in res[result_key]:
+            found[r[id_key]] = r
+    return found
+
+
+def update_preservation(record, snapshots, images, now):
+    """
+    Update the state of the AMI and snapshots of a pending record. Completion is seen by this
+    poll, so durations are exact up to the tracker schedule. Returns whether all of them finished.
+    One that describe_* doesn't return is only finished as "not found" after not_found_grace,
+    right after create_snapshot / create_image it can just not be visible yet.
+    """
+    gone = now - record['requested_at'] > not_found_grace
+    finished = True
+    for s in record['snapshots']:
+        if s.get('finished_at'):
+            continue
+        found = snapshots.get(s['SnapshotId'])
+        if found:
+            s.update(state=found['State'], progress=found.get('Progress'), start_time=found['StartTime'].timestamp() if found.get('StartTime') else None)
+        else:
+            s['state'] = 'not found'
+        if s['state'] in snapshot_final_states or (not found and gone):
+            s.update(finished_at=round(now, 3), seconds=round(max(0, now - (s.get('start_time') or record['requested_at'])), 1))
+        else:
+            finished = False
+    image = record.get('image')
+    if image and not image.get('finished_at'):
+        found = images.get(image['ImageId'])
+        image['state'] = found['State'] if found else 'not found'
+        if image['state'] in image_final_states or (not found and gone):
+            image.update(finished_at=round(now, 3), seconds=round(max(0, now - record['requested_at']), 1))
+        else:
+            finished = False
+    return finished
+
+
+def finish_preservation(key, record, now, timed_out):
+    ok = not timed_out and all(s['state'] == 'completed' for s in record['snapshots']) and (not record.get('image') or record['image']['state'] == 'available')
+    record.update(status='timeout' if timed_out else 'completed' if ok else 'failed', finished_at=round(now, 3), seconds=round(max(0, now - record['requested_at']), 1))
+    final_key = S3_evidence_path + preservation_prefix + key[len(S3_evidence_path + preservation_pending_prefix):]
+    s3_client.put_object(Body=json.dumps(record, indent=2).encode('utf-8'), Bucket=S3_bucket, Key=final_key)
+    s3_client.delete_object(Bucket=S3_bucket, Key=key)
+    emit_metric({'phase': 'preservation', 'instance_id': record['instance_id'], 'mode': record['mode'], 'ok': ok, 'bytes': 0, 'seconds': record['seconds']})
+    print('[{}] {} preservation of {} {} in {}s: {}'.format('OK' if ok else 'ERROR', record['mode'], record['instance_id'], record['status'], record['seconds'], final_key))
+
+
+######################################################
+# Main from command line Arguments or Lambda execution
+######################################################
+
+
+def main(params):
+    """
+    One poll of every pending preservation, of all the instances at once: the states of all their
+    snapshots and AMIs are taken with a few batched describe calls, finished preservations are
+    recorded in preservation_prefix (AMI and snapshot ids, states and durations) and the rest are
+    left pending for the next run. Nothing waits here, the lambda runs on a schedule.
+    """
+    now = time.time()
+    records = pending_preservations()
+    print('{} preservations pending.'.format(len(records)))
+    if not records:
+        return {'pending': 0, 'finished': 0}
+
+    snapshots = describe_by_id(ec2_client.describe_snapshots, 'snapshot-id', 'Snapshots', 'SnapshotId',
+                               [s['SnapshotId'] for r in records.values() for s in r['snapshots']])
+    images = describe_by_id(ec2_client.describe_images, 'image-id', 'Images', 'ImageId',
+                            [r['image']['ImageId'] for r in records.values() if r.get('image')])
+
+    finished = 0
+    for key, record in records.items():
+        before = json.dumps(record, sort_keys=True)
+        done = update_preservation(record, snapshots, images, now)
+        timed_out = not done and now - record['requested_at'] > tracking_max_age
+        if done or timed_out:
+            finish_preservation(key, record, now, timed_out)
+            finished += 1
+        elif json.dumps(record, sort_keys=True) != before:
+            # Keep what finished already (with its time) for the next run
+            s3_client.put_object(Body=json.dumps(record, indent=2).encode('utf-8'), Bucket=S3_bucket, Key=key)
+    print('\nDone! {} finished, {} still pending.\n'.format(finished, len(records) - finished))
+    return {'pending': len(records) - finished, 'finished': finished}
+
+
+
+
+# From AWS lambda (scheduled):
+def lambda_handler(event, context):
+    print("Received event: {}".format(event))
+    return main({})
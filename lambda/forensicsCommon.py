@@ -0,0 +1,1253 @@
+import time
+import os, shlex
+import json
+import hashlib, hmac, base64, gzip
+import threading, collections, contextlib
+import select, struct
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# Code shared by the command line script (commandline/containmentAndForensicsEC2.py) and the lambdas:
+# preservation and containment, local cache of S3 objects, metrics, remote commands, evidence uploads,
+# chain of custody, LiME module cache and run journal. It is shipped in every lambda package, the
+# command line script takes it from this directory.
+
+# Configuration of the entry point, set with configure() before anything else is used
+s3_client = None
+ec2_client = None
+working_path = None  # Collector working path on the instance
+S3_bucket = None
+S3_evidence_path = None
+S3_blobs_path = None  # Content-addressed evidence store for s3_data_format deduplicated
+S3_custody_bucket = None  # Bucket of S3_custody_key: the conf bucket (command line) or S3_bucket (lambda)
+S3_custody_key = None  # HMAC-SHA256 secret custody records are signed with. Records are not signed without it
+S3_lime_cache_path = None  # Prebuilt LiME modules, stored as <S3_lime_cache_path><kernel release>/lime-<kernel release>.ko
+isolation_security_groups = None  # To drop established connections: apply First SG (inbound/outbound 0.0.0.0/0), wait, apply Second SG (restricted)
+cache_path = None  # Local cache of S3 objects, kept between runs (command line) or warm invocations (lambda)
+metrics_file = None  # JSON lines file where metrics are appended (command line --metrics-file)
+metrics_output = True  # Metrics printed to the output (lambdas: CloudWatch Logs extracts them from it)
+
+cache_ttl = 300  # Seconds a cached object is used without revalidating its ETag
+cache_max_age = 86400  # Cached objects not used for this long are evicted
+cache_secret_max_age = 900  # Cached key material is wiped after this long, whatever its ETag
+cache_lock = threading.Lock()
+cache_index = None
+
+s3_part_size = 16 * 1024 * 1024  # S3 multipart part size (minimum allowed by S3 is 5MB)
+s3_upload_workers = 4  # Parts uploaded at the same time
+memory_chunk_size = 16 * 1024 * 1024  # Streamed memory image is compressed in chunks of this size
+memory_compression_level = 1  # Fast gzip, memory images are big and the network is usually the bottleneck
+metrics_namespace = 'EC2Forensics'  # CloudWatch namespace of the phase and artifact metrics
+metrics_lock = threading.Lock()
+remote_pid_prefix = '@@pid '  # First stderr line of every remote command: its pid (and process group), to abort it
+remote_poll_interval = 0.2  # Seconds between checks of remote output and deadlines
+remote_kill_grace = 2  # Seconds between TERM and KILL when a remote command is aborted
+remote_timeouts = {'command': 60, 'hash': 600, 'memory_stream': 3600, 'collection': 3600}  # Seconds allowed to each remote phase
+artifact_event_prefix = '@@artifact '  # Collector line printed as each artifact is collected, followed by its result as JSON
+range_hashes_prefix = '@@hashes '  # Collector line with the hashes of a byte range of a file (collectLocalForensics.py --hash-range), followed by them as JSON
+remote_remove_batch = 200  # Paths per rm command when the sources of a streamed collection are removed
+stream_frame = struct.Struct('>cII')  # Frame header of the evidence streamed by the collector (collectLocalForensics.py --stream-output): kind, member id, payload length
+run_journal_prefix = 'runs/'  # Under S3_evidence_path: <run id>/<instance id>.json, progress of every forensics run (RunJournal)
+run_journal_save_interval = 5  # Seconds between saves of progress that is cheap to redo (parts, members, artifacts)
+security_groups_cache = {}  # (region, vpc id) -> {SG name: SG id}, resolved once per process (kept between warm invocations)
+security_groups_lock = threading.Lock()
+security_groups_settle = 2  # Seconds between the two isolation steps, for the first step SG to be enforced on the tracked connections
+preservation_pending_prefix = 'preservation/pending/'  # Under S3_evidence_path: AMIs and snapshots requested, until PreservationTracker records them as finished
+
+
+def configure(**settings):
+    # Configuration of the entry point (clients, bucket and paths), names as in the globals above
+    global cache_index
+    for name, value in settings.items():
+        if name not in globals():
+            raise ValueError('Unknown setting: ' + name)
+        if name == 'cache_path' and value != cache_path:
+            cache_index = None  # Index of the previous cache directory
+        globals()[name] = value
+
+
+def track_preservation(Iid, mode, image_id, snapshots):
+    # Pending record for PreservationTracker (lambda), that polls it until the AMI and snapshots complete
+    key = '{}{}{}_{}_{}.json'.format(S3_evidence_path, preservation_pending_prefix, Iid, mode, time.strftime('%Y%m%d_%H%M%S'))
+    record = {'instance_id': Iid, 'mode': mode, 'requested_at': round(time.time(), 3),
+              'image': {'ImageId': image_id} if image_id else None, 'snapshots': snapshots}
+    try:
+        s3_client.put_object(Body=json.dumps(record, indent=2).encode('utf-8'), Bucket=S3_bucket, Key=key)
+        print('Completion of the AMI/snapshots is tracked in S3: {}\n'.format(key))
+    except Exception as e:
+        print('[ERROR] Recording preservation {}: {}'.format(key, str(e)))
+
+
+def preserve_status(Iid, do_ami_snapshot, volumes, multi_volume=False):
+    """
+    AMI of the instance (it snapshots every volume too), or EBS snapshots: one create_snapshot
+    per volume, or with multi_volume one create_snapshots of all the attached volumes, taken at
+    the same point in time (crash-consistent across volumes). Nothing waits for them to complete,
+    what was requested is left in S3 for PreservationTracker.
+    """
+    ok = True
+    image_id = None
+    snapshots = []
+    if do_ami_snapshot:
+        # Create AMI of running Instance this process creates also EBS snapshot
+        print('Creating AMI from instance id: {}...'.format(Iid))
+        try:
+            res = ec2_client.create_image(InstanceId=Iid, NoReboot=True, Name="ami_preserved_from_"+Iid)
+            #print(res)
+            if res['ResponseMetadata']['HTTPStatusCode'] == 200:
+                image_id = res['ImageId']
+                print('[OK] AMI created {}\n'.format(res['ImageId']))
+            else:
+                ok = False
+                print('[ERROR] {}\n'.format(str(res)))
+        except:
+            #TODO: Better error msg
+            ok = False
+            print('[ERROR]\n')
+    elif multi_volume:
+        # All the volumes in a single request, same point in time for all of them
+        print('Creating multi-volume EBS snapshot of instance id: {}...'.format(Iid))
+        try:
+            res = ec2_client.create_snapshots(InstanceSpecification={'InstanceId': Iid, 'ExcludeBootVolume': False},
+                                              Description="vol_snapshot_from_"+Iid, CopyTagsFromSource='volume')
+            if res['ResponseMetadata']['HTTPStatusCode'] == 200:
+                snapshots = [{'SnapshotId': s['SnapshotId'], 'VolumeId': s['VolumeId']} for s in res['Snapshots']]
+                print('[OK] EBS snapshots created {}\n'.format(', '.join('{} ({})'.format(s['SnapshotId'], s['VolumeId']) for s in snapshots)))
+            else:
+                ok = False
+                print('[ERROR] {}\n'.format(str(res)))
+        except Exception as e:
+            ok = False
+            print('[ERROR] {}\n'.format(str(e)))
+    else:
+        # Only take EBS Snapshot
+        print('Creating EBS snapshots...')
+        for vol in volumes:   
+            print('> Creating snapshot of volume: {}'.format(vol['Ebs']['VolumeId']))
+            try:
+                res = ec2_client.create_snapshot(VolumeId=vol['Ebs']['VolumeId'], Description="vol_snapshot_from_"+Iid)
+                if res['ResponseMetadata']['HTTPStatusCode'] == 200:
+                    snapshots.append({'SnapshotId': res['SnapshotId'], 'VolumeId': vol['Ebs']['VolumeId']})
+                    print('[OK] EBS snapshot created {}\n'.format(res['SnapshotId']))
+                else:
+                    ok = False
+                    print('[ERROR] {}\n'.format(str(res)))
+            except:
+                #TODO: Better error msg
+                ok = False
+                print('[ERROR]\n')
+    if image_id or snapshots:
+        track_preservation(Iid, 'ami' if do_ami_snapshot else 'multi_volume' if multi_volume else 'per_volume', image_id, snapshots)
+    return ok
+
+
+def security_group_ids(names, vpc_id):
+    """
+    Security group ids by name in the vpc of the instances. Names are resolved once per
+    region and vpc, the ones not cached yet with a single describe_security_groups.
+    """
+    key = (ec2_client.meta.region_name, vpc_id)
+    with security_groups_lock:
+        cached = security_groups_cache.setdefault(key, {})
+        missing = [n for n in names if n not in cached]
+        if missing:
+            filters = [{'Name': 'group-name', 'Values': missing}] + ([{'Name': 'vpc-id', 'Values': [vpc_id]}] if vpc_id else [])
+            for sg in ec2_client.describe_security_groups(Filters=filters)['SecurityGroups']:
+                cached[sg['GroupName']] = sg['GroupId']
+        not_found = [n for n in names if n not in cached]
+        if not_found:
+            raise ValueError('Security groups not found in {}: {}'.format(vpc_id, ', '.join(not_found)))
+        return [cached[n] for n in names]
+
+
+def ec2_containment(Iids, vpc_id=None, access_security_groups=(), failures=None):
+    """
+    Two step isolation of one or many instances (of the same vpc): first SG (all open) makes
+    every tracked connection untracked, security_groups_settle seconds later the isolation SG
+    (plus access_security_groups, to keep forensics access during the collection in
+    containment-first mode) drops them. The API has no way to tell when an SG is enforced on the
+    network interfaces, so the settle time is a fixed wait, shared by all the instances of the call.
+    Failures are collected per instance (in failures, when given) and reported at the end, the
+    other instances are still contained.
+    """
+    Iids = [Iids] if isinstance(Iids, str) else list(Iids)
+    # Instance id -> errors, reported at the end: one instance failing doesn't stop the others from being contained
+    failures = {} if failures is None else failures
+    # Remove original SGs and set very restrictive containment SG
+    print('\nContainment - Removing SGs...')
+    try:
+        step2 = [isolation_security_groups[1]] + list(access_security_groups)
+        sg_ids = security_group_ids([isolation_security_groups[0]] + step2, vpc_id)
+    except Exception as e:
+        sg_ids = None
+        for Iid in Iids:
+            failures.setdefault(Iid, []).append(str(e))
+    if sg_ids:
+        print('-> Attaching SG {} - {} (first step: change all connections to untracked)'.format(isolation_security_groups[0], sg_ids[0]))
+        for Iid in Iids:
+            try:
+                ec2_client.modify_instance_attribute(InstanceId=Iid, Groups=sg_ids[:1])
+            except Exception as e:
+                failures.setdefault(Iid, []).append('first step SG: {}'.format(str(e)))
+        time.sleep(security_groups_settle)
+        print('-> Attaching SG {} - {} (second step: dropping all connections with isolation SG)'.format(', '.join(step2), ', '.join(sg_ids[1:])))
+        for Iid in Iids:
+            try:
+                res = ec2_client.modify_instance_attribute(InstanceId=Iid, Groups=sg_ids[1:])
+                if res['ResponseMetadata']['HTTPStatusCode'] != 200:
+                    failures.setdefault(Iid, []).append('isolation SG: {}'.format(str(res)))
+            except Exception as e:
+                failures.setdefault(Iid, []).append('isolation SG: {}'.format(str(e)))
+        if not failures:
+            print('[OK] SGs removed\n')
+
+    # Tag as quarantined
+    print('Tagging instance id {} as Security_status: quarantined'.format(', '.join(Iids)))
+    try:
+        res = ec2_client.create_tags(Resources=Iids, Tags=[ { 'Key': 'Security_status', 'Value': 'quarantined' }])
+        if res['ResponseMetadata']['HTTPStatusCode'] == 200:
+            print('[OK] instance tagged\n')
+        else:
+            for Iid in Iids:
+                failures.setdefault(Iid, []).append('tagging: {}'.format(str(res)))
+    except Exception as e:
+        for Iid in Iids:
+            failures.setdefault(Iid, []).append('tagging: {}'.format(str(e)))
+
+    for Iid in Iids:
+        if Iid in failures:
+            print('[ERROR] Containment of {}: {}'.format(Iid, '; '.join(failures[Iid])))
+    return not failures
+
+
+def wipe_file(path):
+    # Overwrite before unlinking, key material is not left behind in the file system
+    with open(path, 'r+b') as f:
+        f.write(b'\0' * os.path.getsize(path))
+        f.flush()
+        os.fsync(f.fileno())
+    os.remove(path)
+
+
+def write_cache_file(path, data):
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def load_cache_index():
+    global cache_index
+    if cache_index is None:
+        os.makedirs(cache_path, mode=0o700, exist_ok=True)
+        try:
+            with open(cache_path + 'index.json') as f:
+                cache_index = json.load(f)
+        except (IOError, ValueError):
+            cache_index = {}
+    return cache_index
+
+
+def save_cache_index():
+    with open(cache_path + 'index.json.tmp', 'w') as f:
+        json.dump(cache_index, f, indent=2)
+    os.replace(cache_path + 'index.json.tmp', cache_path + 'index.json')
+
+
+def evict_cache_entry(name):
+    entry = cache_index.pop(name)
+    if os.path.exists(entry['path']):
+        if entry['secret']:
+            wipe_file(entry['path'])
+        else:
+            os.remove(entry['path'])
+
+
+def evict_cache():
+    # Entries not used for cache_max_age, and key material older than cache_secret_max_age
+    with cache_lock:
+        index = load_cache_index()
+        now = time.time()
+        for name, entry in list(index.items()):
+            if now - entry['used'] > cache_max_age or (entry['secret'] and now - entry['downloaded'] > cache_secret_max_age):
+                print('Evicting from cache: {}'.format(name))
+                evict_cache_entry(name)
+        save_cache_index()
+
+
+def cached_s3_file(bucket, key, secret=False):
+    """
+    Local path of an S3 object kept in cache_path between runs (warm invocations, command line runs).
+    For cache_ttl seconds it is used without any S3 call, then it is revalidated with a conditional
+    GET on its ETag, so it is only downloaded again when it changed. Secret entries (key material)
+    are wiped, not just deleted, when they are evicted or replaced.
+    """
+    name = bucket + '/' + key
+    with cache_lock:
+        index = load_cache_index()
+        now = time.time()
+        entry = index.get(name)
+        if entry and (not os.path.exists(entry['path']) or (secret and now - entry['downloaded'] > cache_secret_max_age)):
+            evict_cache_entry(name)
+            entry = None
+
+        if not entry:
+            res = s3_client.get_object(Bucket=bucket, Key=key)
+            path = '{}{}_{}'.format(cache_path, hashlib.sha256(name.encode()).hexdigest()[:16], os.path.basename(key))
+            write_cache_file(path, res['Body'].read())
+            entry = index[name] = {'path': path, 'etag': res['ETag'], 'secret': secret, 'downloaded': now, 'checked': now}
+            print('Cached from S3: {}'.format(name))
+        elif now - entry['checked'] > cache_ttl:
+            try:
+                res = s3_client.get_object(Bucket=bucket, Key=key, IfNoneMatch=entry['etag'])
+                if secret:
+                    wipe_file(entry['path'])
+                write_cache_file(entry['path'], res['Body'].read())
+                entry.update(etag=res['ETag'], downloaded=now)
+                print('Changed in S3, cached again: {}'.format(name))
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('304', 'NotModified'):
+                    raise
+            entry['checked'] = now
+
+        entry['used'] = now
+        save_cache_index()
+        return entry['path']
+
+
+@contextlib.contextmanager
+def measure(phase, instance_id, **properties):
+    """
+    Time a response phase and emit it as a metric when it ends. The record yielded can be
+    updated with bytes moved and ok (outcome), an exception raised inside marks it failed.
+    """
+    record = dict(properties, phase=phase, instance_id=instance_id, ok=True, bytes=0)
+    start = time.time()
+    try:
+        yield record
+    except Exception:
+        record['ok'] = False
+        raise
+    finally:
+        record['seconds'] = round(time.time() - start, 3)
+        emit_metric(record)
+
+
+def metric_line(record):
+    # JSON line in CloudWatch Embedded Metric Format: seconds, bytes and failed are metrics by phase,
+    # every other key (instance_id, artifact...) is kept as a searchable property of the log event
+    return json.dumps(dict(record, failed=0 if record['ok'] else 1, _aws={
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{'Namespace': metrics_namespace,
+                               'Dimensions': [['phase']],
+                               'Metrics': [{'Name': 'seconds', 'Unit': 'Seconds'},
+                                           {'Name': 'bytes', 'Unit': 'Bytes'},
+                                           {'Name': 'failed', 'Unit': 'Count'}]}]}), default=str)
+
+
+def artifact_metric(a, instance_id):
+    # Artifact result of the remote collector, as measured on the instance
+    return {'phase': 'artifact', 'instance_id': instance_id, 'artifact': a['name'], 'type': a['type'],
+            'output': a['output'], 'status': a['status'], 'ok': a['status'] in ('OK', 'UNCHANGED', 'TRUNCATED'),
+            'volatility': a.get('volatility'), 'cut': (a.get('cut') or {}).get('reason'),
+            'seconds': a['seconds'], 'bytes': a.get('bytes', 0)}
+
+
+def forward_collection_metrics(ftp_client, remote_archive, instance_id, emitted=()):
+    """
+    Emit the timings measured by the remote collector (collection_summary.json in the archive),
+    one artifact metric per artifact not emitted yet while the collection was running (outputs
+    in emitted). Returns the summary, or None if there is none.
+    """
+    summary = read_collection_summary(ftp_client, remote_archive)
+    if summary:
+        for a in summary['artifacts']:
+            if a['output'] not in emitted:
+                emit_metric(artifact_metric(a, instance_id))
+    return summary
+
+
+def emit_metric(record):
+    # Command line: metrics go to --metrics-file (if any), not to the console output.
+    # Lambdas: printed, CloudWatch Logs extracts the metrics from the function output
+    if metrics_file:
+        with metrics_lock:
+            with open(metrics_file, 'a') as f:
+                f.write(metric_line(record) + '\n')
+    elif metrics_output:
+        print(metric_line(record))
+
+
+class S3MultipartUpload:
+    """
+    Upload a stream of unknown length to S3 while it is still being produced.
+    Data is cut in parts of s3_part_size that are sent concurrently by a bounded pool of workers,
+    write() blocks while 2 * workers parts are in flight, so memory use is bounded.
+    Every part is sent with its Content-MD5, S3 rejects any part corrupted on the way.
+    An upload left open by an earlier attempt is resumed with its upload_id and the parts it sent
+    (RunJournal): the data is written again from the start, and parts with the same size and MD5
+    as one already sent are not uploaded again, or the first parts are taken as they are (skip),
+    when their data is not read again. on_part(part) is called as each part is uploaded, with the
+    SHA-256 of its data.
+    """
+
+    def __init__(self, bucket, key, part_size=None, workers=s3_upload_workers, upload_id=None, parts=(), on_part=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size or s3_part_size
+        self.upload_id = upload_id or s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.sent = {p['PartNumber']: p for p in parts}
+        self.on_part = on_part
+        self.reused = 0
+        self.error = None  # First part that failed, nothing more is read for an upload that can't complete
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.buffer = bytearray()
+        self.futures = []
+        self.bytes = 0
+        self.start = time.time()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def complete(self):
+        # Last part can be smaller than part_size (an empty object still needs one part)
+        if self.buffer or not self.futures:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        parts = [f.result() for f in self.futures]
+        self.executor.shutdown()
+        s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                            MultipartUpload={'Parts': [{'PartNumber': p['PartNumber'], 'ETag': p['ETag']} for p in parts]})
+        elapsed = time.time() - self.start
+        report = {'key': self.key,
+                  'bytes': self.bytes,
+                  'parts': [{'PartNumber': p['PartNumber'], 'Size': p['Size'], 'MD5': p['MD5']} for p in parts],
+                  'seconds': round(elapsed, 3),
+                  'MBps': round(self.bytes / 1048576 / elapsed, 2) if elapsed else 0}
+        if self.reused:
+            report['reused_parts'] = self.reused
+        print('[OK] Uploaded {} ({} bytes, {} parts{}) in {}s: {} MB/s'.format(self.key, self.bytes, len(parts), ', {} sent before'.format(self.reused) if self.reused else '',
+                                                                         report['seconds'], report['MBps']))
+        return report
+
+    def abort(self, keep_parts=False):
+        # keep_parts: left open in S3 with the parts sent so far, to be resumed by a later attempt
+        self.executor.shutdown()
+        if keep_parts:
+            return
+        try:
+            s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print('[ERROR] Aborting multipart upload of {}: {}'.format(self.key, str(e)))
+
+    def skip(self, parts):
+        # The first parts sent before are part of the object as they are, their data is not written again
+        for part_number in range(1, parts + 1):
+            self._reuse(self.sent[part_number])
+
+    def _reuse(self, sent):
+        self.bytes += sent['Size']
+        self.reused += 1
+        self.futures.append(Future())
+        self.futures[-1].set_result(sent)
+
+    def _submit(self, body):
+        if self.error:
+            raise self.error
+        part_number = len(self.futures) + 1
+        sent = self.sent.get(part_number)
+        if sent and sent['Size'] == len(body) and sent['MD5'] == hashlib.md5(body).hexdigest():
+            self._reuse(sent)
+            return
+        self.bytes += len(body)
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number, body):
+        try:
+            md5 = hashlib.md5(body)
+            res = s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number,
+                                        Body=body, ContentMD5=base64.b64encode(md5.digest()).decode())
+            part = {'PartNumber': part_number, 'ETag': res['ETag'], 'Size': len(body), 'MD5': md5.hexdigest(), 'SHA256': hashlib.sha256(body).hexdigest()}
+            if self.on_part:
+                self.on_part(part)
+            return part
+        except Exception as e:
+            self.error = self.error or e
+            raise
+        finally:
+            self.slots.release()
+
+
+class RemoteTimeout(Exception):
+    pass
+
+
+class RemoteCommand:
+    """
+    Command run on the instance through its own SSH channel, without blocking on its output.
+    stderr lines (and stdout lines, unless stdout is read raw with read()) are handed to on_line
+    as they arrive. The command is aborted, its whole process group killed on the instance,
+    when it runs past its deadline (epoch seconds) or abort() is called. on_pid(pid) is called
+    as soon as its pid is known.
+    """
+
+    def __init__(self, ssh_client, cmd, cwd=None, deadline=None, label='remote', on_line=None, on_pid=None):
+        self.ssh_client = ssh_client
+        self.cmd = cmd
+        self.deadline = deadline
+        self.label = label
+        self.on_line = on_line or (lambda stream, line: print('  [{}] {}'.format(self.label, line)))
+        self.on_pid = on_pid
+        self.pid = None
+        self.aborted = None  # Reason, when it was aborted
+        self.partial = {'stdout': b'', 'stderr': b''}
+        # The shell pid (process group of everything the command starts) goes first on stderr, to abort it
+        self.channel = ssh_client.get_transport().open_session()
+        self.channel.exec_command('echo {}$$ >&2; {}exec {}'.format(remote_pid_prefix, 'cd {} && '.format(cwd) if cwd else '', cmd))
+
+    def _lines(self, stream, data):
+        lines = (self.partial[stream] + data).split(b'\n')
+        self.partial[stream] = lines.pop()
+        for line in lines:
+            line = line.decode(errors='replace').rstrip('\r')
+            if stream == 'stderr' and self.pid is None and line.startswith(remote_pid_prefix):
+                self.pid = int(line[len(remote_pid_prefix):])
+                if self.on_pid:
+                    self.on_pid(self.pid)
+            else:
+                self.on_line(stream, line)
+
+    def _check(self, raw_stdout=False):
+        # Hand over the lines received so far, and abort the command past its deadline
+        while self.channel.recv_stderr_ready():
+            self._lines('stderr', self.channel.recv_stderr(65536))
+        while not raw_stdout and self.channel.recv_ready():
+            self._lines('stdout', self.channel.recv(65536))
+        if self.deadline and time.time() > self.deadline:
+            self.abort('deadline')
+            raise RemoteTimeout('{} ran past its deadline: {}'.format(self.label, self.cmd))
+
+    def read(self, size):
+        # Up to size bytes of raw stdout, less only at EOF
+        data = bytearray()
+        while len(data) < size:
+            self._check(raw_stdout=True)
+            if self.channel.recv_ready():
+                chunk = self.channel.recv(min(size - len(data), 1048576))
+                if not chunk:
+                    break
+                data += chunk
+            elif self.channel.eof_received:
+                break
+            else:
+                select.select([self.channel], [], [], remote_poll_interval)
+        return bytes(data)
+
+    def wait(self):
+        # Exit status of the command, after its last output line was handed over
+        while not (self.channel.exit_status_ready() and not self.channel.recv_ready() and not self.channel.recv_stderr_ready()):
+            self._check()
+            select.select([self.channel], [], [], remote_poll_interval)
+        self._check()
+        for stream, rest in self.partial.items():
+            if rest:
+                self._lines(stream, b'\n')
+        return self.channel.recv_exit_status()
+
+    def abort(self, reason='aborted'):
+        # TERM to the process group of the command, KILL to whatever is left after remote_kill_grace
+        self.aborted = reason
+        print('[ERROR] Aborting {} ({}): {}'.format(self.label, reason, self.cmd))
+        if self.pid:
+            try:
+                stdin, stdout, stderr = self.ssh_client.exec_command('sudo kill -TERM -{pid} 2>/dev/null; sleep {grace}; sudo kill -KILL -{pid} 2>/dev/null; true'.format(pid=self.pid, grace=remote_kill_grace))
+                stdout.channel.recv_exit_status()
+            except Exception as e:
+                print('[ERROR] Killing remote process group {}: {}'.format(self.pid, str(e)))
+        self.channel.close()
+
+
+def run_remote(ssh_client, cmd, timeout=None, deadline=None, label='remote', on_line=None, cwd=None, on_pid=None):
+    """
+    Run a command on the instance, streaming its output lines, until it exits or its deadline
+    (timeout seconds from now, never later than deadline) is reached.
+    Returns its exit status, None if it was aborted.
+    """
+    if timeout:
+        deadline = min(deadline or float('inf'), time.time() + timeout)
+    command = RemoteCommand(ssh_client, cmd, cwd, deadline, label, on_line, on_pid)
+    try:
+        return command.wait()
+    except RemoteTimeout as e:
+        print('[ERROR] ' + str(e))
+        return None
+    finally:
+        command.channel.close()
+
+
+def stream_memory_dump(ssh_client, memory_dump_filename, deadline=None, label='remote', journal=None):
+    """
+    Diskless memory acquisition: the remote collector writes the raw LiME image to the SSH channel,
+    it is compressed here in chunks (concatenated gzip members, still a valid .gz file) by a pool of
+    workers and uploaded to S3 as a multipart upload while the dump is still running.
+    Nothing touches the instance disk, wall time is bound by network throughput.
+    The dump is aborted on the instance past remote_timeouts['memory_stream'] or deadline.
+    A stream can't be resumed (memory changes, it is dumped again from the start), the upload left
+    open by an earlier attempt recorded in the journal is aborted.
+    Returns the upload report or False.
+    """
+    cmd = 'sudo python3 -u collectLocalForensics.py --memory-dump-stream'
+    print('\nStreaming memory dump to S3: {}'.format(S3_evidence_path + memory_dump_filename))
+    print("> I'm going to execute:\n  # {}".format(cmd))
+    previous = journal.step('memory_stream') if journal else {}
+    if previous.get('upload_id'):
+        try:
+            s3_client.abort_multipart_upload(Bucket=S3_bucket, Key=previous['key'], UploadId=previous['upload_id'])
+        except ClientError:
+            pass
+    upload = S3MultipartUpload(S3_bucket, S3_evidence_path + memory_dump_filename)
+    if journal:
+        journal.update('memory_stream', key=upload.key, upload_id=upload.upload_id)
+    command = RemoteCommand(ssh_client, cmd, working_path, min(deadline or float('inf'), time.time() + remote_timeouts['memory_stream']), label)
+    try:
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=s3_upload_workers) as compressors:
+            while True:
+                chunk = command.read(memory_chunk_size)
+                if not chunk:
+                    break
+                pending.append(compressors.submit(gzip.compress, chunk, memory_compression_level))
+                # Keep chunk order, and no more than 2 * workers chunks in memory
+                while pending and (pending[0].done() or len(pending) > s3_upload_workers * 2):
+                    upload.write(pending.popleft().result())
+            while pending:
+                upload.write(pending.popleft().result())
+        exit_status = command.wait()
+        if exit_status != 0:
+            raise Exception('remote memory dump exited with status {}'.format(exit_status))
+        report = upload.complete()
+    except Exception as e:
+        print('[ERROR] Memory dump stream: {}'.format(str(e)))
+        if not command.aborted and not command.channel.exit_status_ready():
+            command.abort('upload failed')
+        upload.abort()
+        return False
+    finally:
+        command.channel.close()
+    return report
+
+
+def resumable_upload(key, journal, step):
+    """
+    Multipart upload of key recorded in step of the journal, with every part sent. The upload of
+    an earlier attempt is resumed if it was for the same key and part size and is still open in S3.
+    """
+    previous = journal.step(step)
+    on_part = lambda part: journal.add_part(step, part)
+    if previous.get('key') == key and previous.get('part_size') == s3_part_size:
+        try:
+            s3_client.list_parts(Bucket=S3_bucket, Key=key, UploadId=previous['upload_id'])
+            print('Resuming upload of {}: {} parts sent before'.format(key, len(previous.get('parts', []))))
+            return S3MultipartUpload(S3_bucket, key, upload_id=previous['upload_id'], parts=previous.get('parts', []), on_part=on_part)
+        except ClientError:
+            print('Upload of {} left by an earlier attempt is gone, starting it again.'.format(key))
+    upload = S3MultipartUpload(S3_bucket, key, on_part=on_part)
+    journal.update(step, key=key, upload_id=upload.upload_id, part_size=s3_part_size, parts=[])
+    return upload
+
+
+def remote_range_hashes(ftp_client, remote_path, offset, size):
+    """
+    SHA-256 of size bytes of a file on the instance from offset, of each s3_part_size window of
+    them and of the archive members among them, computed there by the collector from its disk
+    (collectLocalForensics.py --hash-range): only the hashes go through ssh. None if it failed.
+    """
+    output = []
+    cmd = 'sudo python3 collectLocalForensics.py --hash-range {} {} {} {}'.format(shlex.quote(remote_path), offset, size, s3_part_size)
+    # The command runs on the ssh transport of the SFTP session
+    status = run_remote(ftp_client.get_channel(), cmd, remote_timeouts['hash'], cwd=working_path,
+                        on_line=lambda stream, line: output.append(line[len(range_hashes_prefix):]) if stream == 'stdout' and line.startswith(range_hashes_prefix) else None)
+    if status != 0 or not output:
+        print('[WARNING] Hashing {} on the instance failed'.format(remote_path))
+        return None
+    return json.loads(output[-1])
+
+
+def sftp_to_s3(ftp_client, remote_path, key, offset=0, size=None, on_data=None, journal=None, step=None):
+    """
+    Copy a remote file (or size bytes of it from offset) to S3 without staging it locally.
+    It is read through SFTP in s3_part_size windows (pipelined requests, one window in memory
+    at a time) and every window is pushed as a multipart part while the next one is being read.
+    Data smaller than a part goes in a single put_object.
+    The SHA-256 of what is uploaded is computed on the way, and every window is also handed to
+    on_data(offset, data) (ArchiveVerifier), so nothing is read again to check it.
+    With a journal, a multipart upload is recorded in step of it (resumable_upload) and left open
+    on errors. A later attempt doesn't read again the windows of the parts already sent: the
+    instance hashes the data on its disk (remote_range_hashes), the SHA-256 recorded for each of
+    those parts must match it, and so must every window read after them. The hashes of the whole
+    range and of the archive members in it (member_sha256, instead of on_data) are then the ones
+    computed there, as every byte uploaded was checked against them.
+    Returns the upload report (bytes, sha256, per part MD5, throughput) or False.
+    """
+    try:
+        sha256 = hashlib.sha256()
+        with ftp_client.open(remote_path, 'rb') as f:
+            if size is None:
+                size = f.stat().st_size - offset
+            if size < s3_part_size:
+                body = b''.join(f.readv([(offset, size)])) if size else b''
+                sha256.update(body)
+                if on_data:
+                    on_data(offset, body)
+                s3_client.put_object(Body=body, Bucket=S3_bucket, Key=key, ContentMD5=base64.b64encode(hashlib.md5(body).digest()).decode())
+                return {'key': key, 'bytes': size, 'sha256': sha256.hexdigest(), 'parts': [{'PartNumber': 1, 'Size': size, 'MD5': hashlib.md5(body).hexdigest()}]}
+            upload = resumable_upload(key, journal, step) if journal else S3MultipartUpload(S3_bucket, key)
+            try:
+                # Leading parts sent by an earlier attempt, with the hash of their data
+                skipped = 0
+                while skipped + 1 in upload.sent and upload.sent[skipped + 1].get('SHA256') and upload.sent[skipped + 1]['Size'] == min(s3_part_size, size - skipped * s3_part_size):
+                    skipped += 1
+                hashes = remote_range_hashes(ftp_client, remote_path, offset, size) if skipped else None
+                if hashes and any(upload.sent[n + 1]['SHA256'] != hashes['windows'][n] for n in range(skipped)):
+                    print('[WARNING] Parts of {} sent before do not match the data on the instance, they are sent again'.format(key))
+                    hashes = None
+                if hashes:
+                    print('Resuming {} after {} parts, not read again'.format(key, skipped))
+                    upload.skip(skipped)
+                else:
+                    skipped = 0
+                for n, start in enumerate(range(offset, offset + size, s3_part_size)):
+                    if n < skipped:
+                        continue
+                    window = b''.join(f.readv([(start, min(s3_part_size, offset + size - start))]))
+                    if hashes:
+                        if hashlib.sha256(window).hexdigest() != hashes['windows'][n]:
+                            raise Exception('data read at {} does not match its hash on the instance'.format(start))
+                    else:
+                        sha256.update(window)
+                        if on_data:
+                            on_data(start, window)
+                    upload.write(window)
+                if hashes:
+                    return dict(upload.complete(), sha256=hashes['sha256'], member_sha256=hashes['members'])
+                return dict(upload.complete(), sha256=sha256.hexdigest())
+            except Exception:
+                upload.abort(keep_parts=bool(journal))
+                raise
+    except Exception as e:
+        print('[ERROR] Copying {} to S3: {}'.format(remote_path, str(e)))
+        return False
+
+
+def s3_object_exists(key):
+    try:
+        s3_client.head_object(Bucket=S3_bucket, Key=key)
+        return True
+    except ClientError:
+        return False
+
+
+def read_archive_index(ftp_client, remote_archive):
+    try:
+        with ftp_client.open(remote_archive + '.index.json', 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print('[ERROR] Reading archive index {}.index.json: {}'.format(remote_archive, str(e)))
+        return False
+
+
+def read_collection_summary(ftp_client, remote_archive, index=None):
+    # collection_summary.json member of the archive, stored uncompressed
+    index = index or read_archive_index(ftp_client, remote_archive)
+    for m in index['members'] if index else []:
+        if m['name'] == 'collection_summary.json':
+            with ftp_client.open(remote_archive, 'rb') as f:
+                return json.loads(b''.join(f.readv([(m['data_offset'], m['size'])])).decode('utf-8'))
+    return None
+
+
+def upload_individual(ftp_client, remote_archive, prefix, manifest_key, index=None, journal=None):
+    """
+    Individual upload of a packed archive: every member goes to S3 as its own object
+    <prefix><member name>, read straight from its byte range in the remote archive, so any
+    artifact can be downloaded alone. Members are uploaded concurrently by s3_upload_workers
+    workers, each one with its own SFTP channel. The run manifest records key, sizes and hash
+    of every object with the collection timings of its artifact (collection_summary.json).
+    With a journal, members uploaded by an earlier attempt of the run are not uploaded again.
+    """
+    index = index or read_archive_index(ftp_client, remote_archive)
+    if not index:
+        return False
+
+    # Collection timings by member name
+    summary = read_collection_summary(ftp_client, remote_archive, index)
+    timings = {a['output']: a for a in summary['artifacts']} if summary else {}
+    collection_seconds = summary['elapsed_seconds'] if summary else None
+
+    transport = ftp_client.get_channel().get_transport()
+    local = threading.local()
+    channels = []
+
+    def upload(m):
+        step = 'member:' + m['name']
+        if journal and journal.done(step):
+            return journal.step(step)['entry']
+        if not hasattr(local, 'ftp_client'):
+            local.ftp_client = transport.open_sftp_client()
+            channels.append(local.ftp_client)
+        key = prefix + m['name']
+        print('Uploading {} to S3: {}'.format(m['name'], key))
+        upload_start = time.time()
+        report = sftp_to_s3(local.ftp_client, remote_archive, key, m['data_offset'], m['size'], journal=journal, step=step)
+        if not report:
+            return False
+        entry = {'name': m['name'], 'key': key, 'size': m['size'], 'original_size': m['original_size'],
+                 'sha256': m['sha256'], 'uploaded_sha256': report['sha256'], 'codec': m['codec'], 'upload_seconds': round(time.time() - upload_start, 3)}
+        if m['name'] in timings:
+            entry.update({k: timings[m['name']][k] for k in ('type', 'target', 'status')})
+            entry['collection_seconds'] = timings[m['name']]['seconds']
+        if journal:
+            journal.note(step, done=True, entry=entry)
+        return entry
+
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=s3_upload_workers) as executor:
+            entries = list(executor.map(upload, index['members']))
+    finally:
+        for c in channels:
+            c.close()
+    if not all(entries):
+        return False
+
+    manifest = {'archive': index['archive'],
+                'prefix': prefix,
+                'collection_seconds': collection_seconds,
+                'upload_seconds': round(time.time() - start, 3),
+                'members': entries}
+    s3_client.put_object(Body=json.dumps(manifest, indent=2).encode('utf-8'), Bucket=S3_bucket, Key=manifest_key)
+    print('[OK] {} objects uploaded to {} in {}s, manifest: {}'.format(len(entries), prefix, manifest['upload_seconds'], manifest_key))
+    return manifest
+
+
+def upload_deduplicated(ftp_client, remote_archive, manifest_key, index=None, journal=None):
+    """
+    Content-addressed upload of a packed archive. Every member is stored once in S3 as
+    <S3_blobs_path><sha256 of its original content>[.gz|.zst|.lz4], whatever run or instance it comes from,
+    and only blobs not yet in the bucket are uploaded, read straight from their byte range in the
+    remote archive. The run manifest maps each member name to its blob.
+    With a journal, blobs uploaded by an earlier attempt of the run keep the hash they were uploaded with.
+    """
+    index = index or read_archive_index(ftp_client, remote_archive)
+    if not index:
+        return False
+
+    # Blob extension is the one of the member codec (.gz, .zst, .lz4), none when stored as is
+    blob_keys = [S3_blobs_path + m['sha256'] + (os.path.splitext(m['name'])[1] if m['compressed'] else '') for m in index['members']]
+    with ThreadPoolExecutor(max_workers=s3_upload_workers * 2) as executor:
+        existing = dict(zip(blob_keys, executor.map(s3_object_exists, blob_keys)))
+
+    manifest = {'archive': index['archive'], 'members': []}
+    uploaded = skipped = 0
+    for m, key in zip(index['members'], blob_keys):
+        step = 'member:' + m['name']
+        report = journal.step(step)['report'] if journal and journal.done(step) else None
+        if report:
+            uploaded += m['size']
+        elif existing[key]:
+            skipped += m['size']
+        else:
+            print('Uploading blob {} ({})'.format(key, m['name']))
+            report = sftp_to_s3(ftp_client, remote_archive, key, m['data_offset'], m['size'], journal=journal, step=step)
+            if not report:
+                return False
+            if journal:
+                journal.note(step, done=True, report={'bytes': report['bytes'], 'sha256': report['sha256']})
+            existing[key] = True
+            uploaded += m['size']
+        manifest['members'].append({'name': m['name'], 'blob': key, 'sha256': m['sha256'], 'size': m['original_size'],
+                                    'uploaded_sha256': report['sha256'] if report else None})
+
+    manifest.update({'uploaded_bytes': uploaded, 'skipped_bytes': skipped})
+    s3_client.put_object(Body=json.dumps(manifest, indent=2).encode('utf-8'), Bucket=S3_bucket, Key=manifest_key)
+    print('[OK] Run manifest {}: {} bytes uploaded, {} bytes already in the bucket'.format(manifest_key, uploaded, skipped))
+    return manifest
+
+
+class StreamedMember:
+    """
+    Member of a streamed collection on its way to S3 as its own object. It is kept in memory until
+    it is as big as a part, then sent as a multipart upload while the rest of it arrives (small
+    members go in a single put_object). The SHA-256 of what is uploaded is computed on the way.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.sha256 = hashlib.sha256()
+        self.buffer = bytearray()
+        self.upload = None
+        self.start = time.time()
+
+    def write(self, data):
+        self.sha256.update(data)
+        if self.upload:
+            self.upload.write(data)
+            return
+        self.buffer += data
+        if len(self.buffer) >= s3_part_size:
+            self.upload = S3MultipartUpload(S3_bucket, self.key)
+            self.upload.write(bytes(self.buffer))
+            self.buffer = None
+
+    def complete(self):
+        if self.upload:
+            report = self.upload.complete()
+        else:
+            body = bytes(self.buffer)
+            md5 = hashlib.md5(body)
+            s3_client.put_object(Body=body, Bucket=S3_bucket, Key=self.key, ContentMD5=base64.b64encode(md5.digest()).decode())
+            report = {'key': self.key, 'bytes': len(body), 'parts': [{'PartNumber': 1, 'Size': len(body), 'MD5': md5.hexdigest()}]}
+        return dict(report, sha256=self.sha256.hexdigest(), seconds=round(time.time() - self.start, 3))
+
+    def abort(self):
+        if self.upload:
+            self.upload.abort()
+
+
+def stream_collection(ssh_client, cmd, prefix, manifest_key, deadline=None, label='remote', on_line=None, on_pid=None):
+    """
+    Collection streamed by the collector (collectLocalForensics.py --stream-output) and uploaded
+    while it runs, nothing is staged on the instance. Frames are read from the SSH channel as they
+    arrive and every member goes to S3 as its own object <prefix><member name> (individual format)
+    while the collector is still producing it. Members of concurrent collector workers come
+    interleaved, each one with its own upload, and they are completed by a pool of workers so the
+    channel is not held by S3 calls. The collector index comes last, the run manifest is written
+    from it with the SHA-256 of every object as it was uploaded.
+    The collection is aborted on the instance past remote_timeouts['collection'] or deadline, or
+    when an upload fails. Returns its exit status (None if aborted), the collector index and the
+    manifest (False if the evidence was not all uploaded).
+    """
+    command = RemoteCommand(ssh_client, cmd, working_path, min(deadline or float('inf'), time.time() + remote_timeouts['collection']), label, on_line, on_pid)
+    members = {}  # Member id: StreamedMember, while its data arrives
+    uploads = {}  # Member name: upload report (future)
+    index = None
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=s3_upload_workers) as finishers:
+            while True:
+                header = command.read(stream_frame.size)
+                if not header:
+                    break
+                if len(header) < stream_frame.size:
+                    raise Exception('evidence stream cut in a frame header')
+                kind, member_id, length = stream_frame.unpack(header)
+                payload = command.read(length)
+                if len(payload) < length:
+                    raise Exception('evidence stream cut in a frame')
+                if kind == b'B':
+                    members[member_id] = StreamedMember(prefix + json.loads(payload.decode('utf-8'))['name'])
+                elif kind == b'D':
+                    members[member_id].write(payload)
+                elif kind == b'E':
+                    uploads[json.loads(payload.decode('utf-8'))['name']] = finishers.submit(members.pop(member_id).complete)
+                elif kind == b'I':
+                    index = json.loads(payload.decode('utf-8'))
+            reports = {name: f.result() for name, f in uploads.items()}
+        exit_status = command.wait()
+    except Exception as e:
+        print('[ERROR] Evidence stream: {}'.format(str(e)))
+        for m in members.values():
+            m.abort()
+        if not command.aborted and not command.channel.exit_status_ready():
+            command.abort('upload failed')
+        return None, index, False
+    finally:
+        command.channel.close()
+    if exit_status != 0 or not index:
+        return exit_status, index, False
+
+    entries = []
+    for m in index['members']:
+        entry = {'name': m['name'], 'key': reports[m['name']]['key'], 'size': m['size'], 'original_size': m['original_size'], 'sha256': m['sha256'],
+                 'uploaded_sha256': reports[m['name']]['sha256'], 'codec': m['codec'], 'upload_seconds': reports[m['name']]['seconds']}
+        if m.get('artifact'):
+            entry.update({k: m['artifact'][k] for k in ('type', 'target', 'status')})
+            entry['collection_seconds'] = m['artifact']['seconds']
+        entries.append(entry)
+    collection = index.get('collection', {})
+    manifest = {'archive': index['archive'],
+                'prefix': prefix,
+                'streamed': True,
+                'collection_seconds': round(collection['finished_at'] - collection['started_at'], 3) if collection.get('finished_at') else None,
+                'upload_seconds': round(time.time() - start, 3),
+                'members': entries}
+    s3_client.put_object(Body=json.dumps(manifest, indent=2).encode('utf-8'), Bucket=S3_bucket, Key=manifest_key)
+    print('[OK] {} objects streamed to {} in {}s, manifest: {}'.format(len(entries), prefix, manifest['upload_seconds'], manifest_key))
+    return exit_status, index, manifest
+
+
+def remove_remote_sources(ssh_client, paths, deadline=None, label='remote'):
+    # Files collected with remove_source in a streamed collection, left on the instance by the collector until their evidence is in S3
+    print('Removing {} collected files from the instance.'.format(len(paths)))
+    for n in range(0, len(paths), remote_remove_batch):
+        cmd = 'sudo rm -f -- ' + ' '.join(shlex.quote(p) for p in paths[n:n + remote_remove_batch])
+        if run_remote(ssh_client, cmd, remote_timeouts['command'], deadline, label) != 0:
+            print('[ERROR] Removing collected files: {}'.format(cmd))
+            return False
+    return True
+
+
+class ArchiveVerifier:
+    """
+    SHA-256 of the stored bytes of every member of a packed archive, computed from the windows of
+    the archive on their way to S3 (sftp_to_s3 on_data, in file order), to check them against the
+    stored_sha256 the collector wrote in the archive index.
+    """
+
+    def __init__(self, index):
+        self.members = sorted(index['members'], key=lambda m: m['data_offset'])
+        self.sha256 = {m['name']: hashlib.sha256() for m in self.members}
+        self.first = 0  # Members before it ended before the last window
+
+    def update(self, offset, data):
+        view = memoryview(data)
+        end = offset + len(data)
+        while self.first < len(self.members) and self.members[self.first]['data_offset'] + self.members[self.first]['size'] <= offset:
+            self.first += 1
+        for m in self.members[self.first:]:
+            if m['data_offset'] >= end:
+                break
+            start, stop = max(offset, m['data_offset']), min(end, m['data_offset'] + m['size'])
+            self.sha256[m['name']].update(view[start - offset:stop - offset])
+
+    def hexdigests(self):
+        return {name: h.hexdigest() for name, h in self.sha256.items()}
+
+
+def sign_custody_record(record):
+    # HMAC-SHA256 of the canonical JSON (sorted keys, no spaces) of the record, without its signature
+    try:
+        with open(cached_s3_file(S3_custody_bucket, S3_custody_key, secret=True), 'rb') as f:
+            secret = f.read().strip()
+    except Exception as e:
+        print('[WARNING] No custody key {}, the custody record is not signed: {}'.format(S3_custody_key, str(e)))
+        return None
+    body = json.dumps(record, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return {'algorithm': 'HMAC-SHA256', 'key': S3_custody_key, 'value': hmac.new(secret, body, hashlib.sha256).hexdigest()}
+
+
+def write_custody_record(index, digests, key, instance_id, s3_data_format):
+    """
+    Chain of custody record of a collection, saved next to its evidence. It has the archive index
+    written by the collector (host, collector and artifacts.json hashes, times and, per member, the
+    artifact and command it comes from, with original and stored sizes and SHA-256), the SHA-256
+    of every member as it was uploaded, whether they match, and its HMAC-SHA256 signature.
+    Members already in the bucket (deduplicated) were not uploaded again and have no upload hash.
+    """
+    members = [dict(m, uploaded_sha256=digests.get(m['name']),
+                    verified=None if digests.get(m['name']) is None else digests[m['name']] == m.get('stored_sha256'))
+               for m in index['members']]
+    mismatched = [m['name'] for m in members if m['verified'] is False]
+    record = {'archive': index['archive'], 'instance_id': instance_id, 's3_data_format': s3_data_format,
+              'collection': index.get('collection', {}), 'members': members,
+              'verified': not mismatched, 'recorded_at': round(time.time(), 3)}
+    record['signature'] = sign_custody_record(record) if S3_custody_key else None
+    s3_client.put_object(Body=json.dumps(record, indent=2, default=str).encode('utf-8'), Bucket=S3_bucket, Key=key)
+    for name in mismatched:
+        print('[ERROR] {} uploaded does not match the hash computed by the collector'.format(name))
+    print('[{}] Custody record {}: {} of {} members verified{}'.format('ERROR' if mismatched else 'OK', key, sum(1 for m in members if m['verified']),
+                                                                       len(members), '' if record['signature'] else ', not signed'))
+    return record
+
+
+def lime_module_s3_key(release):
+    return '{}{}/lime-{}.ko'.format(S3_lime_cache_path, release, release)
+
+
+def lime_module_record(release, sha256):
+    # Record of a cache entry, signed like custody records: the module is only pushed while it still has this sha256
+    record = {'release': release, 'sha256': sha256}
+    record['signature'] = sign_custody_record(record) if S3_custody_key else None
+    return record
+
+
+def lime_module_cache_key(ssh_client, deadline=None):
+    """
+    S3 key of the LiME module built for the instance kernel (uname -r) in the module cache,
+    and the sha256 recorded for it (None when there is no trusted entry). A cached module avoids
+    installing packages and building LiME on the instance (no internet access needed from the host
+    being isolated). Entries are only trusted with a record (<key>.json) that matches its signature,
+    they are published from a trusted builder, never from an instance. Without a readable custody
+    key no record can be checked, every entry is taken as a miss.
+    """
+    output = []
+    if run_remote(ssh_client, 'uname -r', remote_timeouts['command'], deadline, on_line=lambda stream, line: output.append(line) if stream == 'stdout' else None) != 0:
+        raise Exception('Failed to get the kernel release of the instance')
+    release = output[0].strip()
+    key = lime_module_s3_key(release)
+    try:
+        record = json.loads(s3_client.get_object(Bucket=S3_bucket, Key=key + '.json')['Body'].read())
+    except ClientError:
+        print('No prebuilt LiME module for kernel {}, it will be built on the instance.'.format(release))
+        return key, None
+    expected = lime_module_record(release, record['sha256'])['signature'] if record.get('sha256') else None
+    if not expected:
+        print('[WARNING] The record of the prebuilt LiME module {} can not be checked without the custody key, the module will be built on the instance.'.format(key))
+        return key, None
+    signature = record.get('signature') if isinstance(record.get('signature'), dict) else {}
+    if record.get('release') != release or signature.get('algorithm') != expected['algorithm'] or \
+            not hmac.compare_digest(str(signature.get('value', '')).encode(), expected['value'].encode()):
+        print('[WARNING] Record of the prebuilt LiME module {} does not match its signature, the module will be built on the instance.'.format(key))
+        return key, None
+    print('Prebuilt LiME module for kernel {} found: {} (sha256 {})'.format(release, key, record['sha256']))
+    return key, record['sha256']
+
+
+def lime_module_quarantine_key(instance_id, release):
+    return '{}quarantine/{}/lime-{}.ko'.format(S3_lime_cache_path, instance_id, release)
+
+
+def quarantine_lime_module(ftp_client, key, instance_id):
+    """
+    A module built by the collector on a cache miss (left in working path as lime-<kernel release>.ko)
+    was built on the host under investigation, so it is not trusted: it is kept for analysis under
+    <S3_lime_cache_path>quarantine/<instance id>/, with its sha256 in <module key>.json, and never
+    pushed to other instances unless it is promoted after review (promote_lime_module).
+    """
+    remote_module = working_path + os.path.basename(key)
+    try:
+        ftp_client.stat(remote_module)
+    except IOError:
+        print('[ERROR] No LiME module was built on the instance: {}'.format(remote_module))
+        return False
+    release = os.path.basename(key)[len('lime-'):-len('.ko')]
+    quarantine_key = lime_module_quarantine_key(instance_id, release)
+    report = sftp_to_s3(ftp_client, remote_module, quarantine_key)
+    if not report:
+        return False
+    record = {'release': release, 'sha256': report['sha256'], 'instance_id': instance_id, 'quarantined_at': round(time.time(), 3)}
+    s3_client.put_object(Bucket=S3_bucket, Key=quarantine_key + '.json', Body=json.dumps(record).encode())
+    print('LiME module built on the instance, kept in quarantine (not cached): {} (sha256 {})'.format(quarantine_key, report['sha256']))
+    return report
+
+
+def publish_lime_module(module, release, origin):
+    # The module (bytes) and its signed record become the cache entry of the kernel release
+    key = lime_module_s3_key(release)
+    record = lime_module_record(release, hashlib.sha256(module).hexdigest())
+    if not record['signature']:
+        # An unsigned entry would never be used
+        raise Exception('The LiME module record can not be signed, custody key {} not available'.format(S3_custody_key))
+    s3_client.put_object(Bucket=S3_bucket, Key=key, Body=module)
+    s3_client.put_object(Bucket=S3_bucket, Key=key + '.json', Body=json.dumps(record).encode())
+    print('[OK] LiME module {} published to cache: {} (sha256 {})'.format(origin, key, record['sha256']))
+    return record
+
+
+def promote_lime_module(instance_id, release, sha256):
+    """
+    Publish to the cache a module kept in quarantine, once it was reviewed. sha256 is the hash of the
+    module that was reviewed: the quarantined object is only promoted if it is still that module.
+    """
+    quarantine_key = lime_module_quarantine_key(instance_id, release)
+    module = s3_client.get_object(Bucket=S3_bucket, Key=quarantine_key)['Body'].read()
+    if hashlib.sha256(module).hexdigest() != sha256:
+        raise Exception('Quarantined LiME module {} is not the one reviewed: sha256 {}, expected {}'.format(quarantine_key, hashlib.sha256(module).hexdigest(), sha256))
+    return publish_lime_module(module, release, quarantine_key)
+
+
+def push_collection_state(ftp_client, state_key):
+    """
+    Incremental collection: send the state of the last collection of this instance (kept in S3,
+    next to the evidence) to the remote working path, so only new log bytes are collected.
+    """
+    try:
+        state = s3_client.get_object(Bucket=S3_bucket, Key=state_key)['Body'].read()
+    except ClientError:
+        print('No previous collection state in {}, collecting full files.'.format(state_key))
+        return False
+    print('Sending previous collection state: {} to EC2: {}'.format(state_key, working_path + 'collection_state.json'))
+    with ftp_client.open(working_path + 'collection_state.json', 'wb') as f:
+        f.write(state)
+    return True
+
+
+def save_collection_state(ftp_client, state_key):
+    # New state left by the collector replaces the previous one in S3
+    try:
+        with ftp_client.open(working_path + 'collection_state.json', 'rb') as f:
+            s3_client.put_object(Body=f.read(), Bucket=S3_bucket, Key=state_key)
+        print('Collection state saved to S3: {}'.format(state_key))
+        return True
+    except Exception as e:
+        print('[ERROR] Saving collection state: {}'.format(str(e)))
+        return False
+
+
+class RunJournal:
+    """
+    Progress of the forensics run of an instance, kept in S3 as
+    <S3_evidence_path><run_journal_prefix><run id>/<instance id>.json: evidence names, resources
+    pushed, collector started (its pid) and finished, artifacts collected, multipart uploads with
+    every part sent, members uploaded. A run interrupted (lambda timeout, ssh session lost) and
+    started again with the same run id skips what was finished, resumes the collection on the
+    instance (collectLocalForensics.py --resume) and the multipart uploads left open.
+    update() saves at once, note() and add_part() at most every run_journal_save_interval: what
+    is lost with them is only done again.
+    """
+
+    def __init__(self, run_id, instance_id):
+        self.key = '{}{}{}/{}.json'.format(S3_evidence_path, run_journal_prefix, run_id, instance_id)
+        self.lock = threading.Lock()
+        try:
+            self.state = json.loads(s3_client.get_object(Bucket=S3_bucket, Key=self.key)['Body'].read().decode('utf-8'))
+            print('Resuming run {} of {}, attempt {}: {}'.format(run_id, instance_id, len(self.state['attempts']) + 1,
+                                                                ', '.join(name for name, step in self.state['steps'].items() if step.get('done')) or 'nothing finished'))
+        except ClientError:
+            self.state = {'run_id': run_id, 'instance_id': instance_id, 'attempts': [], 'steps': {}}
+        self.state['attempts'].append(round(time.time(), 3))
+        self.saved_at = 0
+        with self.lock:
+            self._save()
+
+    def step(self, name):
+        # Copy of what is recorded for a step (empty if it was never started)
+        with self.lock:
+            return json.loads(json.dumps(self.state['steps'].get(name, {})))
+
+    def done(self, name):
+        return bool(self.step(name).get('done'))
+
+    def update(self, name, **values):
+        with self.lock:
+            self.state['steps'].setdefault(name, {}).update(values)
+            self._save()
+
+    def note(self, name, **values):
+        with self.lock:
+            self.state['steps'].setdefault(name, {}).update(values)
+            self._save(later=True)
+
+    def add_part(self, name, part):
+        with self.lock:
+            self.state['steps'].setdefault(name, {}).setdefault('parts', []).append(part)
+            self._save(later=True)
+
+    def _save(self, later=False):
+        if later and time.time() - self.saved_at < run_journal_save_interval:
+            return
+        s3_client.put_object(Body=json.dumps(self.state, indent=2, default=str).encode('utf-8'), Bucket=S3_bucket, Key=self.key)
+        self.saved_at = time.time()
+
+
+def remote_file_size(ftp_client, path):
+    try:
+        return ftp_client.stat(path).st_size
+    except IOError:
+        return None
+
@@ -3,13 +3,48 @@ import json
 import os, shutil
 from glob import glob
 import argparse
+import sys, socket, signal, fcntl
+import time
+import tarfile, gzip, tempfile, threading, io
+import hashlib, re, struct
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 artifacts_file = 'artifacts.json'
 working_path = '/tmp/forensics/'
 memdump_path = working_path + 'memdump/'
-packed_evidence_filename = 'forensics_complete.tar.gz'  # Default value if parameter is missing
+packed_evidence_filename = 'forensics_complete.tar'  # Default value if parameter is missing
+collection_summary_filename = 'collection_summary.json'
+collection_state_filename = 'collection_state.json'  # Offsets of incremental FILE artifacts from the last collection
+archive_journal_extension = '.journal'  # <archive>.journal: members and artifacts done so far, an interrupted collection resumes from it (--resume)
+collection_workers = os.cpu_count() or 1  # Default value if parameter is missing
+artifact_timeout = 300  # Seconds. Default value if parameter is missing. Can be overridden per artifact with "timeout" in artifacs.json
+codec_default = 'gzip'  # Default value if parameter is missing
+codec_extensions = {'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4', 'none': ''}
+codec_default_levels = {'gzip': 6, 'zstd': 3, 'lz4': 1, 'none': 0}
+artifact_codec_types = ['memory', 'FILE', 'COMMAND', 'PROC']
+# Collection order, most volatile first (order of volatility, RFC 3227). Network and process state
+# go before the memory dump: they are quick to take, and change while memory is being dumped
+volatility_classes = ['network', 'process', 'memory', 'session', 'logs', 'system', 'files']
+default_volatility = {'memory': 'memory', 'COMMAND': 'process', 'PROC': 'process', 'FILE': 'files'}  # Unless "volatility" is set per artifact in artifacs.json
+spool_max_size = 64 * 1024 * 1024  # Compressed members bigger than this are spooled to working_path before being appended
+copy_chunk_size = 1024 * 1024
+lime_tcp_port = 4444  # Local port where LiME serves the memory image in --memory-dump-stream mode
+lime_tcp_rule = ['INPUT', '!', '-i', 'lo', '-p', 'tcp', '--dport', str(lime_tcp_port), '-j', 'DROP']  # LiME listens on every interface, only loopback may reach it while it is loaded
+evidence_stream = None  # Binary stdout when evidence is streamed instead of written to working_path
+stream_frame = struct.Struct('>cII')  # --stream-output frame header: kind (B: member begins, D: member data, E: member ends, I: archive index), member id, payload length
+artifact_event_prefix = '@@artifact '  # Line printed as each artifact is collected, followed by its result as JSON (the orchestrator follows the collection with it)
+range_hashes_prefix = '@@hashes '  # Line printed by --hash-range, followed by the hashes as JSON
+file_pattern_magic = re.compile('[*?[]')  # Glob characters, a FILE pattern is walked from the directory before the first of them
+proc_path = '/proc'
+proc_sections = ['processes', 'fds', 'sockets', 'mounts', 'modules']  # What a PROC artifact can take (its attributes, all of them if empty)
+socket_tables = ['tcp', 'tcp6', 'udp', 'udp6', 'raw', 'raw6', 'unix']  # Under /proc/net
+tcp_states = {'01': 'ESTABLISHED', '02': 'SYN_SENT', '03': 'SYN_RECV', '04': 'FIN_WAIT1', '05': 'FIN_WAIT2', '06': 'TIME_WAIT',
+              '07': 'CLOSE', '08': 'CLOSE_WAIT', '09': 'LAST_ACK', '0A': 'LISTEN', '0B': 'CLOSING', '0C': 'NEW_SYN_RECV'}
+artifact_processes = set()  # Running artifact commands, each in its own process group (killed whole on timeout or abort)
+memory_image = None  # Raw memory image taken instead of a LiME dump (--memory-image, replays and benchmarks)
 
-print("""
+banner = """
 ////////////////////////////////////////////////////////////////////////////
 | Script to retrieve artifacts like files and commands output,             |
 | and perform a memory dump from a Linux server.                           |
@@ -22,12 +57,552 @@ print("""
 | Author: Guido Bernat.                                                    |
 ////////////////////////////////////////////////////////////////////////////
 
-""")
+"""
 
 
 
 
-# Install necessary SO packages to do all tasks
+class HashingReader:
+    """Wrap a readable object, computing SHA-256 and size of everything read through it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+
+class HashingWriter:
+    """Wrap a writable object, computing SHA-256 and size of everything written through it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+class Codec:
+    """
+    Compression codec of archive members: gzip, zstd, lz4 or none, and its level.
+    Multi-threaded external compressors are used when installed (pigz, zstd -T0, lz4),
+    otherwise the Python implementation (zlib, or the zstandard / lz4 modules if available).
+    A codec that can't run on this host falls back to gzip, so member names always match their content.
+    """
+
+    def __init__(self, name='gzip', level=None):
+        if name not in codec_extensions:
+            raise ValueError('Unknown codec: ' + name)
+        self.command = None
+        self.module = None
+        if name == 'gzip' and shutil.which('pigz'):
+            self.command = ['pigz', '-c']
+        elif name == 'zstd':
+            if shutil.which('zstd'):
+                self.command = ['zstd', '-q', '-c', '-T0']
+            else:
+                self.module = self._import('zstandard')
+        elif name == 'lz4':
+            if shutil.which('lz4'):
+                self.command = ['lz4', '-q', '-c']
+            else:
+                self.module = self._import('lz4.frame')
+        if name in ('zstd', 'lz4') and not (self.command or self.module):
+            print('   ! Codec {} not available on this host, using gzip.'.format(name))
+            name, level = 'gzip', None
+        self.name = name
+        self.level = codec_default_levels[name] if level is None else int(level)
+        if self.command:
+            self.command = self.command + ['-{}'.format(self.level)]
+
+    @classmethod
+    def parse(cls, spec):
+        """CODEC[:LEVEL], i.e. zstd:3"""
+        name, _, level = spec.partition(':')
+        return cls(name, level or None)
+
+    @property
+    def extension(self):
+        return codec_extensions[self.name]
+
+    def __str__(self):
+        return self.name if self.name == 'none' else '{}:{}'.format(self.name, self.level)
+
+    def copy(self, src, dst):
+        """
+        Compress everything read from src into dst. Returns SHA-256 and size of the original bytes,
+        and SHA-256 of the bytes written to dst, both hashed in the same pass.
+        """
+        reader = HashingReader(src)
+        dst = HashingWriter(dst)
+        if self.name == 'none':
+            shutil.copyfileobj(reader, dst, copy_chunk_size)
+        elif self.command:
+            self._copy_external(reader, dst)
+        elif self.name == 'gzip':
+            with gzip.GzipFile(filename='', mode='wb', fileobj=dst, compresslevel=self.level, mtime=0) as gz:
+                shutil.copyfileobj(reader, gz, copy_chunk_size)
+        elif self.name == 'zstd':
+            self.module.ZstdCompressor(level=self.level, threads=-1).copy_stream(reader, dst)
+        elif self.name == 'lz4':
+            compressor = self.module.LZ4FrameCompressor(compression_level=self.level)
+            dst.write(compressor.begin())
+            for chunk in iter(lambda: reader.read(copy_chunk_size), b''):
+                dst.write(compressor.compress(chunk))
+            dst.write(compressor.flush())
+        return reader.sha256.hexdigest(), reader.size, dst.sha256.hexdigest()
+
+    def _copy_external(self, reader, dst):
+        # A thread feeds the compressor stdin while its stdout is copied to dst
+        proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        errors = []
+
+        def feed():
+            try:
+                shutil.copyfileobj(reader, proc.stdin, copy_chunk_size)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                proc.stdin.close()
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        shutil.copyfileobj(proc.stdout, dst, copy_chunk_size)
+        feeder.join()
+        if proc.wait() != 0 or errors:
+            raise Exception('{} failed: {}'.format(self.command[0], errors or proc.returncode))
+
+    @staticmethod
+    def _import(module):
+        try:
+            return __import__(module, fromlist=['_'])
+        except ImportError:
+            return None
+
+
+# Codec of each artifact type, from --codec [TYPE=]CODEC[:LEVEL] specs (a spec without TYPE applies to all)
+def parse_codecs(specs, compress=True):
+    codecs = {t: Codec(codec_default if compress else 'none') for t in artifact_codec_types}
+    for spec in specs:
+        kind, _, codec = spec.rpartition('=')
+        for t in ([kind] if kind else artifact_codec_types):
+            if t not in codecs:
+                raise ValueError('Unknown artifact type in codec {}, expected one of {}'.format(spec, artifact_codec_types))
+            codecs[t] = Codec.parse(codec)
+    return codecs
+
+
+class EvidenceArchive:
+    """
+    Final evidence archive, built in one streaming pass.
+    It is an uncompressed tar in which every artifact is written exactly once, as soon as
+    it is produced. Each member is either compressed on its own with its Codec (name ends with the
+    codec extension) or stored as is, so already compressed data is never compressed again.
+    Compression runs in the collection workers, only appending to the tar is serialized.
+    The SHA-256 of the original content of every member, and of what is stored in the tar, are
+    computed while it is copied, and close() writes <archive>.index.json with the hashes and byte
+    range of each member, so the orchestrator can pick single members (or skip the ones it already
+    has) without reading the tar, and check what it uploads against it.
+    The index is also the chain of custody record of the collection: info (host, collector, times)
+    and, per member, the artifact (what was read or run) it comes from.
+    Every member and artifact result is also appended to <archive>.journal as soon as it is written,
+    so a collection that was interrupted can go on with the same archive (resume=True) instead of
+    starting over. The journal is locked while the archive is open, a second collector on the same
+    archive waits for the first one to exit.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.members = []
+        self.info = {}
+        self.results = []  # Artifact results restored from the journal (resume)
+        self.state = {}  # Incremental state of the FILE artifacts restored from the journal (resume)
+        self.journal = open(path + archive_journal_extension, 'a')
+        fcntl.flock(self.journal, fcntl.LOCK_EX)
+        if resume and os.path.exists(path):
+            self._restore()
+        else:
+            self.journal.truncate(0)
+            self.f = open(path, 'wb')
+
+    def add_stream(self, arcname, src, codec=None, st=None, spool=True, timeout=None):
+        """
+        Copy src (binary file object) into the archive as arcname, compressed with codec (None: stored as is).
+        spool=True produces the member outside the archive lock (parallel friendly).
+        spool=False writes it straight into the archive, holding the lock, and patches the
+        tar header when the size is known (large members like the memory image).
+        The copy stops after timeout seconds: the member is ended with what was read until then
+        and TimeoutExpired is raised (its output is the member name), as in add_process.
+        """
+        if timeout is None:
+            return self._add_stream(arcname, src, codec, st, spool)
+        reader = DeadlineReader(src, time.time() + timeout)
+        member = self._add_stream(arcname, reader, codec, st, spool)
+        if reader.expired:
+            raise subprocess.TimeoutExpired(arcname, timeout, output=member['name'])
+        return member
+
+    def _add_stream(self, arcname, src, codec, st, spool):
+        codec = codec or Codec('none')
+        arcname += codec.extension
+        if spool:
+            with tempfile.SpooledTemporaryFile(max_size=spool_max_size, dir=working_path) as tmp:
+                sha256, original_size, stored_sha256 = codec.copy(src, tmp)
+                size = tmp.tell()
+                tmp.seek(0)
+                with self.lock:
+                    offset = self.f.tell()
+                    self.f.write(self._header(arcname, size, st))
+                    data_offset = self.f.tell()
+                    shutil.copyfileobj(tmp, self.f, copy_chunk_size)
+                    self._pad(size)
+                    return self._register(arcname, offset, data_offset, size, sha256, original_size, stored_sha256, codec)
+        else:
+            with self.lock:
+                offset = self.f.tell()
+                header_len = len(self._header(arcname, 0, st))
+                self.f.write(b'\0' * header_len)
+                data_offset = self.f.tell()
+                sha256, original_size, stored_sha256 = codec.copy(src, self.f)
+                size = self.f.tell() - data_offset
+                # Header length doesn't depend on size in GNU format, so it can be rewritten in place
+                self.f.seek(offset)
+                self.f.write(self._header(arcname, size, st))
+                self.f.seek(data_offset + size)
+                self._pad(size)
+                return self._register(arcname, offset, data_offset, size, sha256, original_size, stored_sha256, codec)
+
+    def add_process(self, arcname, proc, codec=None, timeout=None, reader=None):
+        """
+        Stream the stdout of a running process (through reader(stdout), if any) into the archive.
+        The process is killed on timeout, what it wrote until then is kept (TimeoutExpired.output is the member name).
+        """
+        killed = []
+        timer = threading.Timer(timeout, lambda: (killed.append(True), kill_process_group(proc))) if timeout else None
+        artifact_processes.add(proc)
+        if timer:
+            timer.start()
+        try:
+            member = self.add_stream(arcname, reader(proc.stdout) if reader else proc.stdout, codec)
+        finally:
+            if timer:
+                timer.cancel()
+            proc.stdout.close()
+            proc.wait()
+            artifact_processes.discard(proc)
+        if killed:
+            raise subprocess.TimeoutExpired(proc.args, timeout, output=member['name'])
+        return member
+
+    def add_file(self, arcname, path, codec=None, start=0, end=None, timeout=None):
+        """Add a regular file, or its [start, end) byte range, keeping its original metadata (mode, owner, mtime). Same timeout as add_stream"""
+        st = os.stat(path)
+        with open(path, 'rb') as src:
+            if start or end is not None:
+                src.seek(start)
+                src = FileRange(src, (st.st_size if end is None else end) - start)
+            # Uncompressed copies are I/O bound, write them straight away
+            return self.add_stream(arcname, src, codec, st, spool=bool(codec and codec.name != 'none'), timeout=timeout)
+
+    def annotate(self, results):
+        """Record in the index the artifact each member comes from: what was read or run, outcome and times"""
+        artifacts = {r['output']: r for r in results if r and r.get('output')}
+        with self.lock:
+            for m in self.members:
+                if m['name'] in artifacts:
+                    m['artifact'] = {k: artifacts[m['name']].get(k) for k in ('name', 'type', 'target', 'status', 'started_at', 'seconds')}
+
+    def remove_source(self, path):
+        """Remove a collected file from the host, once its member is in the archive"""
+        os.remove(path)
+
+    def record_result(self, result, state=None):
+        """Journal an artifact as done, with its incremental state if it has one"""
+        with self.lock:
+            self._journal({'result': result, 'state': state})
+
+    def record_info(self):
+        with self.lock:
+            self._journal({'info': self.info})
+
+    def close(self):
+        with self.lock:
+            self.f.write(b'\0' * (tarfile.BLOCKSIZE * 2))
+            self.f.close()
+            with open(self.path + '.index.json', 'w') as f:
+                json.dump({'archive': os.path.basename(self.path), 'collection': self.info, 'members': self.members}, f, indent=2, default=str)
+            self.journal.close()
+
+    def _journal(self, entry):
+        # One line per entry, written at once and flushed: a line cut by an interruption is the last one
+        self.journal.write(json.dumps(entry, default=str) + '\n')
+        self.journal.flush()
+
+    def _restore(self):
+        """
+        Reopen the archive of an interrupted collection. Members are kept up to the first one whose
+        artifact was not reported done (or failed with ERROR), the archive is cut right after it and
+        the journal rewritten with what was kept. The artifacts left out are collected again.
+        """
+        members, results, info = [], [], {}
+        with open(self.path + archive_journal_extension) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if 'member' in entry:
+                    members.append(entry['member'])
+                elif 'result' in entry and entry['result']['status'] != 'ERROR':
+                    results.append(entry)
+                elif 'info' in entry:
+                    info = entry['info']
+        outputs = {e['result']['output'] for e in results if e['result']['output']}
+        for m in members:
+            if m['name'] not in outputs:
+                break
+            self.members.append(m)
+        kept = {m['name'] for m in self.members}
+        results = [e for e in results if not e['result']['output'] or e['result']['output'] in kept]
+        end = 0
+        if self.members:
+            last = self.members[-1]
+            end = last['data_offset'] + last['size'] + (-last['size'] % tarfile.BLOCKSIZE)
+        self.f = open(self.path, 'r+b')
+        self.f.truncate(end)
+        self.f.seek(end)
+        self.info = info
+        self.results = [e['result'] for e in results]
+        self.state = {e['result']['target']: e['state'] for e in results if e['state']}
+        self.journal.truncate(0)
+        for entry in [{'info': info}] + [{'member': m} for m in self.members] + results:
+            self._journal(entry)
+        print('>> Resuming {}: {} members kept ({} bytes), {} artifacts already collected.'.format(self.path, len(self.members), end, len(self.results)))
+
+    def _header(self, arcname, size, st=None):
+        info = tarfile.TarInfo(arcname)
+        info.size = size
+        info.mtime = int(st.st_mtime) if st else int(time.time())
+        info.mode = (st.st_mode & 0o7777) if st else 0o644
+        if st:
+            info.uid, info.gid = st.st_uid, st.st_gid
+        return info.tobuf(tarfile.GNU_FORMAT)
+
+    def _pad(self, size):
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self.f.write(b'\0' * (tarfile.BLOCKSIZE - remainder))
+
+    def _register(self, arcname, offset, data_offset, size, sha256, original_size, stored_sha256, codec):
+        member = {'name': arcname, 'offset': offset, 'data_offset': data_offset, 'size': size,
+                  'sha256': sha256, 'original_size': original_size, 'stored_sha256': stored_sha256,
+                  'compressed': codec.name != 'none', 'codec': str(codec), 'added_at': round(time.time(), 3)}
+        self.members.append(member)
+        # Data goes to the file before the journal says it is there
+        self.f.flush()
+        self._journal({'member': member})
+        return member
+
+
+class EvidenceStream(EvidenceArchive):
+    """
+    Evidence archive written as a stream of frames to out (stdout, --stream-output) instead of a tar
+    in working_path, so nothing is staged on the instance and the orchestrator uploads every member
+    while the collection is still running. Each frame is stream_frame (kind, member id, payload length)
+    and its payload. A member is a B frame (name and metadata), D frames with its stored bytes as they
+    are compressed, and an E frame with its index entry (sizes and hashes). Members of concurrent
+    workers are interleaved, each one has its own id. close() sends the archive index in an I frame.
+    Nothing is journaled, a streamed collection is not resumed. Collected files are not removed from
+    the host: their paths go in the index (sources_to_remove) and the orchestrator removes them once
+    their members are in S3, a stream can still be lost on its way.
+    """
+
+    def __init__(self, out, name):
+        self.out = out
+        self.path = name
+        self.lock = threading.Lock()
+        self.members = []
+        self.info = {}
+        self.results = []
+        self.state = {}
+        self.sources = []
+        self.next_id = 0
+
+    def _add_stream(self, arcname, src, codec, st, spool):
+        # Into the stream instead of the tar, spool is ignored: nothing is spooled
+        codec = codec or Codec('none')
+        arcname += codec.extension
+        with self.lock:
+            member_id = self.next_id
+            self.next_id += 1
+            self._frame(b'B', member_id, {'name': arcname, 'mtime': int(st.st_mtime) if st else int(time.time()),
+                                          'mode': (st.st_mode & 0o7777) if st else 0o644, 'codec': str(codec)})
+        writer = FrameWriter(self, member_id)
+        sha256, original_size, stored_sha256 = codec.copy(src, writer)
+        writer.flush()
+        with self.lock:
+            member = {'name': arcname, 'size': writer.size, 'sha256': sha256, 'original_size': original_size, 'stored_sha256': stored_sha256,
+                      'compressed': codec.name != 'none', 'codec': str(codec), 'added_at': round(time.time(), 3)}
+            self.members.append(member)
+            self._frame(b'E', member_id, member)
+            return member
+
+    def remove_source(self, path):
+        with self.lock:
+            self.sources.append(path)
+
+    def close(self):
+        with self.lock:
+            self._frame(b'I', 0, {'archive': self.path, 'collection': self.info, 'members': self.members, 'sources_to_remove': self.sources})
+
+    def _journal(self, entry):
+        # Nothing is kept on the instance
+        pass
+
+    def _frame(self, kind, member_id, payload):
+        # Holding the lock. Flushed at once, the orchestrator follows the collection with it
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload, default=str).encode('utf-8')
+        self.out.write(stream_frame.pack(kind, member_id, len(payload)))
+        self.out.write(payload)
+        self.out.flush()
+
+
+class FrameWriter:
+    """Stored bytes of a member of an EvidenceStream, sent in D frames of copy_chunk_size"""
+
+    def __init__(self, stream, member_id):
+        self.stream = stream
+        self.member_id = member_id
+        self.buffer = bytearray()
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= copy_chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            with self.stream.lock:
+                self.stream._frame(b'D', self.member_id, bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+# Kill a command started in its own session and everything it started (a child keeping stdout open would hang the collection)
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class FileRange:
+    """Read only size bytes of an open file from its current position (a log keeps growing while it is read)"""
+
+    def __init__(self, f, size):
+        self.f = f
+        self.left = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.f.read(n)
+        self.left -= len(data)
+        return data
+
+
+class DeadlineReader:
+    """Read a stream until deadline (time.time() value). expired is set when it stopped there, the copy ends as on EOF"""
+
+    def __init__(self, f, deadline):
+        self.f = f
+        self.deadline = deadline
+        self.expired = False
+
+    def read(self, n=-1):
+        if not self.expired and time.time() >= self.deadline:
+            self.expired = True
+        if self.expired:
+            return b''
+        return self.f.read(n if n is not None and n >= 0 else copy_chunk_size)
+
+
+class CollectionBudget:
+    """
+    Global size (original bytes) and time budgets of a collection, shared by the workers (None: no limit).
+    Bytes are taken from it as they are read, so concurrent artifacts never go over the size budget.
+    """
+
+    def __init__(self, max_bytes=None, max_seconds=None):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.deadline = time.time() + max_seconds if max_seconds else None
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        # Bytes granted out of n
+        with self.lock:
+            if self.max_bytes is not None:
+                n = max(0, min(n, self.max_bytes - self.used_bytes))
+            self.used_bytes += n
+            return n
+
+    def remaining_bytes(self):
+        return None if self.max_bytes is None else self.max_bytes - self.used_bytes
+
+    def remaining_seconds(self):
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def report(self):
+        return {'max_bytes': self.max_bytes, 'max_seconds': self.max_seconds, 'used_bytes': self.used_bytes}
+
+
+class BudgetReader:
+    """Read a stream up to limit bytes (None: no limit) taken from the budget. cut is set when it stopped before EOF"""
+
+    def __init__(self, f, budget, limit=None):
+        self.f = f
+        self.budget = budget
+        self.limit = limit
+        self.size = 0
+        self.cut = None
+
+    def wrap(self, f):
+        # Same limits on a stream opened later (stdout of a process)
+        self.f = f
+        return self
+
+    def read(self, n=-1):
+        if self.cut:
+            return b''
+        data = self.f.read(n if n is not None and n >= 0 else copy_chunk_size)
+        allowed = len(data) if self.limit is None else min(len(data), self.limit - self.size)
+        granted = self.budget.take(allowed)
+        if granted < len(data):
+            self.cut = 'artifact max_bytes' if granted == allowed and allowed < len(data) else 'size budget'
+            data = data[:granted]
+        self.size += len(data)
+        return data
+
+
+# Install necessary SO packages to build LiME
 def install_packages():
     print('>> Installing SO packages...')
     cmds = [['sudo', 'yum', 'install', 'git', '-y'],
@@ -40,72 +615,916 @@ def install_packages():
         print("[ERROR] Couldn't install packages. Only RHEL type Linux allowed.")
 
 
-# Memory dump
-def do_memory_dump():
+# Get LiME source and build the kernel module for the running kernel.
+# Returns the path of the module. Leaves the cwd in the LiME src directory.
+def build_lime_module():
+    mem_dump_cmd = ['git', 'clone', 'https://github.com/504ensicsLabs/LiME', memdump_path]
+    res = subprocess.run(mem_dump_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    os.chdir(memdump_path + 'src')
+    print('   loading kernel module...')
+    res = subprocess.run('make', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return os.path.abspath(glob('lime-*.ko')[0])
+
+
+# LiME module to load. A prebuilt module for this kernel release (lime-<uname -r>.ko) is pushed
+# by the orchestrator from its S3 cache when there is one. Otherwise packages are installed and
+# the module is built, then left in working_path with that name for the orchestrator to quarantine it.
+def get_lime_module():
+    module = working_path + 'lime-' + os.uname().release + '.ko'
+    if os.path.exists(module):
+        print('   using prebuilt LiME module ' + module)
+        return module
+
+    print('   no prebuilt LiME module for kernel {}, building it...'.format(os.uname().release))
+    install_packages()
+    orig_cwd = os.getcwd()
+    try:
+        shutil.copy(build_lime_module(), module)
+    finally:
+        os.chdir(orig_cwd)
+        shutil.rmtree(memdump_path, ignore_errors=True)
+    return module
+
+
+# Size of the memory image: the replayed image, or MemTotal
+def memory_size():
+    if memory_image:
+        return os.path.getsize(memory_image)
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+# Memory dump. It is skipped when the image doesn't fit in what is left of the size budget, and
+# the image read stops after timeout seconds (what is left of the time budget), keeping what was read
+def do_memory_dump(archive, codec=None, budget=None, timeout=None):
     print('\n>> Performing memory dump...')
+    start = time.time()
+    deadline = start + timeout if timeout is not None else float('inf')
+    result = {'name': 'MemoryDump', 'type': 'memory', 'target': memory_image or 'LiME', 'output': 'memory_dump.mem', 'status': 'ERROR', 'cut': None, 'started_at': round(start, 3)}
+    budget = budget or CollectionBudget()
+    size = memory_size()
+    if budget.remaining_bytes() is not None and size > budget.remaining_bytes():
+        print('   ! Memory dump skipped: {} bytes of memory, {} bytes left in the size budget.'.format(size, budget.remaining_bytes()))
+        return dict(result, status='SKIPPED', seconds=0, cut={'reason': 'size budget', 'original_bytes': size, 'collected_bytes': 0})
+    if memory_image:
+        print('   adding memory image {} to the evidence archive...'.format(memory_image))
+        with open(memory_image, 'rb') as mem:
+            reader = BudgetReader(mem, budget)
+            limiter = DeadlineReader(reader, deadline)
+            result['output'] = archive.add_stream('memory_dump.mem', limiter, codec, spool=False)['name']
+        cut = memory_dump_cut(reader, limiter, size)
+        if cut:
+            return dict(result, status='TRUNCATED', seconds=round(time.time() - start, 3), cut=cut)
+        return dict(result, status='OK', seconds=round(time.time() - start, 3))
     orig_cwd = os.getcwd()
-    mem_dump_cmd = ['git', 'clone', 'https://github.com/504ensicsLabs/LiME', memdump_path]
     try:
-        res = subprocess.run(mem_dump_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        os.chdir(memdump_path + 'src')
-        print('   loading kernel module...')
-        res = subprocess.run('make', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        module = get_lime_module()
         print('   dumping Memory...')
-        cmd = "insmod " + glob('lime-*.ko')[0] + " 'path=" + working_path + "memory_dump.mem format=lime'"
-        #print(cmd)
-        res = subprocess.run(cmd, shell=True)
-        print('   compressing memory image...')
-        res = subprocess.run(['tar', '-czf', working_path + 'memory_dump.mem.tar.gz', working_path + 'memory_dump.mem'], stdout=None, stderr=subprocess.PIPE)
-        os.remove(working_path+'memory_dump.mem')
-        shutil.rmtree(memdump_path)
+        if isinstance(archive, EvidenceStream):
+            # Nothing on the instance disk: the image goes from LiME to the stream as it is dumped
+            insmod, sock = lime_tcp_connect(module)
+            with sock, sock.makefile('rb') as mem:
+                reader = BudgetReader(mem, budget)
+                limiter = DeadlineReader(reader, deadline)
+                result['output'] = archive.add_stream('memory_dump.mem', limiter, codec)['name']
+            insmod.wait()
+        else:
+            cmd = "insmod " + module + " 'path=" + working_path + "memory_dump.mem format=lime'"
+            #print(cmd)
+            res = subprocess.run(cmd, shell=True)
+            print('   adding memory image to the evidence archive...')
+            with open(working_path + 'memory_dump.mem', 'rb') as mem:
+                reader = BudgetReader(mem, budget)
+                limiter = DeadlineReader(reader, deadline)
+                result['output'] = archive.add_stream('memory_dump.mem', limiter, codec, spool=False)['name']
+            os.remove(working_path+'memory_dump.mem')
         #res = subprocess.run(['make', 'clean'])
+        result['cut'] = memory_dump_cut(reader, limiter, size)
+        result['status'] = 'TRUNCATED' if result['cut'] else 'OK'
         print('   Memory dump complete!')
     except:
         print('   ! Error performing memory dump.')
     # Remove loaded kernel module, to return to initial state     
+    unload_lime()
+    os.chdir(orig_cwd)
+    return dict(result, seconds=round(time.time() - start, 3))
+
+
+# What was cut from the memory image: by the size budget (BudgetReader) or the time budget (DeadlineReader)
+def memory_dump_cut(reader, limiter, size):
+    if reader.cut or limiter.expired:
+        reason = reader.cut or 'time budget'
+        print('   ! Memory dump cut ({}): {} of {} bytes kept.'.format(reason, reader.size, size))
+        return {'reason': reason, 'original_bytes': size, 'collected_bytes': reader.size}
+    return None
+
+
+# Load LiME serving the memory image on lime_tcp_port. Returns the insmod process and the connection the image is read from.
+# The port is firewalled to loopback first: the host can still be on the network, and whoever
+# connects first gets the whole image. No firewall rule, no dump.
+def lime_tcp_connect(module):
+    res = subprocess.run(['iptables', '-I'] + lime_tcp_rule, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        raise Exception('LiME port {} could not be firewalled to loopback: {}'.format(lime_tcp_port, res.stderr.decode(errors='replace').strip()))
+    insmod = subprocess.Popen(['insmod', module, 'path=tcp:{}'.format(lime_tcp_port), 'format=lime'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # LiME starts listening once the module is loaded, retry until it accepts the connection
+    for attempt in range(60):
+        try:
+            return insmod, socket.create_connection(('127.0.0.1', lime_tcp_port))
+        except ConnectionRefusedError:
+            if insmod.poll() is not None:
+                raise Exception('insmod exited: ' + insmod.stderr.read().decode(errors='replace'))
+            time.sleep(0.5)
+    raise Exception('LiME is not listening on port {}'.format(lime_tcp_port))
+
+
+# Remove the LiME module and the firewall rule of its port, to return to initial state
+def unload_lime():
     try:
-        res = subprocess.run(['rmmod', 'lime'], stdout=None, stderr=subprocess.PIPE)
+        subprocess.run(['rmmod', 'lime'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Every copy of the rule, none when the dump was not streamed
+        while subprocess.run(['iptables', '-D'] + lime_tcp_rule, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            pass
     except:
         pass
+
+
+# Diskless memory dump: LiME serves the image on a local TCP port and it is copied
+# as is to out (stdout), so the memory image never touches the instance disk.
+# Compression and upload are done by the orchestrator at the other end of the SSH channel.
+def stream_memory_dump(out):
+    print('\n>> Performing memory dump to stdout...')
+    if memory_image:
+        with open(memory_image, 'rb') as mem:
+            shutil.copyfileobj(mem, out, copy_chunk_size)
+        out.flush()
+        print('   Memory image {} sent.'.format(memory_image))
+        return True
+    orig_cwd = os.getcwd()
+    ok = False
+    try:
+        module = get_lime_module()
+        print('   dumping Memory...')
+        insmod, sock = lime_tcp_connect(module)
+        with sock:
+            copied = 0
+            while True:
+                data = sock.recv(copy_chunk_size)
+                if not data:
+                    break
+                out.write(data)
+                copied += len(data)
+        out.flush()
+        insmod.wait()
+        print('   Memory dump complete! {} bytes sent.'.format(copied))
+        ok = True
+    except Exception as e:
+        print('   ! Error performing memory dump: ' + str(e))
+    # Remove loaded kernel module, to return to initial state
+    unload_lime()
     os.chdir(orig_cwd)
+    return ok
+
+
+# PROC artifacts: the kernel view of processes, open files, sockets, mounts and modules, read
+# straight from /proc by the collector itself. No external binary is run (they can be missing or
+# trojaned on the host), and everything is taken in one pass, as close in time as possible.
+def read_proc(path, binary=False):
+    # None when it is not there or not readable (a process can exit while it is read)
+    try:
+        with open(path, 'rb' if binary else 'r', errors=None if binary else 'replace') as f:
+            return f.read()
+    except OSError:
+        return None
 
 
-# Collect files and process output detailed in artifacs.json
-def collect_forensic_evidence():
+def readlink_proc(path):
+    try:
+        return os.readlink(path)
+    except OSError:
+        return None
+
+
+# Process of /proc/<pid>, None if it is gone. Its open file descriptors too, if with_fds
+def proc_process(pid, boot_time, with_fds):
+    base = '{}/{}/'.format(proc_path, pid)
+    stat = read_proc(base + 'stat')
+    if not stat:
+        return None
+    # comm can have spaces and parentheses, the other fields come after the last ')'
+    fields = stat[stat.rindex(')') + 2:].split()
+    status = dict(line.split(':', 1) for line in (read_proc(base + 'status') or '').splitlines() if ':' in line)
+    cmdline = read_proc(base + 'cmdline', binary=True) or b''
+    process = {'pid': pid,
+               'ppid': int(fields[1]),
+               'state': fields[0],
+               'comm': stat[stat.index('(') + 1:stat.rindex(')')],
+               'cmdline': [a.decode(errors='replace') for a in cmdline.split(b'\0')[:-1]],
+               'exe': readlink_proc(base + 'exe'),
+               'cwd': readlink_proc(base + 'cwd'),
+               'root': readlink_proc(base + 'root'),
+               'uid': [int(u) for u in status['Uid'].split()] if 'Uid' in status else None,
+               'gid': [int(g) for g in status['Gid'].split()] if 'Gid' in status else None,
+               'threads': int(fields[17]),
+               'start_time': round(boot_time + int(fields[19]) / os.sysconf('SC_CLK_TCK'), 2),
+               'rss_bytes': int(fields[21]) * os.sysconf('SC_PAGE_SIZE')}
+    if with_fds:
+        try:
+            fds = sorted(os.listdir(base + 'fd'), key=int)
+        except OSError:
+            fds = []
+        process['fds'] = [{'fd': int(fd), 'target': readlink_proc(base + 'fd/' + fd)} for fd in fds]
+    return process
+
+
+# Address of /proc/net tables: hex IP in host (little endian) 32 bit words, and hex port
+def decode_proc_address(address):
+    ip, port = address.split(':')
+    raw = bytes.fromhex(ip)
+    raw = b''.join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    return {'ip': socket.inet_ntop(socket.AF_INET if len(raw) == 4 else socket.AF_INET6, raw), 'port': int(port, 16)}
+
+
+# Sockets of every /proc/net table, with the pids holding them (from their open file descriptors)
+def proc_sockets(owners):
+    sockets = []
+    for table in socket_tables:
+        for line in (read_proc('{}/net/{}'.format(proc_path, table)) or '').splitlines()[1:]:
+            f = line.split()
+            if table == 'unix':
+                # Num RefCount Protocol Flags Type St Inode [Path]
+                inode = int(f[6])
+                sockets.append({'table': table, 'type': int(f[4], 16), 'state': int(f[5], 16), 'inode': inode,
+                                'path': f[7] if len(f) > 7 else None, 'pids': owners.get(inode, [])})
+            else:
+                # sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode
+                inode = int(f[9])
+                sockets.append({'table': table, 'local': decode_proc_address(f[1]), 'remote': decode_proc_address(f[2]),
+                                'state': tcp_states.get(f[3], f[3]) if table.startswith('tcp') else f[3],
+                                'uid': int(f[7]), 'inode': inode, 'pids': owners.get(inode, [])})
+    return sockets
+
+
+def proc_mounts():
+    mounts = []
+    for line in (read_proc(proc_path + '/mounts') or '').splitlines():
+        device, mountpoint, fstype, options = line.split()[:4]
+        # Spaces and other special characters are octal escaped (\040)
+        unescape = lambda v: v.encode().decode('unicode_escape') if '\\' in v else v
+        mounts.append({'device': unescape(device), 'mountpoint': unescape(mountpoint), 'fstype': fstype, 'options': options.split(',')})
+    return mounts
+
+
+def proc_modules():
+    modules = []
+    for line in (read_proc(proc_path + '/modules') or '').splitlines():
+        f = line.split()
+        modules.append({'name': f[0], 'size': int(f[1]), 'instances': int(f[2]), 'used_by': [d for d in f[3].split(',') if d and d != '-'],
+                        'state': f[4], 'address': f[5] if len(f) > 5 else None, 'taints': f[6].strip('()') if len(f) > 6 else None})
+    return modules
+
+
+# One snapshot of the requested sections (proc_sections), as a JSON serializable dict
+def proc_snapshot(sections):
+    boot_time = next((int(line.split()[1]) for line in (read_proc(proc_path + '/stat') or '').splitlines() if line.startswith('btime ')), 0)
+    snapshot = {'taken_at': round(time.time(), 3), 'boot_time': boot_time, 'hostname': socket.gethostname(),
+                'kernel': os.uname().release, 'tainted': int((read_proc(proc_path + '/sys/kernel/tainted') or '0').strip())}
+    if 'processes' in sections or 'fds' in sections or 'sockets' in sections:
+        processes = []
+        for pid in sorted(int(d) for d in os.listdir(proc_path) if d.isdigit()):
+            process = proc_process(pid, boot_time, 'fds' in sections or 'sockets' in sections)
+            if process:
+                processes.append(process)
+        if 'processes' in sections:
+            snapshot['processes'] = processes
+        if 'sockets' in sections:
+            owners = {}
+            for process in processes:
+                for fd in process.get('fds', []):
+                    if fd['target'] and fd['target'].startswith('socket:['):
+                        owners.setdefault(int(fd['target'][8:-1]), []).append(process['pid'])
+            snapshot['sockets'] = proc_sockets(owners)
+        if 'fds' not in sections:
+            for process in processes:
+                process.pop('fds', None)
+    if 'mounts' in sections:
+        snapshot['mounts'] = proc_mounts()
+    if 'modules' in sections:
+        snapshot['modules'] = proc_modules()
+    return snapshot
+
+
+# FILE artifacts. All the patterns of all FILE artifacts are compiled once, and the filesystem is
+# walked once from their fixed roots: a directory shared by many patterns (or artifacts) is read
+# only once, and only directories where some pattern can still match are entered.
+# Patterns are globs: * ? [] within a path component, ** for any number of directories. A matched
+# directory brings the files below it. Optional per artifact in artifacs.json:
+#   "exclude": patterns not collected (an excluded directory is not walked)
+#   "max_depth": levels below a matched directory (1: only the files directly in it)
+#   "max_size": bytes, bigger files are not collected (they are listed in collection_summary.json)
+#   "max_age_days", "mtime_after", "mtime_before": modification time window (epoch seconds or ISO date)
+#   "follow_symlinks": follow links found below a matched directory. Links matched by a pattern
+#   are always followed, as glob does.
+def glob_component_regex(part):
+    regex, i = '', 0
+    while i < len(part):
+        c = part[i]
+        i += 1
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            j = i + 1 if part[i:i + 1] in ('!', '^') else i
+            j = part.find(']', j + 1 if part[j:j + 1] == ']' else j)
+            if j < 0:
+                regex += re.escape(c)
+            else:
+                chars = part[i:j]
+                regex += '[' + ('^' + chars[1:] if chars[:1] == '!' else chars).replace('\\', '\\\\') + ']'
+                i = j + 1
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+def compile_file_pattern(pattern):
+    parts = os.path.normpath(pattern).strip('/').split('/')
+    regex = ''
+    for n, part in enumerate(parts):
+        if part == '**':
+            regex += '.*' if n == len(parts) - 1 else '(?:[^/]+/)*'
+        else:
+            regex += glob_component_regex(part) + ('' if n == len(parts) - 1 else '/')
+    fixed = []
+    for part in parts:
+        if file_pattern_magic.search(part):
+            break
+        fixed.append(part)
+    return {'pattern': pattern,
+            'regex': re.compile('/' + regex + r'\Z', re.DOTALL),
+            'parts': [p if p == '**' else re.compile(glob_component_regex(p) + r'\Z', re.DOTALL) for p in parts],
+            'root': '/' + '/'.join(fixed)}
+
+
+# Whether something below the directory (path components) can match the pattern
+def pattern_leads_below(pattern, parts):
+    for n, part in enumerate(parts):
+        if n >= len(pattern['parts']):
+            return False
+        if pattern['parts'][n] == '**':
+            return True
+        if not pattern['parts'][n].match(part):
+            return False
+    return len(parts) < len(pattern['parts'])
+
+
+def parse_mtime(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+
+class FileSelector:
+    """
+    Compiled patterns and filters of one FILE artifact, with the files it selected during the walk
+    and a count of what its filters left out.
+    """
+    def __init__(self, art, now=None):
+        now = now or time.time()
+        self.name = art['name']
+        self.include = [compile_file_pattern(p) for p in art['attributes']]
+        self.exclude = [compile_file_pattern(p) for p in art.get('exclude', [])]
+        self.max_depth = art.get('max_depth')
+        self.max_size = art.get('max_size')
+        self.follow_symlinks = art.get('follow_symlinks', False)
+        after = [parse_mtime(art['mtime_after'])] if 'mtime_after' in art else []
+        if 'max_age_days' in art:
+            after.append(now - art['max_age_days'] * 86400)
+        self.mtime_after = max(after) if after else None
+        self.mtime_before = parse_mtime(art['mtime_before']) if 'mtime_before' in art else None
+        self.files = []  # (path, explicit: matched by a pattern, not only found in a matched directory)
+        self.left_out = {'excluded': 0, 'mtime': 0, 'symlinks': 0, 'max_size': []}
+
+    def matches(self, path):
+        return any(p['regex'].match(path) for p in self.include)
+
+    def excluded(self, path):
+        return any(p['regex'].match(path) for p in self.exclude)
+
+    def leads_below(self, parts):
+        return any(pattern_leads_below(p, parts) for p in self.include)
+
+    def select(self, path, st, explicit):
+        if self.max_size is not None and st.st_size > self.max_size:
+            self.left_out['max_size'].append({'path': path, 'size': st.st_size})
+        elif (self.mtime_after is not None and st.st_mtime < self.mtime_after) or (self.mtime_before is not None and st.st_mtime >= self.mtime_before):
+            self.left_out['mtime'] += 1
+        else:
+            self.files.append((path, explicit))
+
+    def report(self):
+        return dict(self.left_out, name=self.name, files=len(self.files))
+
+
+# Single walk for all the FILE selectors. Entries are read with os.scandir (no stat but for the
+# candidate files and the walked directories), directories are walked once even when links lead
+# to them again.
+def walk_file_artifacts(selectors):
+    roots = sorted(set(p['root'] for s in selectors for p in s.include))
+    roots = [r for r in roots if not any(o != r and r.startswith(o.rstrip('/') + '/') for o in roots)]
+    walked = set()
+    pending = [(root, None, {}) for root in reversed(roots)]
+    while pending:
+        path, entry, parent = pending.pop()
+        try:
+            link = entry.is_symlink() if entry else os.path.islink(path)
+            is_dir = entry.is_dir() if entry else os.path.isdir(path)
+            is_file = entry.is_file() if entry else os.path.isfile(path)
+        except OSError:
+            continue
+        parts = path.strip('/').split('/') if path != '/' else []
+        inside = {}
+        descend = False
+        for s in selectors:
+            depth = parent.get(s)
+            explicit = s.matches(path)
+            if depth is None and not explicit:
+                if is_dir and s.leads_below(parts):
+                    descend = True
+                continue
+            if s.exclude and s.excluded(path):
+                s.left_out['excluded'] += 1
+                continue
+            if explicit:
+                depth = 0
+            elif link and not s.follow_symlinks:
+                s.left_out['symlinks'] += 1
+                continue
+            if is_dir:
+                if s.max_depth is None or depth < s.max_depth:
+                    inside[s] = depth + 1
+                    descend = True
+            elif is_file:
+                try:
+                    s.select(path, entry.stat() if entry else os.stat(path), explicit)
+                except OSError:
+                    pass
+        if not (is_dir and descend):
+            continue
+        try:
+            st = os.stat(path)
+            if (st.st_dev, st.st_ino) in walked:
+                continue
+            walked.add((st.st_dev, st.st_ino))
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        for e in reversed(entries):
+            pending.append((os.path.join(path, e.name), e, inside))
+
+
+# Build the list of independent collection jobs from artifacs.json.
+# Every FILE match and every COMMAND is one job, output names only depend on artifact name and path.
+# "volatility", "priority" (higher first within a volatility class) and "max_bytes" per artifact
+# are kept in the jobs for schedule_collection_jobs and the size budget.
+def build_collection_jobs(artifacts, timeout, codecs, incremental=False, walk_report=None):
+    jobs = []
+    selectors = []
+    for order, art in enumerate(artifacts):
+        schedule = {'volatility': art.get('volatility', default_volatility.get(art['type'])),
+                    'priority': art.get('priority', 0),
+                    'max_bytes': art.get('max_bytes'),
+                    'order': order}
+        art_timeout = art.get('timeout', timeout)
+        art_codec = codecs.get(art['type'])
+        if 'codec' in art:
+            art_codec = Codec.parse(art['codec'])
+        elif art.get('compress') is not None:
+            art_codec = Codec(codec_default) if art['compress'] else Codec('none')
+        art_incremental = art.get('incremental', incremental)
+        if art['type'] == 'FILE':
+            selectors.append((FileSelector(art), dict(schedule, timeout=art_timeout, codec=art_codec, incremental=art_incremental)))
+
+        elif art['type'] == 'COMMAND':
+            jobs.append(dict(schedule,
+                             name=art['name'],
+                             type='COMMAND',
+                             target=art['attributes'],
+                             output=art['name'],
+                             timeout=art_timeout,
+                             codec=art_codec))
+
+        elif art['type'] == 'PROC':
+            sections = art['attributes'] or proc_sections
+            for section in sections:
+                if section not in proc_sections:
+                    print('   PROC section: ' + section + ' not recognized.')
+            jobs.append(dict(schedule,
+                             name=art['name'],
+                             type='PROC',
+                             target=[section for section in proc_sections if section in sections],
+                             output=art['name'] + '.json',
+                             timeout=art_timeout,
+                             codec=art_codec))
+
+        else:
+            print('   Artifact type: ' + art['type'] + ' not recognized.')
+
+    if selectors:
+        start = time.time()
+        walk_file_artifacts([s for s, _ in selectors])
+        for s, job in selectors:
+            # Files only found inside a matched directory are never removed from the host
+            jobs.extend(dict(job, name=s.name, type='FILE', target=path, output=s.name + '_' + path[1:].replace('/','_'), remove_source=explicit)
+                        for path, explicit in s.files)
+            if walk_report is not None:
+                walk_report.append(s.report())
+        print('   FILE walk: {} files selected in {:.2f}s.'.format(sum(len(s.files) for s, _ in selectors), time.time() - start))
+
+    return jobs
+
+
+# Collection order: volatility class (volatility_classes order, unknown classes last), then
+# priority, then artifacs.json order
+def schedule_collection_jobs(jobs):
+    def rank(job):
+        volatility = volatility_classes.index(job['volatility']) if job['volatility'] in volatility_classes else len(volatility_classes)
+        return volatility, -job['priority'], job['order']
+    return sorted(jobs, key=rank)
+
+
+# Incremental state of FILE artifacts: {path: {inode, dev, offset, head}}, head is the SHA-256
+# of the first bytes of the file, to tell a reused inode from the same file.
+def load_collection_state():
+    try:
+        with open(working_path + collection_state_filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def file_head_hash(path, size):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read(min(size, 4096))).hexdigest()
+
+
+def file_sha256(path):
+    try:
+        with open(path, 'rb') as f:
+            sha256 = hashlib.sha256()
+            for chunk in iter(lambda: f.read(copy_chunk_size), b''):
+                sha256.update(chunk)
+            return sha256.hexdigest()
+    except IOError:
+        return None
+
+
+# Byte range of a file not collected yet. The same file (same inode and first bytes, maybe rotated
+# under a new name) is collected from the offset reached last time, unless it shrank.
+# Anything else (new file, new rotated file, truncated file) is collected from the beginning.
+def incremental_range(path, st, previous):
+    for prev_path, prev in sorted(previous.items(), key=lambda i: i[0] != path):
+        if prev['inode'] == st.st_ino and prev['dev'] == st.st_dev:
+            if prev['offset'] <= st.st_size and prev['head'] == file_head_hash(path, min(prev['offset'], 4096)):
+                return prev['offset'], st.st_size
+            break
+    return 0, st.st_size
+
+
+# FILE job of a regular file. Incremental: only bytes appended since last collection are archived, as
+# <output>.<start>-<end>[.gz]. The full file is rebuilt concatenating, in offset order, the ranges
+# of the same inode (a rotated file changes name, collection_state.json of each run has its inode).
+# Over its max_bytes or the size budget, only the newest bytes (end of the file) are archived, also
+# named after their range. Returns the member name (None if nothing was archived) and what was cut.
+# A copy stopped by timeout raises TimeoutExpired, the incremental state then ends where the copy did.
+def collect_file(job, archive, state, budget, timeout=None):
+    st = os.stat(job['target'])
+    start, end = 0, st.st_size
+    if job.get('incremental'):
+        start, end = incremental_range(job['target'], st, state['previous'])
+        with state['lock']:
+            state['current'][job['target']] = {'inode': st.st_ino, 'dev': st.st_dev, 'offset': end,
+                                               'head': file_head_hash(job['target'], min(end, 4096))}
+        if start == end:
+            print('   FILE unchanged since last collection: ' + job['target'])
+            return None, None
+    size = end - start
+    allowed = size if job['max_bytes'] is None else min(size, job['max_bytes'])
+    granted = budget.take(allowed)
+    cut = None
+    if granted < size:
+        cut = {'reason': 'artifact max_bytes' if granted == allowed else 'size budget', 'original_bytes': size,
+               'collected_bytes': granted, 'range': [end - granted, end]}
+        print('   ! FILE {} cut ({}): last {} of {} bytes kept.'.format(job['target'], cut['reason'], granted, size))
+        if not granted:
+            return None, cut
+        start = end - granted
+    try:
+        if job.get('incremental') or cut:
+            return archive.add_file('{}.{}-{}'.format(job['output'], start, end), job['target'], job['codec'], start, end, timeout)['name'], cut
+        return archive.add_file(job['output'], job['target'], job['codec'], 0, end if budget.max_bytes is not None else None, timeout)['name'], None
+    except subprocess.TimeoutExpired as e:
+        if job.get('incremental'):
+            offset = start + member_original_size(archive, e.output)
+            with state['lock']:
+                state['current'][job['target']].update(offset=offset, head=file_head_hash(job['target'], min(offset, 4096)))
+        raise
+
+
+# Run one collection job, writing its output into the evidence archive.
+# Jobs are skipped once a budget is spent, and truncated when they would go over it
+# (the time left in the budget caps their timeout, commands and file and PROC copies alike).
+# Never raises, the outcome and what was cut are returned to build the summary
+def run_collection_job(job, archive, state=None, budget=None):
+    budget = budget or CollectionBudget()
+    start = time.time()
+    status = 'OK'
+    output = job['output']
+    cut = None
+    timeout = job['timeout']
+    left = budget.remaining_seconds()
+    if left is not None and left < (timeout or float('inf')):
+        timeout = left
+    try:
+        if left is not None and left <= 0:
+            status = 'SKIPPED'
+            cut = {'reason': 'time budget', 'collected_bytes': 0}
+            print('   ! Skipped (time budget spent): {} {}'.format(job['type'], str(job['target'])))
+        elif budget.remaining_bytes() is not None and budget.remaining_bytes() <= 0:
+            status = 'SKIPPED'
+            cut = {'reason': 'size budget', 'collected_bytes': 0}
+            print('   ! Skipped (size budget spent): {} {}'.format(job['type'], str(job['target'])))
+
+        elif job['type'] == 'memory':
+            result = do_memory_dump(archive, job['codec'], budget, timeout)
+            return dict(result, volatility=job['volatility'], priority=job['priority'])
+
+        elif job['type'] == 'FILE':
+            print('   Working on FILE: ' + job['target'])
+            output, cut = collect_file(job, archive, state, budget, timeout)
+            if cut:
+                status = 'TRUNCATED' if output else 'SKIPPED'
+            elif not output:
+                status = 'UNCHANGED'
+            elif job.get('remove_source') and not job.get('incremental'):
+                archive.remove_source(job['target'])
+
+        elif job['type'] == 'COMMAND':
+            print('   Working on COMMAND: ' + str(job['target']))
+            limiter = BudgetReader(None, budget, job['max_bytes'])
+            proc = subprocess.Popen(job['target'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, start_new_session=True)
+            output = archive.add_process(job['output'], proc, job['codec'], timeout, limiter.wrap)['name']
+            if limiter.cut:
+                status, cut = 'TRUNCATED', {'reason': limiter.cut, 'collected_bytes': limiter.size}
+
+        elif job['type'] == 'PROC':
+            print('   Working on PROC: ' + ', '.join(job['target']))
+            limiter = BudgetReader(io.BytesIO(json.dumps(proc_snapshot(job['target']), separators=(',', ':')).encode('utf-8')), budget, job['max_bytes'])
+            output = archive.add_stream(job['output'], limiter, job['codec'], timeout=timeout)['name']
+            if limiter.cut:
+                status, cut = 'TRUNCATED', {'reason': limiter.cut, 'collected_bytes': limiter.size}
+
+    except subprocess.TimeoutExpired as e:
+        output = e.output or output
+        if timeout != job['timeout']:
+            # Stopped by the time budget, what it produced until then is kept
+            status = 'TRUNCATED'
+            cut = {'reason': 'time budget', 'collected_bytes': member_original_size(archive, output)}
+            print('   ! Time budget spent on {}: {}'.format(job['type'], str(job['target'])))
+        else:
+            status = 'TIMEOUT'
+            print('   ! Timeout ({}s) on {}: {}'.format(job['timeout'], job['type'], str(job['target'])))
+    except Exception:
+        status = 'ERROR'
+        if job['type'] == 'FILE':
+            print('   ! Error copying or compressing FILE.')
+        else:
+            print('   ! Error executing command or compressing output.')
+
+    return {'name': job['name'],
+            'type': job['type'],
+            'target': job['target'],
+            'output': output,
+            'status': status,
+            'volatility': job['volatility'],
+            'priority': job['priority'],
+            'cut': cut,
+            'started_at': round(start, 3),
+            'seconds': round(time.time() - start, 3)}
+
+
+# Original bytes of a member of the archive (0 if it is not there)
+def member_original_size(archive, name):
+    return next((m['original_size'] for m in list(archive.members) if m['name'] == name), 0)
+
+
+# Size of what was collected, original and stored in the archive (the orchestrator reports it)
+def add_artifact_sizes(result, archive):
+    member = next((m for m in list(archive.members) if m['name'] == result['output']), None)
+    result['bytes'] = member['original_size'] if member else 0
+    result['stored_bytes'] = member['size'] if member else 0
+    return result
+
+
+# One line per artifact as soon as it is collected, the orchestrator reads them while the collection runs.
+# Written at once, so it is not split by messages of the other workers
+def report_artifact(result, archive):
+    sys.stdout.write(artifact_event_prefix + json.dumps(add_artifact_sizes(result, archive), default=str) + '\n')
+    sys.stdout.flush()
+
+
+# Print how long each artifact took and what was cut by the budgets, and save it in the evidence archive
+def write_collection_summary(results, elapsed, archive, budget=None, file_walk=None):
+    for r in results:
+        add_artifact_sizes(r, archive)
+    print('\n>> Collection summary ({} artifacts in {:.2f}s):'.format(len(results), elapsed))
+    for r in results:
+        print('   {:<9} {:>8.2f}s  {:<8} {}  {}'.format(r['status'], r['seconds'], r['volatility'] or '-', r['name'], r['output']))
+    cut = [r for r in results if r.get('cut')]
+    for r in cut:
+        print('   ! Cut ({}): {} {}, {} bytes kept'.format(r['cut']['reason'], r['name'], r['target'], r['cut']['collected_bytes']))
+    for w in file_walk or []:
+        if w['excluded'] or w['mtime'] or w['symlinks'] or w['max_size']:
+            print('   Left out of {}: {} excluded, {} out of mtime window, {} symlinks, {} over max_size'.format(
+                w['name'], w['excluded'], w['mtime'], w['symlinks'], len(w['max_size'])))
+
+    try:
+        summary = json.dumps({'elapsed_seconds': round(elapsed, 3), 'budget': budget.report() if budget else None,
+                              'cut': [{k: r[k] for k in ('name', 'type', 'target', 'output', 'status', 'cut')} for r in cut],
+                              'file_walk': file_walk or [],
+                              'artifacts': results}, indent=2, default=str).encode('utf-8')
+        archive.add_stream(collection_summary_filename, io.BytesIO(summary))
+    except Exception:
+        print('   ! Error writing ' + collection_summary_filename)
+
+
+# Hashes of size bytes of a file from offset, read here from disk: SHA-256 of all of them, of each window
+# of window_size bytes and of the stored bytes of every member of the archive index among them. The
+# orchestrator checks with them the parts a resumed upload sent before, instead of reading them again.
+def hash_archive_range(path, offset, size, window_size):
+    try:
+        with open(path + '.index.json') as f:
+            members = [m for m in json.load(f)['members'] if offset <= m['data_offset'] and m['data_offset'] + m['size'] <= offset + size]
+    except (IOError, ValueError):
+        members = []
+    digests = {m['name']: hashlib.sha256() for m in members}
+    sha256 = hashlib.sha256()
+    windows = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for start in range(offset, offset + size, window_size):
+            data = f.read(min(window_size, offset + size - start))
+            sha256.update(data)
+            windows.append(hashlib.sha256(data).hexdigest())
+            view = memoryview(data)
+            for m in members:
+                first, last = max(start, m['data_offset']), min(start + len(data), m['data_offset'] + m['size'])
+                if first < last:
+                    digests[m['name']].update(view[first - start:last - start])
+    return {'sha256': sha256.hexdigest(), 'windows': windows, 'members': {name: h.hexdigest() for name, h in digests.items()}}
+
+
+# Save the incremental state for the next collection, in working path (the orchestrator keeps it)
+# and in the evidence archive, next to the ranges it describes
+def write_collection_state(current, archive):
+    try:
+        data = json.dumps(current, indent=2, sort_keys=True)
+        with open(working_path + collection_state_filename, 'w') as f:
+            f.write(data)
+        archive.add_stream(collection_state_filename, io.BytesIO(data.encode('utf-8')))
+    except Exception:
+        print('   ! Error writing ' + collection_state_filename)
+
+
+# What identifies a job (or the result of one) between a collection and its resumption
+def collection_job_key(job):
+    return job['name'], job['type'], json.dumps(job['target'])
+
+
+# Collect files and process output detailed in artifacs.json, and the memory dump
+# Jobs start in order of volatility (schedule_collection_jobs) on a pool of workers. The memory
+# dump runs alone (it holds the archive while it is written): jobs before it, the dump, then the rest
+def collect_forensic_evidence(archive, codecs, workers=collection_workers, timeout=artifact_timeout, incremental=False, memory_dump=False, budget=None):
     # Load artifact list 
     print('\n>> Loading artifact list...')
     with open(artifacts_file) as f:
         artifacts = json.load(f)
 
     # Retrieve artifacts, and compress
-    print('>> Retrieving artifacts.')
-    for art in artifacts:
-        #print('Name: ' + art['name'] + ' Type: ' + art['type'] + ' Value: ' + str(art['attributes']) )
-        if art['type'] == 'FILE':
-            for p in art['attributes']:
-                for i in glob(p):
-                    print('   Working on FILE: ' + i)
-                    try:
-                        res = subprocess.run(['tar', '-czf', working_path + art['name']+ '_' + i[1:].replace('/','_') + '.tar.gz', i], stdout=None, stderr=subprocess.PIPE)
-                        os.remove(i)
-                    except:
-                        print('   ! Error copying or compressing FILE.')
+    file_walk = []
+    jobs = build_collection_jobs(artifacts, timeout, codecs, incremental, file_walk)
+    if memory_dump:
+        jobs.append({'name': 'MemoryDump', 'type': 'memory', 'target': memory_image or 'LiME', 'output': 'memory_dump.mem', 'timeout': None,
+                     'codec': codecs['memory'], 'volatility': 'memory', 'priority': 0, 'max_bytes': None, 'order': len(artifacts)})
+    jobs = schedule_collection_jobs(jobs)
+    budget = budget or CollectionBudget()
+    state = {'previous': load_collection_state(), 'current': dict(archive.state), 'lock': threading.Lock()}
+    # Resumed collection: artifacts done before the interruption are not collected again, and count in the size budget
+    if archive.results:
+        done = {collection_job_key(r) for r in archive.results}
+        jobs = [job for job in jobs if collection_job_key(job) not in done]
+        budget.take(sum(m['original_size'] for m in archive.members))
+        print('>> {} artifacts already collected before the interruption.'.format(len(archive.results)))
+    print('>> Retrieving {} artifacts with {} workers, in order of volatility ({}).'.format(len(jobs), workers, ', '.join(volatility_classes)))
+    start = time.time()
+    results = [None] * len(jobs)
+    memory = [n for n, job in enumerate(jobs) if job['type'] == 'memory']
+    batches = [range(memory[0]), memory, range(memory[0] + 1, len(jobs))] if memory else [range(len(jobs))]
+    for batch in batches:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(run_collection_job, jobs[n], archive, state, budget): n for n in batch}
+            for future in as_completed(futures):
+                # Keep the schedule order in the summary, whatever the completion order was
+                job = jobs[futures[future]]
+                results[futures[future]] = future.result()
+                report_artifact(results[futures[future]], archive)
+                archive.record_result(results[futures[future]], state['current'].get(job['target']) if job['type'] == 'FILE' else None)
+
+    results = archive.results + results
+    write_collection_summary(results, time.time() - start, archive, budget, file_walk)
+    archive.annotate(results)
+    if any(job.get('incremental') for job in jobs):
+        write_collection_state(state['current'], archive)
+    return results
+
 
-        elif art['type'] == 'COMMAND':
-            try:
-                cmd_file = working_path + art['name']
-                print('   Working on COMMAND: ' + str(art['attributes']))
-                c = open(cmd_file, 'w')
-                res = subprocess.run(art['attributes'], stdout=c, stderr=subprocess.PIPE)
-                c.close()
-                res = subprocess.run(['tar', '-czf', cmd_file + '.tar.gz', cmd_file], stdout=None, stderr=subprocess.PIPE)
-                os.remove(cmd_file)
-            except:
-                print('   ! Error executing command or compressing output.')
 
+# Synthetic data for the codec benchmark. Memory-like: 4KB pages, zeroed, random (encrypted or
+# compressed data), or structured (repeated records and pointers). Log-like: syslog lines.
+def synthetic_memory(size, rng):
+    pages = []
+    for n in range(size // 4096):
+        kind = rng.random()
+        if kind < 0.45:
+            pages.append(bytes(4096))
+        elif kind < 0.65:
+            pages.append(rng.getrandbits(4096 * 8).to_bytes(4096, 'little'))
         else:
-            print('   Artifact type: ' + art['type'] + ' not recognized.')
+            record = rng.getrandbits(48 * 8).to_bytes(48, 'little') + (0xffff880000000000 + rng.randrange(1 << 30)).to_bytes(8, 'little') + bytes(8)
+            pages.append(record * 64)
+    return b''.join(pages)
+
+
+def synthetic_logs(size, rng):
+    templates = ['sshd[{pid}]: Failed password for invalid user {user} from 203.0.113.{ip} port {port} ssh2',
+                 'sshd[{pid}]: Accepted publickey for ec2-user from 10.0.{ip}.{ip2} port {port} ssh2',
+                 'systemd[1]: Started Session {pid} of user {user}.',
+                 'kernel: [{port}.{pid}] IPv4: martian source 10.0.{ip}.{ip2} from 10.0.{ip2}.{ip}, on dev eth0',
+                 'CRON[{pid}]: (root) CMD (run-parts /etc/cron.hourly)']
+    users = ['root', 'admin', 'ec2-user', 'oracle', 'test', 'ubuntu']
+    lines = []
+    length = 0
+    t = 1600000000
+    while length < size:
+        t += rng.randrange(3)
+        line = time.strftime('%b %d %H:%M:%S', time.gmtime(t)) + ' ip-10-0-1-23 ' + rng.choice(templates).format(
+            pid=rng.randrange(1, 65535), user=rng.choice(users), ip=rng.randrange(256), ip2=rng.randrange(256), port=rng.randrange(1024, 65535)) + '\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines).encode()[:size]
+
 
+# Benchmark every codec available on this host (throughput and compression ratio), to choose codecs per artifact type
+def benchmark_codecs(size_mb):
+    import random
+    rng = random.Random(0)
+    size = size_mb * 1024 * 1024
+    print('>> Generating {} MB of synthetic memory-like and log-like data...'.format(size_mb))
+    samples = [('memory', synthetic_memory(size, rng)), ('logs', synthetic_logs(size, rng))]
+    specs = ['none', 'gzip:1', 'gzip:6', 'zstd:1', 'zstd:3', 'zstd:9', 'lz4:1', 'lz4:9']
+    results = []
+    print('\n   {:<10} {:<8} {:>10} {:>12} {:>8}'.format('Codec', 'Data', 'Seconds', 'MB/s', 'Ratio'))
+    for spec in specs:
+        codec = Codec.parse(spec)
+        if codec.name != spec.split(':')[0]:
+            continue  # Not available here, it fell back to gzip
+        for sample_name, data in samples:
+            out = io.BytesIO()
+            start = time.time()
+            codec.copy(io.BytesIO(data), out)
+            elapsed = time.time() - start
+            result = {'codec': str(codec), 'data': sample_name, 'seconds': round(elapsed, 3),
+                      'MBps': round(len(data) / 1048576 / elapsed, 1) if elapsed else 0,
+                      'ratio': round(len(data) / out.tell(), 2) if out.tell() else 0,
+                      'engine': codec.command[0] if codec.command else 'python'}
+            results.append(result)
+            print('   {:<10} {:<8} {:>10.3f} {:>12.1f} {:>8.2f}  ({})'.format(result['codec'], sample_name, elapsed, result['MBps'], result['ratio'], result['engine']))
+    return results
+
+
+# Aborted by the orchestrator (TERM to the collector process group): artifact commands running
+# in their own process groups are killed, and the LiME module unloaded
+def abort_collection(signum, frame):
+    print('   ! Aborted by signal {}.'.format(signum), flush=True)
+    for proc in list(artifact_processes):
+        kill_process_group(proc)
+    unload_lime()
+    os._exit(128 + signum)
 
 
 # Cleaning
@@ -127,6 +1546,17 @@ def do_cleaning():
 
 def main(params):
 
+    # Only hash a byte range of a file, for the orchestrator
+    if params['hash_range']:
+        path, offset, size, window_size = params['hash_range']
+        print(range_hashes_prefix + json.dumps(hash_archive_range(path, int(offset), int(size), int(window_size))))
+        return True
+
+    print(banner)
+    if params['benchmark_mb']:
+        benchmark_codecs(params['benchmark_mb'])
+        return True
+
     print("I'm going to do this:\n"+str(params).replace('\'','').replace('{', '').replace('}','').replace(',','\n')+'\n')
 
     # Create temp working directory if not exist
@@ -134,19 +1564,38 @@ def main(params):
         os.mkdir(working_path)
     #os.chdir(working_path)
 
-    # Install necessary SO packages
-    install_packages()
+    # Only stream the memory image through stdout, nothing else is collected in this mode
+    if params['memory_dump_stream']:
+        return stream_memory_dump(evidence_stream)
+
+    # Every artifact is written once into the final archive, as it is collected
+    # (resume: into the archive of an interrupted collection, after what it already has),
+    # or streamed to stdout as it is collected, without writing it to working_path
+    if params['stream_output']:
+        archive = EvidenceStream(evidence_stream, params['output_filename'])
+    else:
+        archive = EvidenceArchive(working_path + params['output_filename'], params['resume'])
 
-    # Execute memory dump
-    if params['memory_dump']:
-        do_memory_dump()
-    
-    # Get files and commands output
-    collect_forensic_evidence()
+    # Chain of custody: where, when and by what the evidence was collected (in the archive index)
+    archive.info.update(hostname=socket.gethostname(), kernel=os.uname().release, command_line=sys.argv,
+                        collector_sha256=file_sha256(os.path.abspath(__file__)), artifacts_sha256=file_sha256(artifacts_file))
+    if 'started_at' in archive.info:
+        archive.info.setdefault('resumed_at', []).append(round(time.time(), 3))
+    else:
+        archive.info['started_at'] = round(time.time(), 3)
+    archive.record_info()
+
+    # Get memory dump, files and commands output, in order of volatility and within the budgets
+    budget = CollectionBudget(params['size_budget'] * 1048576 if params['size_budget'] else None, params['time_budget'] or None)
+    collect_forensic_evidence(archive, params['codecs'], params['workers'], params['artifact_timeout'], params['incremental'], params['memory_dump'], budget)
 
     try:
-        res = subprocess.run(['tar', '-czf', working_path + params['output_filename'], working_path], stdout=None, stderr=subprocess.PIPE)
-        print('\n>> File ' + working_path + params['output_filename'] + ' contains all the collected evidence.')
+        archive.info['finished_at'] = round(time.time(), 3)
+        archive.close()
+        if params['stream_output']:
+            print('\n>> {} members of {} streamed.'.format(len(archive.members), params['output_filename']))
+        else:
+            print('\n>> File ' + working_path + params['output_filename'] + ' contains all the collected evidence.')
     except:
         print('   ! Error creating final ' + params['output_filename'])
 
@@ -155,6 +1604,7 @@ def main(params):
         do_cleaning()
 
     print('\nDone!\n')
+    return True
 
 
 # From command line arguments:
@@ -162,15 +1612,49 @@ if __name__=='__main__':
     my_parser = argparse.ArgumentParser()
     my_parser.add_argument('--no-memory-dump', required=False, dest='no_memory_dump', action='store_true', help='Do not execute memory dump. --> default: false (make memory dump)')
     my_parser.add_argument('--conserve-local-forensics', required=False, dest='conserve_forensics', action='store_true', help='Do not delete forensinc files gathered in destination server after finishing tasks. --> default: false (delete tmp files in remote server)')
-    my_parser.add_argument('--output-filename', required=False, dest='results_filename', type=str, default=packed_evidence_filename, help='Filename of the .tar.gz resultant forensics data gathered and memory dump. --> default: '+packed_evidence_filename)
+    my_parser.add_argument('--output-filename', required=False, dest='results_filename', type=str, default=packed_evidence_filename, help='Filename of the .tar resultant forensics data gathered and memory dump. --> default: '+packed_evidence_filename)
+    my_parser.add_argument('--workers', required=False, dest='workers', type=int, default=collection_workers, help='Number of artifacts collected at the same time. --> default: {} (number of CPUs)'.format(collection_workers))
+    my_parser.add_argument('--artifact-timeout', required=False, dest='artifact_timeout', type=int, default=artifact_timeout, help='Seconds allowed for each artifact before it is killed (COMMAND) or its copy stopped (FILE, PROC), what it collected until then is kept. --> default: {}'.format(artifact_timeout))
+    my_parser.add_argument('--no-compression', required=False, dest='no_compression', action='store_true', help='Store artifacts uncompressed inside the evidence archive, unless "compress" or "codec" is set per artifact in artifacs.json. --> default: false (each artifact is compressed)')
+    my_parser.add_argument('--codec', required=False, dest='codecs', type=str, action='append', default=[], help='Compression of archive members, as [TYPE=]CODEC[:LEVEL] with TYPE in {} and CODEC in {}. Can be repeated, i.e. --codec memory=zstd:1 --codec FILE=gzip:6. "codec" per artifact in artifacs.json overrides it. --> default: {}'.format(', '.join(artifact_codec_types), ', '.join(codec_extensions), codec_default))
+    my_parser.add_argument('--benchmark-codecs', required=False, dest='benchmark_mb', type=int, default=0, help='Only benchmark every codec on this many MB of synthetic memory-like and log-like data, and exit.')
+    my_parser.add_argument('--memory-dump-stream', required=False, dest='memory_dump_stream', action='store_true', help='Only do a memory dump, written raw to stdout instead of working path (messages go to stderr). The image is not written to disk, LiME port is firewalled to loopback while it is served. Without a prebuilt module, LiME is still built in working path. --> default: false')
+    my_parser.add_argument('--incremental', required=False, dest='incremental', action='store_true', help='FILE artifacts only collect bytes appended since the last collection recorded in ' + collection_state_filename + ', unless "incremental" is set per artifact in artifacs.json. --> default: false (full files)')
+    my_parser.add_argument('--memory-image', required=False, dest='memory_image', type=str, help='Take this raw memory image instead of dumping memory with LiME (replays and benchmarks). --> default: none (LiME dump)')
+    my_parser.add_argument('--size-budget', required=False, dest='size_budget', type=int, default=0, help='MB of original data collected at most, memory dump included. Artifacts that would go over it are truncated (files keep their newest bytes) or skipped. --> default: no limit')
+    my_parser.add_argument('--time-budget', required=False, dest='time_budget', type=int, default=0, help='Seconds allowed to the whole collection. Artifacts running then are stopped, the ones not started are skipped. --> default: no limit')
+    my_parser.add_argument('--resume', required=False, dest='resume', action='store_true', help='Go on with the archive of an interrupted collection with the same --output-filename (its ' + archive_journal_extension + ' file): artifacts already in it, memory dump included, are not collected again. --> default: false (new archive)')
+    my_parser.add_argument('--stream-output', required=False, dest='stream_output', action='store_true', help='Write the evidence archive to stdout as a stream of frames, each artifact as soon as it is collected, instead of ' + working_path + ' (messages go to stderr). The orchestrator uploads it while the collection runs. --> default: false (archive in working path)')
+    my_parser.add_argument('--hash-range', required=False, dest='hash_range', type=str, nargs=4, metavar=('FILE', 'OFFSET', 'SIZE', 'WINDOW'), help='Only print the SHA-256 of SIZE bytes of FILE from OFFSET, of each WINDOW bytes of them and of the members of its archive index among them (resumed uploads), and exit.')
     args = my_parser.parse_args()
+    if args.stream_output and args.resume:
+        my_parser.error('--resume needs the archive of the interrupted collection in working path, a streamed collection is not resumed')
+
+    signal.signal(signal.SIGTERM, abort_collection)
+    memory_image = args.memory_image
+    if args.memory_dump_stream or args.stream_output:
+        # stdout carries the memory image or the evidence stream, every message goes to stderr
+        evidence_stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
 
     argsh = { 
         'memory_dump': not args.no_memory_dump,
         'conserve_files': args.conserve_forensics,
-        'output_filename': args.results_filename
+        'output_filename': args.results_filename,
+        'workers': args.workers,
+        'artifact_timeout': args.artifact_timeout,
+        'codecs': parse_codecs(args.codecs, not args.no_compression),
+        'benchmark_mb': args.benchmark_mb,
+        'memory_dump_stream': args.memory_dump_stream,
+        'incremental': args.incremental,
+        'size_budget': args.size_budget,
+        'time_budget': args.time_budget,
+        'resume': args.resume,
+        'stream_output': args.stream_output,
+        'hash_range': args.hash_range
     } 
 
-    main(argsh)
+    if not main(argsh):
+        sys.exit(1)
 
 
@@ -6,6 +6,9 @@ data "aws_iam_policy_document" "containment_and_forensics_policy_document" {
         actions = [
             "s3:GetObject",
             "s3:PutObject",
+            "s3:DeleteObject",
+            "s3:AbortMultipartUpload",
+            "s3:ListMultipartUploadParts",
         ]
 
         resources = [
@@ -13,6 +16,19 @@ data "aws_iam_policy_document" "containment_and_forensics_policy_document" {
         ]
     }
 
+    statement {
+        sid = "tf4"
+        effect = "Allow"
+
+        actions = [
+            "s3:ListBucket",
+        ]
+
+        resources = [
+            "arn:aws:s3:::${var.forensics_S3_bucket_name}",
+        ]
+    }
+
     statement {
         sid = "tf2"
         effect = "Allow"
@@ -23,6 +39,9 @@ data "aws_iam_policy_document" "containment_and_forensics_policy_document" {
             "ec2:DescribeNetworkInterfaces",
             "ec2:CreateTags",
             "ec2:CreateSnapshot",
+            "ec2:CreateSnapshots",
+            "ec2:DescribeSnapshots",
+            "ec2:DescribeImages",
             "ec2:DeleteNetworkInterface",
             "ec2:CreateImage",
             "ec2:ModifyInstanceAttribute",
@@ -62,16 +81,44 @@ data "aws_iam_policy_document" "containment_and_forensics_assume_policy_document
 
 
 
+# Every lambda package has its handler and forensicsCommon.py, the code shared by the lambdas and the command line script
 data "archive_file" "instance_containment_pkg" {
     type = "zip"
-    source_file = "../lambda/InstanceContainAndPreserveStatus.py"
+    source {
+        content  = file("../lambda/InstanceContainAndPreserveStatus.py")
+        filename = "InstanceContainAndPreserveStatus.py"
+    }
+    source {
+        content  = file("../lambda/forensicsCommon.py")
+        filename = "forensicsCommon.py"
+    }
     output_path = "../lambda/packages/InstanceContainAndPreserveStatus.zip"
 }
 
+data "archive_file" "preservation_tracker_pkg" {
+    type = "zip"
+    source {
+        content  = file("../lambda/PreservationTracker.py")
+        filename = "PreservationTracker.py"
+    }
+    source {
+        content  = file("../lambda/forensicsCommon.py")
+        filename = "forensicsCommon.py"
+    }
+    output_path = "../lambda/packages/PreservationTracker.zip"
+}
+
 data "archive_file" "forensics_evidence_pkg" {
     type = "zip"
     #source_dir = "../lambda/packages/paramiko_src/"
-    source_file = "../lambda/EC2ForensicsEvidence.py"
+    source {
+        content  = file("../lambda/EC2ForensicsEvidence.py")
+        filename = "EC2ForensicsEvidence.py"
+    }
+    source {
+        content  = file("../lambda/forensicsCommon.py")
+        filename = "forensicsCommon.py"
+    }
     output_path = "../lambda/packages/EC2ForensicsEvidence.zip"
 }
 
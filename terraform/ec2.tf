@@ -55,4 +55,33 @@ resource "aws_security_group" "isolation_step2" {
   }
 
   depends_on = [aws_security_group.lambda_access_to_ec2]
-}
\ No newline at end of file
+}
+
+resource "aws_security_group" "forensics_access" {
+  name        = "forensics_access"
+  description = "Forensics access to an isolated instance during the collection (containment-first)"
+  vpc_id      = var.vpc_id
+
+  ingress {
+    from_port   = 22
+    to_port     = 22
+    protocol    = "tcp"
+    cidr_blocks = ["${chomp(data.http.myip.body)}/32"]
+  }
+
+  ingress {
+    from_port   = 22
+    to_port     = 22
+    protocol    = "tcp"
+    security_groups = [aws_security_group.lambda_access_to_ec2.id]
+  }
+
+  egress {
+    from_port   = 0
+    to_port     = 0
+    protocol    = "-1"
+    security_groups = [aws_security_group.lambda_access_to_ec2.id]
+  }
+
+  depends_on = [aws_security_group.lambda_access_to_ec2]
+}
@@ -47,6 +47,46 @@ resource "aws_lambda_function" "ec2-forensics" {
 
 }
 
+resource "aws_lambda_function" "preservation-tracker" {
+  function_name    = "preservation-tracker"
+  description      = "Track AMIs and EBS snapshots until they finish, record ids and durations to S3"
+  handler          = "PreservationTracker.lambda_handler"
+  memory_size      = 256
+  timeout          = 60
+  role             = aws_iam_role.containment_and_forensics_role.arn
+  runtime          = "python3.7"
+  filename         = data.archive_file.preservation_tracker_pkg.output_path
+  source_code_hash = filebase64sha256(data.archive_file.preservation_tracker_pkg.output_path)
+
+  environment {
+    variables = {
+      FORENSICS_BUCKET = var.forensics_S3_bucket_name
+      FORENSICS_EVIDENCE_PATH = var.S3_evidence_path
+      REGION = var.region
+    }
+  }
+}
+
+# The tracker polls on a schedule, nothing waits for the snapshots to finish
+resource "aws_cloudwatch_event_rule" "preservation_tracker_schedule" {
+  name                = "preservation-tracker-schedule"
+  description         = "Poll pending AMIs and EBS snapshots of the containment lambda and command line"
+  schedule_expression = var.preservation_tracker_schedule
+}
+
+resource "aws_cloudwatch_event_target" "preservation_tracker" {
+  rule = aws_cloudwatch_event_rule.preservation_tracker_schedule.name
+  arn  = aws_lambda_function.preservation-tracker.arn
+}
+
+resource "aws_lambda_permission" "preservation_tracker_schedule" {
+  statement_id  = "AllowScheduledPreservationTracker"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.preservation-tracker.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.preservation_tracker_schedule.arn
+}
+
 
 # Layer additional libraries
 resource "aws_lambda_layer_version" "paramiko_272" {
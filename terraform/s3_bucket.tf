@@ -39,6 +39,15 @@ resource "aws_s3_bucket_object" "config_ec2_key" {
   depends_on = [aws_s3_bucket.s3_containment_and_forensics]
 }
 
+resource "aws_s3_bucket_object" "config_custody_key" {
+  bucket = var.forensics_S3_bucket_name
+  key    = "forensics/config/custody.key"
+  source = var.custody_key
+
+  etag = filemd5(var.custody_key)
+  depends_on = [aws_s3_bucket.s3_containment_and_forensics]
+}
+
 # Only necessary for commandline version:
 resource "aws_s3_bucket_object" "config_json" {
   bucket = var.forensics_S3_bucket_name
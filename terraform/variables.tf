@@ -12,6 +12,10 @@ variable "ec2_key" {
     description = "Path to key.pem to access by ssh to vulnerated EC2" 
 }
 
+variable "custody_key" {
+    description = "Path to the secret custody records are signed with (HMAC-SHA256), i.e. made with: openssl rand -hex 32 > custody.key"
+}
+
 variable "ec2_local_user" {
     default = "ec2-user" 
     description = "Local username of the vulnerated EC2 instance"
@@ -35,3 +39,8 @@ variable "vpc_lambda_route_table" {
 variable "region" {
     default = "sa-east-1"
 }
+
+variable "preservation_tracker_schedule" {
+    description = "How often pending AMIs and EBS snapshots are polled (durations are exact up to it)"
+    default = "rate(5 minutes)"
+}
@@ -0,0 +1,103 @@
+import os, sys, json, hashlib, threading
+import pytest
+
+# Unit tests of the collector, the orchestrators code and the preservation tracker, with the stand-ins of
+# benchmark/localStubs.py instead of AWS. Modules are imported as the benchmark does: they create
+# their boto3 clients on import, which are replaced by the stand-ins in each test.
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(repo_path, d) for d in ('benchmark', 'commandline', 'lambda', 'resources')]
+
+S3_bucket = 'forensics-test'
+S3_evidence_path = 'forensics/evidence/'
+key = S3_evidence_path + 'i-1/archive.tar'  # Evidence object of the upload tests
+custody_key = 'forensics/config/custody.key'
+custody_secret = b'custody secret'
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.update({'FORENSICS_BUCKET': S3_bucket, 'FORENSICS_EVIDENCE_PATH': S3_evidence_path,
+                   'EC2_LOCAL_USER': 'ec2-user', 'REGION': 'us-east-1'})
+
+from localStubs import Counters, LocalS3, LocalEC2
+
+
+@pytest.fixture
+def s3():
+    return LocalS3(Counters())
+
+
+@pytest.fixture
+def ec2():
+    return LocalEC2(Counters())
+
+
+@pytest.fixture
+def collector(tmp_path, monkeypatch):
+    import collectLocalForensics
+    monkeypatch.setattr(collectLocalForensics, 'working_path', str(tmp_path) + '/')
+    return collectLocalForensics
+
+
+# Code shared by the orchestrators (upload, journal), configured as an entry point would
+@pytest.fixture
+def common(s3, monkeypatch):
+    import forensicsCommon
+    monkeypatch.setattr(forensicsCommon, 's3_client', s3)
+    monkeypatch.setattr(forensicsCommon, 'S3_bucket', S3_bucket)
+    monkeypatch.setattr(forensicsCommon, 'S3_evidence_path', S3_evidence_path)
+    monkeypatch.setattr(forensicsCommon, 's3_part_size', 1024)
+    return forensicsCommon
+
+
+@pytest.fixture
+def custody(common, s3, tmp_path, monkeypatch):
+    # Shared code with a custody key in S3 and an empty local cache
+    s3.put_object(Body=custody_secret, Bucket=S3_bucket, Key=custody_key)
+    monkeypatch.setattr(common, 'S3_custody_bucket', S3_bucket)
+    monkeypatch.setattr(common, 'S3_custody_key', custody_key)
+    monkeypatch.setattr(common, 'cache_path', str(tmp_path) + '/cache/')
+    monkeypatch.setattr(common, 'cache_index', None)
+    os.makedirs(common.cache_path)
+    return common
+
+
+@pytest.fixture
+def tracker(s3, monkeypatch):
+    import PreservationTracker
+    monkeypatch.setattr(PreservationTracker, 's3_client', s3)
+    return PreservationTracker
+
+
+def uploaded(s3):
+    return s3.objects[(S3_bucket, key)]
+
+
+# Helpers of the collector tests
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_index(path):
+    with open(path + '.index.json') as f:
+        return json.load(f)
+
+
+def make_tree(root, files):
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def file_state(collector, path, offset):
+    st = os.stat(path)
+    return {'inode': st.st_ino, 'dev': st.st_dev, 'offset': offset, 'head': collector.file_head_hash(path, min(offset, 4096))}
+
+
+def file_job(path, incremental=True):
+    return {'target': path, 'output': 'logs/syslog', 'codec': None, 'max_bytes': None, 'incremental': incremental}
+
+
+def collection_state(previous):
+    return {'previous': previous, 'current': {}, 'lock': threading.Lock()}
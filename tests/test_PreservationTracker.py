@@ -0,0 +1,68 @@
+import json
+from datetime import datetime, timezone
+import pytest
+
+requested_at = 1700000000.0
+
+
+def pending_record():
+    return {'instance_id': 'i-1', 'mode': 'snapshot', 'requested_at': requested_at,
+            'snapshots': [{'SnapshotId': 'snap-1'}, {'SnapshotId': 'snap-2'}], 'image': {'ImageId': 'ami-1'}}
+
+
+def snapshot(state, started_at=requested_at + 10):
+    return {'State': state, 'Progress': '100%' if state == 'completed' else '40%', 'StartTime': datetime.fromtimestamp(started_at, timezone.utc)}
+
+
+def test_update_preservation_finishes_what_reached_a_final_state(tracker):
+    record = pending_record()
+    now = requested_at + 100
+    assert not tracker.update_preservation(record, {'snap-1': snapshot('completed'), 'snap-2': snapshot('pending')}, {'ami-1': {'State': 'pending'}}, now)
+    snap1, snap2 = record['snapshots']
+    assert snap1['state'] == 'completed' and snap1['finished_at'] == now and snap1['seconds'] == 90
+    assert snap2['state'] == 'pending' and 'finished_at' not in snap2
+    assert record['image']['state'] == 'pending' and 'finished_at' not in record['image']
+
+    later = requested_at + 200
+    assert tracker.update_preservation(record, {'snap-2': snapshot('error')}, {'ami-1': {'State': 'available'}}, later)
+    assert snap1['finished_at'] == now  # Not updated again
+    assert snap2['state'] == 'error' and snap2['finished_at'] == later
+    assert record['image']['state'] == 'available' and record['image']['seconds'] == 200
+
+
+def test_update_preservation_waits_for_missing_ones(tracker):
+    record = pending_record()
+    now = requested_at + tracker.not_found_grace
+    assert not tracker.update_preservation(record, {}, {}, now)
+    assert [s['state'] for s in record['snapshots']] == ['not found', 'not found'] and record['image']['state'] == 'not found'
+    assert not any(s.get('finished_at') for s in record['snapshots'] + [record['image']])
+
+    # Visible at last
+    assert not tracker.update_preservation(record, {'snap-1': snapshot('pending')}, {}, now + 1)
+    assert record['snapshots'][0]['state'] == 'pending' and 'finished_at' not in record['snapshots'][0]
+    assert record['snapshots'][1]['finished_at'] == now + 1 and record['image']['finished_at'] == now + 1
+
+
+@pytest.mark.parametrize('image', [None, {'ImageId': 'ami-1', 'state': 'available', 'finished_at': requested_at + 50}])
+def test_update_preservation_without_pending_image(tracker, image):
+    record = dict(pending_record(), image=image)
+    assert tracker.update_preservation(record, {'snap-1': snapshot('completed'), 'snap-2': snapshot('completed')}, {}, requested_at + 60)
+    assert record['image'] == image
+
+
+def test_multi_volume_snapshot_tracked_until_completed(common, tracker, ec2, s3, monkeypatch):
+    monkeypatch.setattr(common, 'ec2_client', ec2)
+    monkeypatch.setattr(tracker, 'ec2_client', ec2)
+    ec2.add_instance('i-1', '10.0.0.1', volumes=2)
+    assert common.preserve_status('i-1', False, ec2.instances['i-1']['BlockDeviceMappings'], multi_volume=True)
+    assert ec2.counters.values['ec2_calls'] == 1  # Both volumes in one request
+    pending = [k for b, k in s3.objects if k.startswith(common.S3_evidence_path + common.preservation_pending_prefix)]
+    assert len(pending) == 1
+
+    assert tracker.main({}) == {'pending': 0, 'finished': 1}
+    assert (tracker.S3_bucket, pending[0]) not in s3.objects
+    final_key = pending[0].replace(common.preservation_pending_prefix, tracker.preservation_prefix)
+    record = json.loads(s3.objects[(tracker.S3_bucket, final_key)])
+    assert record['status'] == 'completed' and record['mode'] == 'multi_volume'
+    assert sorted(s['VolumeId'] for s in record['snapshots']) == ['vol-i-1-0', 'vol-i-1-1']
+    assert all(s['state'] == 'completed' for s in record['snapshots'])
@@ -0,0 +1,52 @@
+import tarfile
+from conftest import make_tree, file_job
+
+# Size and time budgets of the collection: what is cut is recorded, the newest bytes are kept
+
+
+def test_collect_file_budget_keeps_newest_bytes(collector, tmp_path):
+    path = str(tmp_path / 'syslog')
+    make_tree(str(tmp_path), {'syslog': b'a' * 70 + b'b' * 30})
+    archive = collector.EvidenceArchive(str(tmp_path / 'evidence.tar'))
+    name, cut = collector.collect_file(file_job(path, incremental=False), archive, None, collector.CollectionBudget(max_bytes=30))
+    assert name == 'logs/syslog.70-100'
+    assert cut == {'reason': 'size budget', 'original_bytes': 100, 'collected_bytes': 30, 'range': [70, 100]}
+    archive.close()
+    with tarfile.open(str(tmp_path / 'evidence.tar')) as tar:
+        assert tar.extractfile(name).read() == b'b' * 30
+
+
+class Clock:
+    """time module stand-in, every time() call is one second later"""
+
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+def test_memory_dump_stops_at_the_time_budget(collector, tmp_path, monkeypatch):
+    image = str(tmp_path / 'memory.raw')
+    make_tree(str(tmp_path), {'memory.raw': b'm' * 100000})
+    monkeypatch.setattr(collector, 'memory_image', image)
+    monkeypatch.setattr(collector, 'copy_chunk_size', 1000)
+    monkeypatch.setattr(collector, 'time', Clock())
+    archive = collector.EvidenceArchive(str(tmp_path / 'evidence.tar'))
+    result = collector.do_memory_dump(archive, None, collector.CollectionBudget(), timeout=10)
+    archive.close()
+    cut = result['cut']
+    assert result['status'] == 'TRUNCATED' and cut['reason'] == 'time budget' and cut['original_bytes'] == 100000
+    assert 0 < cut['collected_bytes'] < 100000
+    assert collector.member_original_size(archive, result['output']) == cut['collected_bytes']
+
+
+def test_memory_dump_gets_what_is_left_of_the_time_budget(collector, tmp_path, monkeypatch):
+    timeouts = []
+    monkeypatch.setattr(collector, 'do_memory_dump', lambda archive, codec, budget, timeout: timeouts.append(timeout) or {'status': 'OK'})
+    job = {'name': 'MemoryDump', 'type': 'memory', 'target': 'LiME', 'output': 'memory_dump.mem', 'timeout': None,
+           'codec': None, 'volatility': 'memory', 'priority': 0, 'max_bytes': None}
+    collector.run_collection_job(job, None, budget=collector.CollectionBudget(max_seconds=30))
+    collector.run_collection_job(job, None, budget=collector.CollectionBudget())
+    assert 0 < timeouts[0] <= 30 and timeouts[1] is None
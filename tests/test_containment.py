@@ -0,0 +1,74 @@
+import threading, time
+import pytest
+
+# Two step isolation (forensicsCommon.ec2_containment) and its batches in fleet mode
+
+
+@pytest.fixture
+def cli(common, ec2, monkeypatch):
+    import containmentAndForensicsEC2
+    monkeypatch.setattr(common, 'ec2_client', ec2)
+    monkeypatch.setattr(common, 'isolation_security_groups', ['isolation_step1', 'isolation'])
+    monkeypatch.setattr(common, 'security_groups_cache', {})
+    monkeypatch.setattr(common, 'security_groups_settle', 0.2)
+    for n in range(3):
+        ec2.add_instance('i-{}'.format(n), '10.0.0.{}'.format(n))
+    return containmentAndForensicsEC2
+
+
+def contained(ec2, Iid, groups=('sg-isolation',)):
+    inst = ec2.instances[Iid]
+    return [g['GroupId'] for g in inst['SecurityGroups']] == list(groups) and \
+        {'Key': 'Security_status', 'Value': 'quarantined'} in inst['Tags']
+
+
+def test_ec2_containment_of_many_instances_shares_the_settle_time(cli, common, ec2):
+    start = time.time()
+    failures = {}
+    assert common.ec2_containment(['i-0', 'i-1', 'i-2', 'i-missing'], 'vpc-local', ['forensics_access'], failures=failures) is False
+    assert time.time() - start < 0.4
+    assert all(contained(ec2, Iid, ['sg-isolation', 'sg-forensics_access']) for Iid in ('i-0', 'i-1', 'i-2'))
+    assert list(failures) == ['i-missing']  # The others are contained anyway
+
+
+def test_containment_first_contains_the_fleet_in_one_call(cli, ec2, monkeypatch):
+    calls = []
+    containment_call = cli.ec2_containment
+    monkeypatch.setattr(cli, 'ec2_containment', lambda Iids, *args, **kwargs: calls.append(sorted(Iids)) or containment_call(Iids, *args, **kwargs))
+    batches = cli.ContainmentBatches(['forensics_access'])
+    batches.add({Iid: 'vpc-local' for Iid in ec2.instances})
+    results = {}
+    workers = [threading.Thread(target=lambda Iid=Iid: results.update(batches.wait([Iid]))) for Iid in ec2.instances]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert calls == [['i-0', 'i-1', 'i-2']]
+    assert all(ok for ok, _ in results.values()) and len(set(at for _, at in results.values())) == 1
+
+
+def test_instances_queued_while_a_containment_runs_go_in_the_next_one(cli, ec2, monkeypatch):
+    calls = []
+    first_running = threading.Event()
+    containment_call = cli.ec2_containment
+
+    def ec2_containment(Iids, *args, **kwargs):
+        calls.append(sorted(Iids))
+        first_running.set()
+        return containment_call(Iids, *args, **kwargs)
+    monkeypatch.setattr(cli, 'ec2_containment', ec2_containment)
+    batches = cli.ContainmentBatches()
+
+    def contain(Iid):
+        batches.add({Iid: 'vpc-local'})
+        assert batches.wait([Iid])[Iid][0]
+    first = threading.Thread(target=contain, args=('i-0',))
+    first.start()
+    first_running.wait()
+    others = [threading.Thread(target=contain, args=(Iid,)) for Iid in ('i-1', 'i-2')]
+    for w in others:
+        w.start()
+    for w in [first] + others:
+        w.join()
+    assert calls == [['i-0'], ['i-1', 'i-2']]
+    assert all(contained(ec2, Iid) for Iid in ec2.instances)
@@ -0,0 +1,46 @@
+import os, io, json, hmac, hashlib
+from conftest import S3_bucket, custody_secret
+
+# Chain of custody: members hashed on their way to S3, checked against the index, signed record
+
+
+def test_archive_verifier_matches_the_index(common, collector, tmp_path):
+    path = str(tmp_path / 'evidence.tar')
+    archive = collector.EvidenceArchive(path)
+    for n, size in enumerate([10, 3000, 0, 700]):
+        archive.add_stream('member{}'.format(n), io.BytesIO(os.urandom(size)))
+    archive.close()
+    index = {'members': list(archive.members)}
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    for window in (1, 333, 1024, len(data)):
+        verifier = common.ArchiveVerifier(index)
+        for offset in range(0, len(data), window):
+            verifier.update(offset, data[offset:offset + window])
+        assert verifier.hexdigests() == {m['name']: m['stored_sha256'] for m in index['members']}
+
+
+def custody_index():
+    return {'archive': 'evidence.tar', 'collection': {'host': 'test'},
+            'members': [{'name': 'logs', 'stored_sha256': 'a' * 64}, {'name': 'ps', 'stored_sha256': 'b' * 64}]}
+
+
+def test_custody_record_is_signed_and_verified(custody, s3):
+    record = custody.write_custody_record(custody_index(), {'logs': 'a' * 64, 'ps': 'b' * 64}, 'custody.json', 'i-1', 'packed')
+    assert record['verified'] and all(m['verified'] for m in record['members'])
+    stored = json.loads(s3.objects[(S3_bucket, 'custody.json')])
+    signature = stored.pop('signature')
+    body = json.dumps(stored, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    assert signature['value'] == hmac.new(custody_secret, body, hashlib.sha256).hexdigest()
+
+
+def test_custody_record_reports_mismatches(custody):
+    record = custody.write_custody_record(custody_index(), {'logs': 'c' * 64}, 'custody.json', 'i-1', 'deduplicated')
+    assert not record['verified']
+    assert [m['verified'] for m in record['members']] == [False, None]  # ps already in the bucket, not uploaded
+
+
+def test_custody_record_without_key_is_not_signed(custody, monkeypatch):
+    monkeypatch.setattr(custody, 'S3_custody_key', 'forensics/config/missing.key')
+    assert custody.write_custody_record(custody_index(), {}, 'custody.json', 'i-1', 'packed')['signature'] is None
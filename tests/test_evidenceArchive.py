@@ -0,0 +1,27 @@
+import io, gzip, tarfile
+import pytest
+from conftest import sha256, read_index
+
+# Evidence archive written in a single streaming pass, with its index
+
+
+@pytest.mark.parametrize('spool', [True, False])
+def test_archive_members_match_index(collector, tmp_path, spool):
+    path = str(tmp_path / 'evidence.tar')
+    archive = collector.EvidenceArchive(path)
+    logs = b'log line\n' * 5000
+    archive.add_stream('logs', io.BytesIO(logs), collector.Codec('gzip'), spool=spool)
+    archive.add_stream('ps', io.BytesIO(b'1 init\n'), spool=spool)
+    archive.close()
+
+    with tarfile.open(path) as tar:
+        assert tar.getnames() == ['logs.gz', 'ps']
+        assert gzip.decompress(tar.extractfile('logs.gz').read()) == logs
+        assert tar.extractfile('ps').read() == b'1 init\n'
+    index = read_index(path)
+    with open(path, 'rb') as f:
+        for m, original in zip(index['members'], [logs, b'1 init\n']):
+            f.seek(m['data_offset'])
+            stored = f.read(m['size'])
+            assert sha256(stored) == m['stored_sha256']
+            assert m['sha256'] == sha256(original) and m['original_size'] == len(original)
@@ -0,0 +1,67 @@
+import os, io, json, gzip, threading
+from conftest import sha256
+
+# Evidence streamed over SSH in frames while it is collected, one member per artifact
+
+
+def read_frames(collector, data):
+    stream = io.BytesIO(data)
+    frames = []
+    while True:
+        header = stream.read(collector.stream_frame.size)
+        if not header:
+            return frames
+        kind, member_id, length = collector.stream_frame.unpack(header)
+        frames.append((kind, member_id, stream.read(length)))
+
+
+def test_stream_frames_round_trip(collector, monkeypatch, tmp_path):
+    monkeypatch.setattr(collector, 'copy_chunk_size', 1000)
+    out = io.BytesIO()
+    stream = collector.EvidenceStream(out, 'evidence.tar')
+    logs = os.urandom(3500)
+    stream.add_stream('logs', io.BytesIO(logs))
+    stream.add_stream('ps', io.BytesIO(b'1 init\n' * 100), collector.Codec('gzip'))
+    stream.remove_source('/var/log/collected')
+    stream.close()
+
+    begun, data, ended = {}, {}, {}
+    frames = read_frames(collector, out.getvalue())
+    for kind, member_id, payload in frames[:-1]:
+        if kind == b'B':
+            begun[member_id] = json.loads(payload)
+            data[member_id] = b''
+        elif kind == b'D':
+            assert member_id in begun and member_id not in ended
+            data[member_id] += payload
+        elif kind == b'E':
+            ended[member_id] = json.loads(payload)
+    assert [begun[i]['name'] for i in sorted(begun)] == ['logs', 'ps.gz']
+    assert data[0] == logs
+    assert gzip.decompress(data[1]) == b'1 init\n' * 100
+    for i, member in ended.items():
+        assert member['size'] == len(data[i]) and member['stored_sha256'] == sha256(data[i])
+    assert ended[0]['sha256'] == sha256(logs)
+    kind, _, payload = frames[-1]
+    assert kind == b'I'
+    index = json.loads(payload)
+    assert index['members'] == [ended[0], ended[1]]
+    assert index['sources_to_remove'] == ['/var/log/collected']
+
+
+def test_stream_concurrent_members_keep_their_data(collector):
+    out = io.BytesIO()
+    stream = collector.EvidenceStream(out, 'evidence.tar')
+    contents = {'member{}'.format(n): os.urandom(50000) for n in range(4)}
+    workers = [threading.Thread(target=stream.add_stream, args=(name, io.BytesIO(data))) for name, data in contents.items()]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    names, data = {}, {}
+    for kind, member_id, payload in read_frames(collector, out.getvalue()):
+        if kind == b'B':
+            names[member_id] = json.loads(payload)['name']
+        elif kind == b'D':
+            data[member_id] = data.get(member_id, b'') + payload
+    assert {names[i]: data[i] for i in names} == contents
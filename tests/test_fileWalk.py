@@ -0,0 +1,105 @@
+import os
+import pytest
+from conftest import make_tree
+
+# FILE artifact patterns compiled into one matcher, and the single walk of the filesystem
+
+
+@pytest.mark.parametrize('pattern, path, matches', [
+    ('/var/log/*.log', '/var/log/syslog.log', True),
+    ('/var/log/*.log', '/var/log/nginx/access.log', False),
+    ('/var/log/**', '/var/log/nginx/access.log', True),
+    ('/var/log/**/*.log', '/var/log/a.log', True),
+    ('/var/log/**/*.log', '/var/log/nginx/old/access.log', True),
+    ('/var/log/**/*.log', '/var/log/nginx/access.log.1', False),
+    ('/home/*/.ssh/authorized_keys', '/home/ec2-user/.ssh/authorized_keys', True),
+    ('/home/*/.ssh/authorized_keys', '/home/.ssh/authorized_keys', False),
+    ('/var/log/secure?', '/var/log/secure1', True),
+    ('/var/log/secure?', '/var/log/secure', False),
+    ('/var/log/messages[0-9]', '/var/log/messages3', True),
+    ('/var/log/messages[!0-9]', '/var/log/messages3', False),
+    ('/var/log/messages[!0-9]', '/var/log/messagesx', True),
+    ('/etc/passwd', '/etc/passwd', True),
+    ('/etc/passwd', '/etc/passwd-', False),
+    ('/tmp/a+b.txt', '/tmp/a+b.txt', True),
+    ('/tmp/a+b.txt', '/tmp/aab.txt', False),
+])
+def test_compile_file_pattern_matches(collector, pattern, path, matches):
+    assert bool(collector.compile_file_pattern(pattern)['regex'].match(path)) == matches
+
+
+@pytest.mark.parametrize('pattern, root', [
+    ('/var/log/*.log', '/var/log'),
+    ('/var/log/**/*.log', '/var/log'),
+    ('/home/*/.ssh', '/home'),
+    ('/etc/passwd', '/etc/passwd'),
+    ('/*', '/'),
+])
+def test_compile_file_pattern_root(collector, pattern, root):
+    assert collector.compile_file_pattern(pattern)['root'] == root
+
+
+@pytest.mark.parametrize('pattern, parts, leads', [
+    ('/home/*/.ssh/authorized_keys', ['home', 'ec2-user'], True),
+    ('/home/*/.ssh/authorized_keys', ['home', 'ec2-user', '.ssh'], True),
+    ('/home/*/.ssh/authorized_keys', ['home', 'ec2-user', '.aws'], False),
+    ('/home/*/.ssh/authorized_keys', ['home', 'ec2-user', '.ssh', 'authorized_keys'], False),
+    ('/var/log/**/*.log', ['var', 'log', 'nginx', 'old'], True),
+    ('/var/log/*.log', ['var', 'lib'], False),
+])
+def test_pattern_leads_below(collector, pattern, parts, leads):
+    assert collector.pattern_leads_below(collector.compile_file_pattern(pattern), parts) == leads
+
+
+def selected(selector, root):
+    return sorted((os.path.relpath(path, root), explicit) for path, explicit in selector.files)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = str(tmp_path / 'host')
+    make_tree(root, {'var/log/syslog': b's' * 10,
+                     'var/log/auth.log': b'a' * 10,
+                     'var/log/big.log': b'b' * 5000,
+                     'var/log/nginx/access.log': b'n' * 10,
+                     'var/log/nginx/old/access.log.1': b'o' * 10,
+                     'home/ec2-user/.ssh/authorized_keys': b'k' * 10,
+                     'home/ec2-user/.aws/credentials': b'c' * 10})
+    return root
+
+
+def test_walk_patterns_and_directories(collector, tree):
+    logs = collector.FileSelector({'name': 'logs', 'attributes': [tree + '/var/log/*.log']})
+    nginx = collector.FileSelector({'name': 'nginx', 'attributes': [tree + '/var/log/nginx']})
+    keys = collector.FileSelector({'name': 'keys', 'attributes': [tree + '/home/*/.ssh/authorized_keys']})
+    collector.walk_file_artifacts([logs, nginx, keys])
+    assert selected(logs, tree) == [('var/log/auth.log', True), ('var/log/big.log', True)]
+    # Files found in a matched directory are not explicit
+    assert selected(nginx, tree) == [('var/log/nginx/access.log', False), ('var/log/nginx/old/access.log.1', False)]
+    assert selected(keys, tree) == [('home/ec2-user/.ssh/authorized_keys', True)]
+
+
+def test_walk_filters(collector, tree):
+    os.utime(tree + '/var/log/syslog', (1, 1))
+    logs = collector.FileSelector({'name': 'logs', 'attributes': [tree + '/var/log'], 'exclude': [tree + '/var/log/nginx/old'],
+                                   'max_depth': 2, 'max_size': 1000, 'max_age_days': 1})
+    collector.walk_file_artifacts([logs])
+    assert selected(logs, tree) == [('var/log/auth.log', False), ('var/log/nginx/access.log', False)]
+    report = logs.report()
+    assert report['excluded'] == 1 and report['mtime'] == 1
+    assert report['max_size'] == [{'path': tree + '/var/log/big.log', 'size': 5000}]
+
+
+def test_walk_max_depth(collector, tree):
+    logs = collector.FileSelector({'name': 'logs', 'attributes': [tree + '/var/log'], 'max_depth': 1})
+    collector.walk_file_artifacts([logs])
+    assert [p for p, _ in selected(logs, tree)] == ['var/log/auth.log', 'var/log/big.log', 'var/log/syslog']
+
+
+def test_walk_symlinks(collector, tree):
+    os.symlink(tree + '/home', tree + '/var/log/home')
+    logs = collector.FileSelector({'name': 'logs', 'attributes': [tree + '/var/log'], 'max_depth': 1})
+    followed = collector.FileSelector({'name': 'followed', 'attributes': [tree + '/var/log/home'], 'follow_symlinks': True})
+    collector.walk_file_artifacts([logs, followed])
+    assert logs.report()['symlinks'] == 1
+    assert [p for p, _ in selected(followed, tree)] == ['var/log/home/ec2-user/.aws/credentials', 'var/log/home/ec2-user/.ssh/authorized_keys']
@@ -0,0 +1,27 @@
+import pytest
+from conftest import S3_bucket
+
+# Fleet mode: instances resolved by id, tag or ASG with one describe_instances
+
+
+@pytest.fixture
+def cli(s3, ec2, monkeypatch):
+    import containmentAndForensicsEC2
+    monkeypatch.setattr(containmentAndForensicsEC2, 'ec2_client', ec2)
+    monkeypatch.setattr(containmentAndForensicsEC2, 's3_client', s3)
+    monkeypatch.setattr(containmentAndForensicsEC2, 'S3_bucket', S3_bucket)
+    for n, state in enumerate(['running', 'stopped', 'terminated', 'running']):
+        ec2.add_instance('i-{}'.format(n), '10.0.0.{}'.format(n), tags={'Role': 'web' if n < 3 else 'db'})
+        ec2.instances['i-{}'.format(n)]['State']['Name'] = state
+    return containmentAndForensicsEC2
+
+
+def test_filters_only_take_running_instances(cli, ec2):
+    fleet = cli.get_fleet_data(None, [{'Name': 'tag:Role', 'Values': ['web']}])
+    assert list(fleet) == ['i-0']
+    assert fleet['i-0']['Reservations'][0]['Instances'] == [ec2.instances['i-0']]
+
+
+def test_instances_by_id_are_taken_in_any_state(cli):
+    # Reported as not running by the collection
+    assert sorted(cli.get_fleet_data(['i-0', 'i-1'])) == ['i-0', 'i-1']
@@ -0,0 +1,36 @@
+import os
+from conftest import make_tree, file_state, file_job, collection_state
+
+# Incremental FILE collection: offsets persisted per file, rotation and rewrite detection
+
+
+def test_incremental_range(collector, tmp_path):
+    path = str(tmp_path / 'syslog')
+    make_tree(str(tmp_path), {'syslog': b'x' * 100})
+    assert collector.incremental_range(path, os.stat(path), {}) == (0, 100)
+    previous = {path: file_state(collector, path, 60)}
+    assert collector.incremental_range(path, os.stat(path), previous) == (60, 100)
+    # Rotated: same file under a new name
+    os.rename(path, path + '.1')
+    assert collector.incremental_range(path + '.1', os.stat(path + '.1'), previous) == (60, 100)
+    # Rewritten (same inode, first bytes changed) and truncated
+    with open(path + '.1', 'r+b') as f:
+        f.write(b'y')
+    assert collector.incremental_range(path + '.1', os.stat(path + '.1'), previous) == (0, 100)
+    with open(path + '.1', 'r+b') as f:
+        f.truncate(50)
+    assert collector.incremental_range(path + '.1', os.stat(path + '.1'), previous) == (0, 50)
+
+
+def test_collect_file_incremental(collector, tmp_path):
+    path = str(tmp_path / 'syslog')
+    make_tree(str(tmp_path), {'syslog': b'x' * 100})
+    archive = collector.EvidenceArchive(str(tmp_path / 'evidence.tar'))
+    state = collection_state({path: file_state(collector, path, 60)})
+    assert collector.collect_file(file_job(path), archive, state, collector.CollectionBudget()) == ('logs/syslog.60-100', None)
+    assert archive.members[0]['original_size'] == 40
+    assert state['current'][path]['offset'] == 100
+
+    state = collection_state(state['current'])
+    assert collector.collect_file(file_job(path), archive, state, collector.CollectionBudget()) == (None, None)
+    archive.close()
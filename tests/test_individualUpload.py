@@ -0,0 +1,91 @@
+import os, io, json, hashlib
+import paramiko
+import pytest
+from conftest import S3_bucket, S3_evidence_path
+
+# Individual S3 data format: every archive member uploaded as its own object, read from its byte
+# range in the remote archive through SFTP, and the run manifest
+
+prefix = S3_evidence_path + 'i-1/'
+manifest_key = prefix + 'manifest.json'
+
+
+@pytest.fixture(scope='module')
+def host():
+    from localStubs import Counters, LocalHost
+    host = LocalHost(Counters())
+    yield host
+    host.close()
+
+
+@pytest.fixture
+def ftp_client(host):
+    ssh_client = paramiko.SSHClient()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh_client.connect('127.0.0.1', port=host.port, username='ec2-user', pkey=paramiko.RSAKey.generate(1024),
+                       allow_agent=False, look_for_keys=False)
+    ftp_client = ssh_client.open_sftp()
+    yield ftp_client
+    ftp_client.close()
+    ssh_client.close()
+
+
+@pytest.fixture
+def archive(collector, tmp_path):
+    # Packed archive with a collection summary, as the collector leaves it on the instance
+    path = str(tmp_path / 'evidence.tar')
+    archive = collector.EvidenceArchive(path)
+    archive.add_stream('logs.gz', io.BytesIO(os.urandom(3000)))
+    archive.add_stream('ps', io.BytesIO(b'1 init\n'))
+    summary = {'elapsed_seconds': 4.5, 'artifacts': [
+        {'name': 'logs', 'type': 'FILE', 'target': '/var/log/messages', 'output': 'logs.gz', 'status': 'OK', 'seconds': 1.25},
+        {'name': 'processes', 'type': 'COMMAND', 'target': 'ps', 'output': 'ps', 'status': 'OK', 'seconds': 0.5}]}
+    archive.add_stream('collection_summary.json', io.BytesIO(json.dumps(summary).encode('utf-8')))
+    archive.close()
+    return path
+
+
+def members(path):
+    with open(path + '.index.json') as f:
+        index = json.load(f)
+    with open(path, 'rb') as f:
+        data = f.read()
+    return {m['name']: dict(m, data=data[m['data_offset']:m['data_offset'] + m['size']]) for m in index['members']}
+
+
+def test_manifest_has_key_sizes_hashes_and_timings_of_every_artifact(common, s3, ftp_client, archive):
+    manifest = common.upload_individual(ftp_client, archive, prefix, manifest_key)
+    assert json.loads(s3.objects[(S3_bucket, manifest_key)]) == manifest
+    assert manifest['archive'] == 'evidence.tar' and manifest['prefix'] == prefix
+    assert manifest['collection_seconds'] == 4.5 and manifest['upload_seconds'] >= 0
+
+    expected = members(archive)
+    entries = {e['name']: e for e in manifest['members']}
+    assert sorted(entries) == sorted(expected)
+    for name, e in entries.items():
+        m = expected[name]
+        assert e['key'] == prefix + name and s3.objects[(S3_bucket, e['key'])] == m['data']
+        assert e['size'] == m['size'] and e['original_size'] == m['original_size']
+        assert e['sha256'] == m['sha256'] and e['uploaded_sha256'] == hashlib.sha256(m['data']).hexdigest()
+        assert e['upload_seconds'] >= 0
+    # Timings and origin of the artifact each member comes from
+    assert {k: entries['logs.gz'][k] for k in ('type', 'target', 'status', 'collection_seconds')} == \
+        {'type': 'FILE', 'target': '/var/log/messages', 'status': 'OK', 'collection_seconds': 1.25}
+    assert entries['ps']['collection_seconds'] == 0.5
+    assert 'collection_seconds' not in entries['collection_summary.json']
+
+
+def test_members_uploaded_by_an_earlier_attempt_are_not_uploaded_again(common, s3, ftp_client, archive, monkeypatch):
+    monkeypatch.setattr(common, 'run_journal_save_interval', 0)
+    first = common.upload_individual(ftp_client, archive, prefix, manifest_key, journal=common.RunJournal('run-1', 'i-1'))
+    for e in first['members']:
+        del s3.objects[(S3_bucket, e['key'])]
+
+    again = common.upload_individual(ftp_client, archive, prefix, manifest_key, journal=common.RunJournal('run-1', 'i-1'))
+    assert again['members'] == first['members']
+    assert not any((S3_bucket, e['key']) in s3.objects for e in again['members'])
+
+
+def test_upload_individual_without_index(common, s3, ftp_client, tmp_path):
+    assert common.upload_individual(ftp_client, str(tmp_path / 'missing.tar'), prefix, manifest_key) is False
+    assert (S3_bucket, manifest_key) not in s3.objects
@@ -0,0 +1,108 @@
+import json, hashlib
+import pytest
+from conftest import S3_bucket
+
+# Prebuilt LiME modules cache: an entry is only used with a record signed with the custody key
+
+release = '5.10.0-test'
+module_sha256 = 'a' * 64
+
+
+@pytest.fixture
+def lime(custody, monkeypatch):
+    monkeypatch.setattr(custody, 'S3_lime_cache_path', 'forensics/resources/lime/')
+    # uname -r on the instance
+    monkeypatch.setattr(custody, 'run_remote', lambda ssh_client, cmd, timeout, deadline, on_line: on_line('stdout', release + '\n') or 0)
+    return custody
+
+
+def put_record(lime, s3, record):
+    s3.put_object(Body=json.dumps(record).encode(), Bucket=S3_bucket, Key=lime.lime_module_s3_key(release) + '.json')
+
+
+def test_signed_entry_is_used(lime, s3):
+    put_record(lime, s3, lime.lime_module_record(release, module_sha256))
+    assert lime.lime_module_cache_key(None) == (lime.lime_module_s3_key(release), module_sha256)
+
+
+def test_no_entry(lime, s3):
+    assert lime.lime_module_cache_key(None) == (lime.lime_module_s3_key(release), None)
+
+
+@pytest.mark.parametrize('signature', [None, {}, 'forged', {'algorithm': 'HMAC-SHA256', 'value': '0' * 64}])
+def test_entry_not_signed_with_the_custody_key_is_a_miss(lime, s3, signature):
+    put_record(lime, s3, {'release': release, 'sha256': module_sha256, 'signature': signature})
+    assert lime.lime_module_cache_key(None)[1] is None
+
+
+def test_entry_of_another_module_is_a_miss(lime, s3):
+    record = lime.lime_module_record(release, module_sha256)
+    put_record(lime, s3, dict(record, sha256='b' * 64))
+    assert lime.lime_module_cache_key(None)[1] is None
+
+
+@pytest.mark.parametrize('custody_key', [None, 'forensics/config/missing.key'])
+def test_without_custody_key_every_entry_is_a_miss(lime, s3, monkeypatch, custody_key):
+    put_record(lime, s3, lime.lime_module_record(release, module_sha256))
+    monkeypatch.setattr(lime, 'S3_custody_key', custody_key)
+    # Unsigned records, as written without the key, are not trusted either
+    assert lime.lime_module_record(release, module_sha256)['signature'] is None
+    assert lime.lime_module_cache_key(None)[1] is None
+    put_record(lime, s3, lime.lime_module_record(release, module_sha256))
+    assert lime.lime_module_cache_key(None)[1] is None
+
+
+def put_quarantined(lime, s3, module):
+    s3.put_object(Body=module, Bucket=S3_bucket, Key=lime.lime_module_quarantine_key('i-1', release))
+
+
+def test_promoted_module_becomes_a_trusted_entry(lime, s3):
+    module = b'\x7fELF reviewed module'
+    put_quarantined(lime, s3, module)
+    record = lime.promote_lime_module('i-1', release, hashlib.sha256(module).hexdigest())
+    key = lime.lime_module_s3_key(release)
+    assert s3.objects[(S3_bucket, key)] == module
+    assert lime.lime_module_cache_key(None) == (key, record['sha256'])
+
+
+def test_module_changed_after_review_is_not_promoted(lime, s3):
+    put_quarantined(lime, s3, b'\x7fELF replaced module')
+    with pytest.raises(Exception):
+        lime.promote_lime_module('i-1', release, hashlib.sha256(b'\x7fELF reviewed module').hexdigest())
+    assert (S3_bucket, lime.lime_module_s3_key(release)) not in s3.objects
+
+
+def test_module_is_not_promoted_without_custody_key(lime, s3, monkeypatch):
+    module = b'\x7fELF reviewed module'
+    put_quarantined(lime, s3, module)
+    monkeypatch.setattr(lime, 'S3_custody_key', None)
+    with pytest.raises(Exception):
+        lime.promote_lime_module('i-1', release, hashlib.sha256(module).hexdigest())
+    assert (S3_bucket, lime.lime_module_s3_key(release)) not in s3.objects
+
+
+@pytest.fixture
+def precheck(lime, monkeypatch, tmp_path):
+    # Containment-first check of the cache before the isolation, with no ssh connection
+    import containmentAndForensicsEC2 as cli
+    paramiko_key = tmp_path / 'ec2.key'
+    cli.paramiko.RSAKey.generate(1024).write_private_key_file(str(paramiko_key))
+    monkeypatch.setattr(cli, 'EC2_key', str(paramiko_key))
+    monkeypatch.setattr(cli, 'ssh_connect', lambda ssh_client, inst, ssh_public_ip, key: None)
+    inst_data = {'Reservations': [{'Instances': [{'State': {'Name': 'running'}}]}]}
+    return lambda: cli.lime_module_precheck('i-1', inst_data, {'ssh_public_ip': False})
+
+
+def test_precheck_keeps_the_memory_dump_with_a_prebuilt_module(precheck, lime, s3):
+    put_record(lime, s3, lime.lime_module_record(release, module_sha256))
+    assert precheck() is True
+
+
+def test_precheck_skips_the_memory_dump_on_a_cache_miss(precheck, capsys):
+    assert precheck() is False
+    assert '[ERROR] i-1: no prebuilt LiME module' in capsys.readouterr().out
+
+
+def test_precheck_skips_the_memory_dump_when_the_cache_can_not_be_checked(precheck, lime, monkeypatch):
+    monkeypatch.setattr(lime, 'run_remote', lambda ssh_client, cmd, timeout, deadline, on_line: 1)
+    assert precheck() is False
@@ -0,0 +1,28 @@
+import os, hashlib
+from conftest import S3_bucket, key, uploaded
+
+# Evidence streamed into an S3 multipart upload (forensicsCommon.S3MultipartUpload)
+
+
+def test_multipart_upload(common, s3):
+    data = os.urandom(3500)
+    parts = []
+    upload = common.S3MultipartUpload(S3_bucket, key, on_part=parts.append)
+    for n in range(0, len(data), 300):
+        upload.write(data[n:n + 300])
+    report = upload.complete()
+    assert uploaded(s3) == data
+    assert report['bytes'] == 3500 and [p['Size'] for p in report['parts']] == [1024, 1024, 1024, 428]
+    assert sorted(p['SHA256'] for p in parts) == sorted(hashlib.sha256(data[n:n + 1024]).hexdigest() for n in range(0, 3500, 1024))
+
+
+def test_multipart_upload_empty_object(common, s3):
+    common.S3MultipartUpload(S3_bucket, key).complete()
+    assert uploaded(s3) == b''
+
+
+def test_multipart_upload_part_size_read_when_created(common, s3, monkeypatch):
+    monkeypatch.setattr(common, 's3_part_size', 2048)
+    upload = common.S3MultipartUpload(S3_bucket, key)
+    upload.write(os.urandom(3000))
+    assert [p['Size'] for p in upload.complete()['parts']] == [2048, 952]
@@ -0,0 +1,191 @@
+import os, io, tarfile
+import pytest
+from botocore.exceptions import ClientError
+from conftest import S3_bucket, key, uploaded, sha256, read_index
+
+# Interrupted runs resumed: collector archive from its journal, multipart uploads from the parts
+# sent before, and the run journal in S3
+
+
+# Collector archive
+
+def result(output, target, status='OK'):
+    return {'name': 'logs', 'type': 'FILE', 'target': target, 'output': output, 'status': status}
+
+
+def interrupt(archive):
+    # Collector killed: nothing is closed properly, the index is not written
+    archive.f.close()
+    archive.journal.close()
+
+
+def test_archive_resume_keeps_members_of_finished_artifacts(collector, tmp_path):
+    path = str(tmp_path / 'evidence.tar')
+    archive = collector.EvidenceArchive(path)
+    archive.info = {'host': 'test'}
+    archive.record_info()
+    first = archive.add_stream('first', io.BytesIO(b'a' * 1000))
+    archive.record_result(result('first', '/var/log/first'), state={'inode': 1, 'dev': 1, 'offset': 1000, 'head': 'h'})
+    archive.add_stream('second', io.BytesIO(b'b' * 1000))  # Its artifact was not reported done
+    archive.record_result(result('failed', '/var/log/failed', 'ERROR'))
+    interrupt(archive)
+    with open(path + collector.archive_journal_extension, 'a') as f:
+        f.write('{"member": {"name": "cut')
+
+    archive = collector.EvidenceArchive(path, resume=True)
+    assert [m['name'] for m in archive.members] == ['first']
+    assert archive.results == [result('first', '/var/log/first')]
+    assert archive.state == {'/var/log/first': {'inode': 1, 'dev': 1, 'offset': 1000, 'head': 'h'}}
+    assert archive.info == {'host': 'test'}
+    assert os.path.getsize(path) == first['data_offset'] + 1024
+    archive.add_stream('second', io.BytesIO(b'c' * 10))
+    archive.close()
+
+    with tarfile.open(path) as tar:
+        assert tar.getnames() == ['first', 'second']
+        assert tar.extractfile('second').read() == b'c' * 10
+    assert [m['name'] for m in read_index(path)['members']] == ['first', 'second']
+
+
+def test_archive_resume_without_finished_artifacts_starts_over(collector, tmp_path):
+    path = str(tmp_path / 'evidence.tar')
+    archive = collector.EvidenceArchive(path)
+    archive.add_stream('first', io.BytesIO(b'a' * 1000))
+    interrupt(archive)
+
+    archive = collector.EvidenceArchive(path, resume=True)
+    assert archive.members == [] and archive.results == []
+    assert os.path.getsize(path) == 0
+    archive.close()
+
+
+def test_hash_archive_range(collector, tmp_path):
+    path = str(tmp_path / 'evidence.tar')
+    archive = collector.EvidenceArchive(path)
+    for n in range(3):
+        archive.add_stream('member{}'.format(n), io.BytesIO(os.urandom(1500)))
+    archive.close()
+    with open(path, 'rb') as f:
+        data = f.read()
+    members = read_index(path)['members']
+
+    hashes = collector.hash_archive_range(path, 0, 4096, 1000)
+    assert hashes['sha256'] == sha256(data[:4096])
+    assert hashes['windows'] == [sha256(data[o:min(o + 1000, 4096)]) for o in range(0, 4096, 1000)]
+    # Only the members whole in the range
+    assert hashes['members'] == {m['name']: m['stored_sha256'] for m in members if m['data_offset'] + m['size'] <= 4096}
+
+
+# Multipart uploads
+
+def interrupted_upload(common, s3, data, parts_accepted, **kwargs):
+    # Upload cut after parts_accepted parts, left open in S3. Returns it and the parts it sent
+    sent = []
+    s3.parts_left = parts_accepted
+    upload = common.S3MultipartUpload(S3_bucket, key, workers=1, on_part=sent.append, **kwargs)
+    with pytest.raises(ClientError):
+        upload.write(data)
+        upload.complete()
+    upload.abort(keep_parts=True)
+    s3.parts_left = None
+    return upload, sorted(sent, key=lambda p: p['PartNumber'])
+
+
+def test_multipart_upload_stops_reading_after_a_failed_part(common, s3):
+    s3.parts_left = 0
+    upload = common.S3MultipartUpload(S3_bucket, key, workers=1)
+    with pytest.raises(ClientError):
+        for n in range(10):
+            upload.write(os.urandom(1024))
+    # At most the parts already in flight (2 * workers) and the one waiting for them are sent
+    assert n <= 3 and 1 <= s3.parts_refused <= 3
+    upload.abort()
+    assert s3.uploads == {}
+
+
+def test_resumed_upload_reuses_parts_sent_before(common, s3):
+    data = os.urandom(3500)
+    first, sent = interrupted_upload(common, s3, data, 2)
+    assert [p['PartNumber'] for p in sent] == [1, 2]
+    upload = common.S3MultipartUpload(S3_bucket, key, upload_id=first.upload_id, parts=sent)
+    upload.write(data)
+    report = upload.complete()
+    assert uploaded(s3) == data
+    assert report['reused_parts'] == 2 and report['bytes'] == 3500
+
+
+def test_resumed_upload_sends_changed_parts_again(common, s3):
+    data = os.urandom(3500)
+    first, sent = interrupted_upload(common, s3, data, 2)
+    changed = data[:1024] + b'\0' * 1024 + data[2048:]
+    upload = common.S3MultipartUpload(S3_bucket, key, upload_id=first.upload_id, parts=sent)
+    upload.write(changed)
+    assert upload.complete()['reused_parts'] == 1
+    assert uploaded(s3) == changed
+
+
+def test_resumed_upload_skips_parts_not_read_again(common, s3):
+    data = os.urandom(3500)
+    first, sent = interrupted_upload(common, s3, data, 2)
+    upload = common.S3MultipartUpload(S3_bucket, key, upload_id=first.upload_id, parts=sent)
+    upload.skip(2)
+    upload.write(data[2048:])
+    report = upload.complete()
+    assert uploaded(s3) == data
+    assert report['reused_parts'] == 2 and report['bytes'] == 3500
+
+
+# RunJournal
+
+def test_run_journal_states(common, s3):
+    journal = common.RunJournal('run-1', 'i-1')
+    journal_key = common.S3_evidence_path + common.run_journal_prefix + 'run-1/i-1.json'
+    assert journal.key == journal_key and (S3_bucket, journal_key) in s3.objects
+    assert journal.step('push') == {} and not journal.done('push')
+    journal.update('push', done=True)
+    journal.note('collection', pid=123)  # Saved later
+    journal.step('push')['done'] = False  # A copy
+    assert journal.done('push')
+
+    resumed = common.RunJournal('run-1', 'i-1')
+    assert resumed.done('push') and resumed.step('collection') == {}
+    assert len(resumed.state['attempts']) == 2
+    assert common.RunJournal('run-2', 'i-1').state['steps'] == {}
+
+
+def test_resumable_upload_resumes_the_upload_of_an_earlier_attempt(common, s3, monkeypatch):
+    monkeypatch.setattr(common, 'run_journal_save_interval', 0)
+    data = os.urandom(3500)
+    journal = common.RunJournal('run-1', 'i-1')
+    s3.parts_left = 2
+    upload = common.resumable_upload(key, journal, 'archive')
+    with pytest.raises(ClientError):
+        upload.write(data)
+        upload.complete()
+    upload.abort(keep_parts=True)
+    s3.parts_left = None
+
+    # The parts S3 accepted were recorded as they were sent, none of them is sent again
+    journal = common.RunJournal('run-1', 'i-1')
+    previous = journal.step('archive')
+    assert previous['upload_id'] == upload.upload_id and len(previous['parts']) == 2
+    upload = common.resumable_upload(key, journal, 'archive')
+    upload.write(data)
+    report = upload.complete()
+    assert uploaded(s3) == data and report['reused_parts'] == 2
+
+
+@pytest.mark.parametrize('change', ['upload gone', 'part size'])
+def test_resumable_upload_starts_over(common, s3, monkeypatch, change):
+    journal = common.RunJournal('run-1', 'i-1')
+    first = common.resumable_upload(key, journal, 'archive')
+    first.write(os.urandom(2048))
+    first.abort(keep_parts=change != 'upload gone')
+    if change == 'part size':
+        monkeypatch.setattr(common, 's3_part_size', 2048)
+
+    upload = common.resumable_upload(key, common.RunJournal('run-1', 'i-1'), 'archive')
+    assert upload.upload_id != first.upload_id and upload.sent == {}
+    upload.write(b'new')
+    upload.complete()
+    assert uploaded(s3) == b'new'
@@ -0,0 +1,38 @@
+import subprocess, time
+import pytest
+from conftest import make_tree, file_state, file_job, collection_state
+
+# Per-artifact timeouts of the collector: what was read before the timeout is kept
+
+
+class SlowReader:
+    """Endless source, one chunk every delay seconds"""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def read(self, n=-1):
+        time.sleep(self.delay)
+        return b'x' * 100
+
+
+def test_add_stream_timeout_keeps_what_was_read(collector, tmp_path):
+    archive = collector.EvidenceArchive(str(tmp_path / 'evidence.tar'))
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        archive.add_stream('slow', SlowReader(0.01), timeout=0.1)
+    assert e.value.output == 'slow'
+    member = archive.members[0]
+    assert member['name'] == 'slow' and 0 < member['original_size'] < 100 * 20
+    archive.close()
+
+
+def test_collect_file_timeout_ends_state_where_the_copy_did(collector, tmp_path):
+    path = str(tmp_path / 'syslog')
+    make_tree(str(tmp_path), {'syslog': b'x' * 100})
+    archive = collector.EvidenceArchive(str(tmp_path / 'evidence.tar'))
+    state = collection_state({path: file_state(collector, path, 60)})
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        collector.collect_file(file_job(path), archive, state, collector.CollectionBudget(), timeout=0)
+    assert e.value.output == 'logs/syslog.60-100'
+    assert state['current'][path]['offset'] == 60 + collector.member_original_size(archive, e.value.output)
+    archive.close()